@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+#
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks of the pipeline tools on synthetic data.
+
+Synthesizes a file_counts.py style dataset with Zipf or log-normal distributed
+copies, generates an upload stream from it and measures the throughput and
+the peak memory of
+    * generate-upload-stream.py for each popularity distribution,
+    * simulator.py for each engine, short hash length and combination of the
+      protocol flags,
+    * simulator-perfect.py for each set of the files seen,
+    * oversample.py.
+
+The tools are run with --timings (see simulator/profiling.py) and the results
+are written as JSON:
+    {"commit": ..., "python": ..., "config": {...},
+     "results": [{"name": ..., "tool": ..., "args": [...], "uploads": ...,
+                  "wall": ..., "uploads_per_sec": ..., "max_rss": ...,
+                  "phases": {...}}, ...]}
+
+A failed benchmark has an "error" instead of the measurements. With
+--compare BASELINE the results are also compared to an earlier run.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOOLS = os.path.join(ROOT, "simulator")
+
+# The protocol flags of simulator.py; every combination is benchmarked.
+PROTOCOL_FLAGS = ("--with-sizes", "--deduplicate-below-threshold",
+                  "--one-successful-check")
+
+DISTRIBUTIONS = ("uniform", "normal", "lognormal")
+
+# The options that change the synthesized data; the results of runs with
+# different values are not comparable.
+DATA_PARAMS = ("files", "popularity", "zipf_exponent", "lognormal_sigma",
+               "max_copies", "seed")
+
+# The largest file size a stream can hold (5 bytes)
+MAX_SIZE = (1 << 40) - 1
+
+
+def synthesize(path, args):
+    """Writes a '<sha1 hash>  <copies>  <size>' dataset of args.files files.
+
+    Returns:
+        The total number of uploads of the dataset.
+    """
+
+    rnd = np.random.default_rng(args.seed)
+    if args.popularity == "zipf":
+        copies = rnd.zipf(args.zipf_exponent, args.files)
+    else:
+        copies = rnd.lognormal(0, args.lognormal_sigma, args.files) + 1
+    copies = np.minimum(copies, args.max_copies).astype(np.int64)
+
+    sizes = np.minimum(rnd.lognormal(10, 3, args.files) + 1, MAX_SIZE)
+    hashes = rnd.bytes(20 * args.files)
+
+    sizes = sizes.astype(np.int64).tolist()
+    with open(path, "w") as out:
+        for i, (count, size) in enumerate(zip(copies.tolist(), sizes)):
+            out.write("%s  %i  %i\n" % (hashes[20 * i:20 * i + 20].hex(),
+                                        count, size))
+
+    return int(copies.sum())
+
+
+def run(name, tool, tool_args, uploads, work_dir, stdin=None, stdout=None):
+    """Runs a tool with --timings and returns its measurements."""
+    timings = os.path.join(work_dir, "timings.json")
+    if os.path.exists(timings):
+        os.remove(timings)
+
+    argv = [sys.executable, os.path.join(TOOLS, tool)] + tool_args + \
+        ["--timings", timings]
+    print("+++ %s" % name, file=sys.stderr)
+
+    with open(stdin or os.devnull, "rb") as inp, \
+            open(stdout or os.devnull, "wb") as out:
+        proc = subprocess.run(argv, stdin=inp, stdout=out,
+                              stderr=subprocess.PIPE)
+
+    result = {"name": name, "tool": tool, "args": tool_args}
+    if proc.returncode != 0 or not os.path.exists(timings):
+        lines = proc.stderr.decode(errors="replace").strip().splitlines()
+        result["error"] = lines[-1] if lines else \
+            "exit status %i" % proc.returncode
+        print("+++ %s failed: %s" % (name, result["error"]), file=sys.stderr)
+        return result
+
+    with open(timings) as fileobj:
+        measured = json.load(fileobj)
+
+    result.update(
+        uploads=uploads,
+        wall=measured["wall"],
+        uploads_per_sec=uploads / measured["wall"] if uploads else None,
+        max_rss=measured["max_rss"],
+        phases=measured["phases"],
+    )
+    return result
+
+
+def benchmarks(args, work_dir):
+    """Runs the benchmarks selected by args.
+
+    Returns:
+        A list of the results; see run().
+    """
+
+    data = os.path.join(work_dir, "data.txt")
+    uploads = synthesize(data, args)
+    print("+++ Synthesized %i files, %i uploads" % (args.files, uploads),
+          file=sys.stderr)
+
+    stream = os.path.join(work_dir, "stream.bin")
+    results = []
+
+    def selected(name):
+        return not args.only or any(part in name for part in args.only)
+
+    for distribution in DISTRIBUTIONS:
+        name = "generate/%s" % distribution
+        if not selected(name) and distribution != "uniform":
+            continue
+        # The uniform stream is the input of the simulators.
+        out = stream if distribution == "uniform" else None
+        result = run(name, "generate-upload-stream.py",
+                     [data, "--distribution", distribution,
+                      "--seed", str(args.seed)],
+                     uploads, work_dir, stdout=out)
+        if selected(name):
+            results.append(result)
+
+    engines = args.engines.split(",")
+    for engine, shlen in itertools.product(engines, args.short_hash_lengths):
+        for count in range(len(PROTOCOL_FLAGS) + 1):
+            for flags in itertools.combinations(PROTOCOL_FLAGS, count):
+                name = "simulator/%s/shlen=%i/%s" % (
+                    engine, shlen,
+                    ",".join(flag.lstrip("-") for flag in flags) or "default")
+                if not selected(name):
+                    continue
+                results.append(run(
+                    name, "simulator.py",
+                    [stream, "--engine", engine, "--short-hash-length",
+                     str(shlen), "--seed", str(args.seed), "--only-final"] +
+                    list(flags),
+                    uploads, work_dir))
+
+    for seen_set in ("runs", "table"):
+        name = "perfect" if seen_set == "runs" else "perfect/%s" % seen_set
+        if selected(name):
+            results.append(run(name, "simulator-perfect.py",
+                               [stream, "--seed", str(args.seed),
+                                "--seen-set", seen_set],
+                               uploads, work_dir))
+
+    if selected("oversample"):
+        results.append(run("oversample", "oversample.py",
+                           ["--smote-amount", "100"], None, work_dir,
+                           stdin=data))
+
+    return results
+
+
+def commit():
+    """Returns the git commit of the tree or None."""
+    try:
+        return subprocess.check_output(
+            ["git", "-C", ROOT, "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, config, results):
+    """Prints the wall time and memory of the results relative to the
+    results of an earlier run.
+    """
+
+    if any(baseline["config"].get(name) != config[name]
+           for name in DATA_PARAMS):
+        print("+++ The baseline was run with a different configuration: %s" %
+              json.dumps(baseline["config"], sort_keys=True), file=sys.stderr)
+
+    before = {result["name"]: result for result in baseline["results"]}
+    print("%-60s %10s %10s" % ("benchmark", "speedup", "memory"),
+          file=sys.stderr)
+    for result in results:
+        old = before.get(result["name"])
+        if old is None or "error" in old or "error" in result:
+            continue
+        print("%-60s %9.2fx %9.2fx" % (result["name"],
+                                       old["wall"] / result["wall"],
+                                       result["max_rss"] / old["max_rss"]),
+              file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--files", action="store", default=20000, type=int,
+        help="The number of distinct files in the dataset (default: 20000).")
+    parser.add_argument(
+        "--popularity", action="store", default="zipf",
+        choices=["zipf", "lognormal"],
+        help="The distribution of the copies of the files.")
+    parser.add_argument(
+        "--zipf-exponent", action="store", default=1.8, type=float,
+        help="The exponent of the Zipf distribution (> 1).")
+    parser.add_argument(
+        "--lognormal-sigma", action="store", default=1.5, type=float,
+        help="The sigma of the log-normal distribution.")
+    parser.add_argument(
+        "--max-copies", action="store", default=100000, type=int,
+        help="The largest number of copies of a file.")
+    parser.add_argument(
+        "--short-hash-lengths", action="store", default=[5, 13],
+        type=lambda text: [int(v) for v in text.split(",")],
+        help="A comma separated list of the short hash lengths to simulate " +
+             "(default: 5,13).")
+    parser.add_argument(
+        "--engines", action="store", default="reference,array",
+        help="A comma separated list of the simulator engines.")
+    parser.add_argument(
+        "--seed", action="store", default=1, type=int,
+        help="The seed of the dataset, the stream and the simulations.")
+    parser.add_argument(
+        "--only", action="append",
+        help="Only run the benchmarks whose name contains the string; can " +
+             "be given multiple times.")
+    parser.add_argument(
+        "--work-dir", action="store", type=str,
+        help="The directory of the synthesized data; a temporary " +
+             "directory by default.")
+    parser.add_argument(
+        "--output", action="store", default="-", type=str,
+        help="The file to write the results to (default: stdout).")
+    parser.add_argument(
+        "--compare", action="store", type=str, metavar="BASELINE",
+        help="Compare the results to the results of an earlier run.")
+    args = parser.parse_args()
+
+    if args.popularity == "zipf" and args.zipf_exponent <= 1:
+        parser.error("--zipf-exponent must be greater than 1")
+
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = benchmarks(args, args.work_dir)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = benchmarks(args, work_dir)
+
+    config = {name: value for name, value in vars(args).items()
+              if name not in ("output", "compare", "work_dir")}
+    document = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "config": config,
+        "results": results,
+    }
+
+    if args.output == "-":
+        json.dump(document, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as out:
+            json.dump(document, out, indent=2)
+            out.write("\n")
+
+    if args.compare:
+        with open(args.compare) as fileobj:
+            compare(json.load(fileobj), config, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+% Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+%
+% Licensed under the Apache License, Version 2.0 (the "License");
+% you may not use this file except in compliance with the License.
+% You may obtain a copy of the License at
+%
+%     http://www.apache.org/licenses/LICENSE-2.0
+%
+% Unless required by applicable law or agreed to in writing, software
+% distributed under the License is distributed on an "AS IS" BASIS,
+% WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+% See the License for the specific language governing permissions and
+% limitations under the License.
+
+function [params, data] = read_results(file)
+  % Reads a simulator output file written with --output-format binary.
+  % params is a struct of the run parameters and data has the same columns
+  % as the csv output.
+  fid = fopen(file, 'r', 'ieee-le');
+  magic = fread(fid, 8, '*char')';
+  if ~strcmp(magic, 'DDPEVO01')
+      fclose(fid);
+      error('%s is not a binary simulator output file', file);
+  end
+
+  flags = fread(fid, 1, 'uint32');
+  len = fread(fid, 1, 'uint32');
+  params = jsondecode(fread(fid, len, '*char')');
+  % --with-perfect-baseline adds columns; they are listed in the parameters
+  width = 4;
+  if isfield(params, 'columns')
+      width = numel(params.columns);
+  end
+
+  blocks = {};
+  while true
+      count = fread(fid, 1, 'uint64');
+      if isempty(count)
+          break
+      end
+      % The blocks are stored column by column
+      blocks{end + 1} = fread(fid, [count, width], 'int64');
+  end
+  fclose(fid);
+
+  data = vertcat(zeros(0, width), blocks{:});
+  if bitand(flags, 1)
+      data = cumsum(data);
+  end
+end
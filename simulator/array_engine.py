@@ -0,0 +1,616 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An array-backed engine for the protocol simulation.
+
+The files are stored as parallel NumPy arrays indexed by a file slot and the
+files of each bucket form a linked list (through the next array) in the order
+of their popularity. The checkers of a file are runs of checkers with the same
+check count, like checkerset.CheckerSet: files with a single checker keep it
+inline and the others get a linked list of (check count, checkers) runs from
+a shared pool in descending order of the check counts. The keys of the files
+are stored in full, as one 64-bit word for file IDs and three for the 20 byte
+hashes of raw streams.
+
+A file takes 64 bytes with a file ID and 80 bytes with a hash, and every run
+of a file with more than one checker another 32 bytes. The arrays grow by
+doubling, so up to half of them may be unused. A bucket takes about 120 bytes
+with its entry in the dict of the bucket IDs.
+
+The protocol step runs over whole batches of uploads. The kernel is compiled
+with Numba if it is installed; otherwise the same code runs in the interpreter
+over memoryviews of the arrays, which is correct but slower than the reference
+engine. Numba is only imported when the first ArrayState is created.
+
+The kernel draws the random numbers from the same per bucket SplitMix64
+streams as rng.BucketRandom, in the same order, so the results are the same
+as those of the reference engine.
+"""
+
+import checkpoint
+import math
+import rng
+import sys
+
+import numpy as np
+
+# The Numba module once compile_kernel() has imported it; None if it is not
+# installed or the kernel has not been compiled yet
+numba = None
+
+MASK64 = rng.MASK64
+GOLDEN = rng.GOLDEN
+
+# 2^-53; converts 53 random bits to a float in [0, 1)
+INV53 = 1.0 / (1 << 53)
+
+# The indexes of the scalar state in ArrayState.meta
+N_FILES, N_RUNS, N_FREE_RUNS, N_FREE_FILES, REMOVED = range(5)
+
+# The indexes of the instrumentation counters in ArrayState.stats; the
+# histogram of the scanned files per upload starts at STAT_HISTOGRAM.
+(STAT_UPLOADS, STAT_SCANNED, STAT_CONSIDERED, STAT_OFFLINE, STAT_MATCHES,
+ STAT_REORDERS, STAT_REORDER_DISTANCE, STAT_HISTOGRAM) = range(8)
+N_STATS = STAT_HISTOGRAM + 65
+
+# The number of uploads the kernel simulates at once. Bounds the space that
+# must be reserved before each call.
+KERNEL_BATCH_SIZE = 4096
+
+
+def _next64(bstate, b):
+    """Returns the next 64-bit random integer of bucket b."""
+    s = (bstate[b] + GOLDEN) & MASK64
+    bstate[b] = s
+    z = ((s ^ (s >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+
+def _alloc_run(v, count, nxt, rvalue, rcount, rnext, free_runs, meta):
+    """Allocates a run of count checkers with v checks left followed by the
+    run nxt.
+    """
+
+    if meta[N_FREE_RUNS] > 0:
+        meta[N_FREE_RUNS] -= 1
+        r = free_runs[meta[N_FREE_RUNS]]
+    else:
+        r = meta[N_RUNS]
+        meta[N_RUNS] += 1
+
+    rvalue[r] = v
+    rcount[r] = count
+    rnext[r] = nxt
+    return r
+
+
+def _take(f, ftotal, ftop, fruns, rvalue, rcount, rnext, free_runs, meta):
+    """Removes the checker with the most checks left from file f and returns
+    its check count.
+    """
+
+    v = ftop[f]
+    ftotal[f] -= 1
+
+    # The checkers with the most checks left are in the first run.
+    r = fruns[f]
+    if r != -1:
+        rcount[r] -= 1
+        if rcount[r] == 0:
+            nxt = rnext[r]
+            free_runs[meta[N_FREE_RUNS]] = r
+            meta[N_FREE_RUNS] += 1
+            fruns[f] = nxt
+            if nxt != -1:
+                ftop[f] = rvalue[nxt]
+
+    return v
+
+
+def _add(f, v, ftotal, ftop, fruns, rvalue, rcount, rnext, free_runs, meta):
+    """Adds a checker with v checks left to file f."""
+    r = fruns[f]
+    total = ftotal[f]
+    ftotal[f] = total + 1
+    if r == -1:
+        if total == 0:
+            ftop[f] = v
+            return
+
+        # The second checker; switch to a list of runs.
+        r = _alloc_run(ftop[f], 1, -1, rvalue, rcount, rnext, free_runs,
+                       meta)
+        fruns[f] = r
+
+    if v > rvalue[r]:
+        fruns[f] = _alloc_run(v, 1, r, rvalue, rcount, rnext, free_runs,
+                              meta)
+        ftop[f] = v
+        return
+
+    # Find the run of v or the place of a new one; usually the first or the
+    # second run.
+    prev = -1
+    while r != -1 and rvalue[r] > v:
+        prev = r
+        r = rnext[r]
+
+    if r != -1 and rvalue[r] == v:
+        rcount[r] += 1
+    else:
+        rnext[prev] = _alloc_run(v, 1, r, rvalue, rcount, rnext, free_runs,
+                                 meta)
+
+
+def _free_file(f, fruns, rnext, free_runs, free_files, meta):
+    """Releases the slot and the runs of file f."""
+    r = fruns[f]
+    while r != -1:
+        free_runs[meta[N_FREE_RUNS]] = r
+        meta[N_FREE_RUNS] += 1
+        r = rnext[r]
+    fruns[f] = -1
+
+    free_files[meta[N_FREE_FILES]] = f
+    meta[N_FREE_FILES] += 1
+
+
+def _alloc_file(free_files, meta):
+    """Allocates a file slot."""
+    if meta[N_FREE_FILES] > 0:
+        meta[N_FREE_FILES] -= 1
+        return free_files[meta[N_FREE_FILES]]
+
+    f = meta[N_FILES]
+    meta[N_FILES] += 1
+    return f
+
+
+def _same_key(fkey, f, keys, j):
+    """Returns true if file f has the key of upload j."""
+    for w in range(keys.shape[1]):
+        if fkey[f, w] != keys[j, w]:
+            return False
+    return True
+
+
+def _simulate(keys, bidx, stored, rlc, rlu, span, offline_rate,
+              dedup_below, one_success, fkey, fcopies, fthreshold, ftotal,
+              ftop, fruns, fnext, head, tail, bstate, rvalue, rcount, rnext,
+              free_runs, free_files, meta, stats):
+    """Simulates a batch of uploads. See Simulation.upload() in simulator.py
+    for the protocol; this is the same step over the arrays.
+
+    Args:
+        keys - The file keys of the uploads; a row of 64-bit words each.
+        bidx - The bucket indexes of the uploads.
+        stored - Output; set to 1 for each upload that was stored.
+        span - max_threshold - 1; the number of possible thresholds.
+        The rest are the protocol parameters and the ArrayState arrays.
+    """
+
+    for j in range(len(bidx)):
+        b = bidx[j]
+
+        dedup = False
+        match = -1
+        considered = 0
+        scanned = 0
+        run_start = 0
+        distance = 0
+
+        # The previous file in the list, the file before the current run of
+        # files with equal copies and the same at the time of the match.
+        prev = -1
+        before_run = -1
+        run_copies = -1
+        match_prev = -1
+        match_before = -1
+
+        f = head[b]
+        while f != -1:
+            nxt = fnext[f]
+            copies = fcopies[f]
+            if copies != run_copies:
+                before_run = prev
+                run_copies = copies
+                run_start = scanned
+            scanned += 1
+
+            if offline_rate != 0.0 and \
+                    (_next64(bstate, b) >> 11) * INV53 < \
+                    math.pow(offline_rate, ftotal[f]):
+                # All checkers were offline, try the next one
+                prev = f
+                f = nxt
+                continue
+
+            considered += 1
+            remaining = ftop[f] - 1
+            r = fruns[f]
+            if remaining > 0 and \
+                    (r == -1 or rcount[r] == 1 and
+                     (rnext[r] == -1 or rvalue[rnext[r]] < remaining)) and \
+                    (match != -1 or not _same_key(fkey, f, keys, j)):
+                # _take() and _add() inlined. Usually the checker is alone
+                # in the first run and still has more checks left than the
+                # other checkers, so it is updated in place.
+                ftop[f] = remaining
+                if r != -1:
+                    rvalue[r] = remaining
+
+                if considered == rlu:
+                    break
+                prev = f
+                f = nxt
+                continue
+
+            remaining = _take(f, ftotal, ftop, fruns, rvalue, rcount, rnext,
+                              free_runs, meta) - 1
+
+            if match == -1 and _same_key(fkey, f, keys, j):
+                match = f
+                match_prev = prev
+                match_before = before_run
+                distance = scanned - 1 - run_start
+
+                if dedup_below or copies >= fthreshold[f]:
+                    dedup = True
+
+                fcopies[f] = copies + 1
+
+                if one_success and dedup:
+                    remaining = rlc
+                else:
+                    _add(f, rlc, ftotal, ftop, fruns, rvalue, rcount, rnext,
+                         free_runs, meta)
+
+            if remaining > 0:
+                _add(f, remaining, ftotal, ftop, fruns, rvalue, rcount,
+                     rnext, free_runs, meta)
+            elif ftotal[f] == 0:
+                # The file can never be considered again; unlink it.
+                if prev == -1:
+                    head[b] = nxt
+                else:
+                    fnext[prev] = nxt
+                if tail[b] == f:
+                    tail[b] = prev
+
+                _free_file(f, fruns, rnext, free_runs, free_files, meta)
+                meta[REMOVED] += 1
+
+                if considered == rlu:
+                    break
+                f = nxt
+                continue
+
+            if considered == rlu:
+                break
+
+            prev = f
+            f = nxt
+
+        if match != -1:
+            if match_prev != match_before:
+                # Move the file behind the files that have at least as many
+                # copies.
+                fnext[match_prev] = fnext[match]
+                if tail[b] == match:
+                    tail[b] = match_prev
+
+                if match_before == -1:
+                    fnext[match] = head[b]
+                    head[b] = match
+                else:
+                    fnext[match] = fnext[match_before]
+                    fnext[match_before] = match
+        else:
+            f = _alloc_file(free_files, meta)
+            for w in range(keys.shape[1]):
+                fkey[f, w] = keys[j, w]
+            fcopies[f] = 1
+            fthreshold[f] = 2 + (((_next64(bstate, b) >> 11) * span) >> 53)
+            ftotal[f] = 1
+            ftop[f] = rlc
+            fruns[f] = -1
+            fnext[f] = -1
+
+            if tail[b] == -1:
+                head[b] = f
+            else:
+                fnext[tail[b]] = f
+            tail[b] = f
+
+        stored[j] = 0 if dedup else 1
+
+        stats[STAT_UPLOADS] += 1
+        stats[STAT_SCANNED] += scanned
+        stats[STAT_CONSIDERED] += considered
+        stats[STAT_OFFLINE] += scanned - considered
+        if match != -1:
+            stats[STAT_MATCHES] += 1
+        if match != -1 and match_prev != match_before:
+            stats[STAT_REORDERS] += 1
+            stats[STAT_REORDER_DISTANCE] += distance
+
+        # The log2 class of the scanned files; see metrics.py
+        k = 0
+        while scanned >> k:
+            k += 1
+        stats[STAT_HISTOGRAM + k] += 1
+
+
+def _bucket_lengths(head, fnext, lengths):
+    """Counts the files in each bucket into lengths."""
+    for b in range(len(head)):
+        n = 0
+        f = head[b]
+        while f != -1:
+            n += 1
+            f = fnext[f]
+        lengths[b] = n
+
+
+# The functions of the kernel compiled with Numba
+KERNEL_FUNCTIONS = ("_next64", "_alloc_run", "_take", "_add",
+                    "_bucket_lengths", "_free_file", "_alloc_file",
+                    "_same_key", "_simulate")
+
+# True once compile_kernel() has run
+_compiled = False
+
+
+def compile_kernel():
+    """Compiles the kernel with Numba if it is installed; the functions are
+    replaced by their compiled versions. Numba takes a while to import, so
+    it is only imported here, once.
+
+    Returns:
+        True if the kernel is compiled.
+    """
+
+    global numba, _compiled
+    if not _compiled:
+        _compiled = True
+        try:
+            import numba as jit
+        except ImportError:
+            return False
+
+        namespace = globals()
+        for name in KERNEL_FUNCTIONS:
+            namespace[name] = jit.njit(cache=True)(namespace[name])
+        numba = jit
+    return numba is not None
+
+
+# The per file arrays of ArrayState
+FILE_ARRAYS = ("fkey", "fcopies", "fthreshold", "ftotal", "ftop", "fruns",
+               "fnext")
+
+# The per run arrays of ArrayState
+RUN_ARRAYS = ("rvalue", "rcount", "rnext")
+
+
+def _grow(arr, size, fill=0):
+    """Returns arr grown to at least size items."""
+    if len(arr) >= size:
+        return arr
+
+    grown = np.full((max(size, 2 * len(arr)),) + arr.shape[1:], fill,
+                    arr.dtype)
+    grown[:len(arr)] = arr
+    return grown
+
+
+class ArrayState:
+    """The files and buckets of a simulation as flat arrays."""
+
+    def __init__(self, params, capacity=1024):
+        compile_kernel()
+        self.params = params
+        self.rng = rng.BucketRandom(params.seed)
+
+        # The random thresholds are drawn with 64-bit arithmetic.
+        if not 2 <= params.max_threshold <= 2049:
+            raise ValueError("The array engine supports max_threshold in " +
+                             "the range [2, 2049]")
+
+        # Per file arrays; the keys have a column per 64-bit word
+        self.fkey = np.zeros((capacity, 1), np.int64)
+        self.fcopies = np.zeros(capacity, np.int64)
+        self.fthreshold = np.zeros(capacity, np.int64)
+        self.ftotal = np.zeros(capacity, np.int64)
+        self.ftop = np.zeros(capacity, np.int64)
+        self.fruns = np.full(capacity, -1, np.int64)
+        self.fnext = np.full(capacity, -1, np.int64)
+        self.free_files = np.zeros(capacity, np.int64)
+
+        # Per bucket arrays
+        self.head = np.full(capacity, -1, np.int64)
+        self.tail = np.full(capacity, -1, np.int64)
+        self.bstate = np.zeros(capacity, np.uint64)
+
+        # Per run arrays
+        self.rvalue = np.zeros(capacity, np.int64)
+        self.rcount = np.zeros(capacity, np.int64)
+        self.rnext = np.full(capacity, -1, np.int64)
+        self.free_runs = np.zeros(capacity, np.int64)
+
+        self.meta = np.zeros(5, np.int64)
+
+        # The instrumentation counters; see STAT_UPLOADS
+        self.stats = np.zeros(N_STATS, np.int64)
+
+        # A dict bucket_id -> bucket index
+        self.bucket_index = {}
+
+    @property
+    def removed(self):
+        """The number of files removed because their checkers ran out."""
+        return int(self.meta[REMOVED])
+
+    def bucket_indexes(self, bucket_ids):
+        """Maps bucket IDs to dense bucket indexes, creating the buckets
+        that do not exist yet.
+        """
+
+        index = self.bucket_index
+        new = []
+        bidx = []
+        for bucket_id in bucket_ids:
+            b = index.get(bucket_id)
+            if b is None:
+                b = index[bucket_id] = len(index)
+                new.append(bucket_id)
+            bidx.append(b)
+
+        if new:
+            start = len(index) - len(new)
+            self.head = _grow(self.head, len(index), -1)
+            self.tail = _grow(self.tail, len(index), -1)
+            self.bstate = _grow(self.bstate, len(index))
+            self.bstate[start:len(index)] = [self.rng.initial_state(bucket_id)
+                                             for bucket_id in new]
+
+        return np.array(bidx, np.int64)
+
+    def file_keys(self, keys):
+        """Returns the upload keys as rows of 64-bit words; file IDs take a
+        word and hashes are padded with zeros to whole words.
+        """
+
+        if not keys or isinstance(keys[0], int):
+            rows = np.array(keys, np.int64).reshape(-1, 1)
+        else:
+            width = len(keys[0])
+            data = np.zeros((len(keys), -(-width // 8) * 8), np.uint8)
+            data[:, :width] = np.frombuffer(b"".join(keys), np.uint8) \
+                .reshape(len(keys), width)
+            rows = data.view(np.int64)
+
+        if rows.shape[1] != self.fkey.shape[1]:
+            if self.meta[N_FILES]:
+                raise ValueError("The file keys changed from %i to %i words"
+                                 % (self.fkey.shape[1], rows.shape[1]))
+            self.fkey = np.zeros((len(self.fkey), rows.shape[1]), np.int64)
+        return rows
+
+    def reserve(self, uploads):
+        """Makes sure the arrays have room for the given number of uploads;
+        each upload adds at most one file, and at most one run to each of
+        the RLu files it considers and two to the file it matches.
+        """
+
+        files = int(self.meta[N_FILES]) + uploads
+        for name in ("fkey", "fcopies", "fthreshold", "ftotal", "ftop",
+                     "free_files"):
+            setattr(self, name, _grow(getattr(self, name), files))
+        self.fruns = _grow(self.fruns, files, -1)
+        self.fnext = _grow(self.fnext, files, -1)
+
+        runs = int(self.meta[N_RUNS]) + uploads * (self.params.rlu + 1)
+        for name in ("rvalue", "rcount", "free_runs"):
+            setattr(self, name, _grow(getattr(self, name), runs))
+        self.rnext = _grow(self.rnext, runs, -1)
+
+    def bucket_lengths(self):
+        """Returns an array of the number of files in each bucket."""
+        buckets = len(self.bucket_index)
+        lengths = np.zeros(buckets, np.int64)
+        _bucket_lengths(self.head[:buckets], self.fnext, lengths)
+        return lengths
+
+    def get_state(self):
+        """Returns the state for a checkpoint as a (meta, arrays) tuple; see
+        checkpoint.py.
+        """
+
+        meta = self.meta
+        files = int(meta[N_FILES])
+        runs = int(meta[N_RUNS])
+        buckets = len(self.bucket_index)
+
+        arrays = {name: getattr(self, name)[:files] for name in FILE_ARRAYS}
+        arrays.update({name: getattr(self, name)[:runs]
+                       for name in RUN_ARRAYS})
+        arrays.update(
+            free_files=self.free_files[:meta[N_FREE_FILES]],
+            free_runs=self.free_runs[:meta[N_FREE_RUNS]],
+            head=self.head[:buckets],
+            tail=self.tail[:buckets],
+            bstate=self.bstate[:buckets],
+            meta=meta,
+            stats=self.stats,
+            bucket_ids=checkpoint.split_ints(list(self.bucket_index)),
+        )
+        return {}, arrays
+
+    def set_state(self, meta, arrays):
+        """Restores a state returned by get_state()."""
+        for name in FILE_ARRAYS + RUN_ARRAYS + ("free_files", "free_runs",
+                                                "head", "tail", "meta"):
+            setattr(self, name, np.array(arrays[name], np.int64))
+        self.bstate = np.array(arrays["bstate"], np.uint64)
+        self.stats = np.array(arrays["stats"], np.int64)
+
+        bucket_ids = checkpoint.join_ints(arrays["bucket_ids"])
+        self.bucket_index = {bucket_id: b
+                             for b, bucket_id in enumerate(bucket_ids)}
+
+    def simulate(self, keys, bucket_ids):
+        """Simulates a batch of uploads.
+
+        Returns:
+            A NumPy array of flags; 1 for each upload that was stored.
+        """
+
+        params = self.params
+        keys = self.file_keys(keys)
+        bidx = self.bucket_indexes(bucket_ids)
+        stored = np.zeros(len(keys), np.uint8)
+
+        for start in range(0, len(keys), KERNEL_BATCH_SIZE):
+            end = start + KERNEL_BATCH_SIZE
+            self.reserve(len(keys[start:end]))
+
+            arrays = [keys[start:end], bidx[start:end], stored[start:end]]
+            state = [self.fkey, self.fcopies, self.fthreshold, self.ftotal,
+                     self.ftop, self.fruns, self.fnext, self.head, self.tail,
+                     self.bstate, self.rvalue, self.rcount, self.rnext,
+                     self.free_runs, self.free_files, self.meta, self.stats]
+
+            span = params.max_threshold - 1
+            if numba is None:
+                # memoryviews give plain ints to the interpreted kernel.
+                arrays = [memoryview(arr) for arr in arrays]
+                state = [memoryview(arr) for arr in state]
+            else:
+                span = np.uint64(span)
+
+            _simulate(*arrays, params.rlc, params.rlu, span,
+                      float(params.offline_rate),
+                      bool(params.deduplicate_below_threshold),
+                      bool(params.one_successful_check), *state)
+
+        return stored
+
+
+def warn_if_interpreted():
+    """Prints a warning if the kernel cannot be compiled."""
+    if not compile_kernel():
+        print("+++ Numba is not installed; the array engine runs in the " +
+              "interpreter", file=sys.stderr)
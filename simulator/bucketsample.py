@@ -0,0 +1,170 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Estimates from a sample of the buckets.
+
+Files are only deduplicated against the files of their own bucket and the
+random numbers of a bucket do not depend on the other buckets (see
+rng.BucketRandom), so the uploads of a subset of the buckets are simulated
+exactly as in the whole stream. With --bucket-sample-rate p only the uploads
+of a pseudo-random fraction p of the short hashes are read; the short hash
+(or its top 64 bits if it is longer) is hashed with the seed and the upload
+is kept if the hash falls in the lowest fraction p of its range. All the
+buckets of a short hash, i.e. of its files of every size with --with-sizes,
+are kept or dropped together.
+
+The counters are scaled by 1 / p, so they estimate the counters of the whole
+stream, and the DDPs of the sample estimate the DDPs of the whole stream.
+Their standard errors are estimated with a delete-a-group jackknife over
+GROUPS groups of the sampled short hashes, and the --only-final lines end
+with
+    <stderr_files>,<stderr_bytes>
+"""
+
+import numpy as np
+
+import rng
+
+# The number of groups of the jackknife
+GROUPS = 32
+
+
+def _mix(values, key):
+    """Hashes a uint64 array with the SplitMix64 finalizer."""
+    z = values ^ np.uint64(key)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+class BucketSample:
+    """The sampled short hashes of a stream.
+
+    The sampling unit of an upload is its short hash if it has at most 64
+    bits and its top 64 bits otherwise.
+    """
+
+    def __init__(self, rate, seed, shlen, hashlen, interned):
+        """Creates a sample.
+
+        Args:
+            rate - The fraction of the short hashes to keep.
+            seed - The seed of the pseudo-random subset.
+            shlen - The length of the short hash in bits.
+            hashlen - The length of the dataset hashes in bits.
+            interned - True if the stream is interned; see
+                stream.UploadStream.batches().
+        """
+
+        self.rate = rate
+        self.key = rng.mix64(seed & rng.MASK64)
+        # Keep the units whose hash is below the limit.
+        self.limit = np.uint64(min(int(rate * 2 ** 64), rng.MASK64))
+
+        # The shift from the top 64 bits of the hashes of a raw stream to the
+        # unit (None if the values are the units) and the shift from the
+        # short hash to the unit
+        shift = hashlen - shlen
+        self.shift = shift - 96 if not interned and shift >= 96 else None
+        self.drop = max(96 - shift, 0)
+        self.mask = (1 << shlen) - 1
+
+    def select(self, values):
+        """Returns a mask of the uploads to keep given the values passed by
+        stream.UploadStream.batches().
+        """
+
+        if self.shift is not None:
+            if self.shift >= 64:
+                values = np.zeros_like(values)
+            else:
+                values = values >> np.uint64(self.shift)
+        return _mix(values, self.key) < self.limit
+
+    def groups(self, bucket_ids):
+        """Returns the jackknife group of each bucket ID of a batch; see
+        simulator.bucket_ids().
+        """
+        mask, drop = self.mask, self.drop
+        return np.fromiter((((bid & mask) >> drop) % GROUPS
+                            for bid in bucket_ids), np.intp, len(bucket_ids))
+
+
+class GroupCounters:
+    """The counters of a simulation (see results.COLUMNS) summed over each
+    jackknife group of the uploads.
+    """
+
+    def __init__(self):
+        self.counts = np.zeros((GROUPS, 4), np.int64)
+
+    def add(self, groups, stored, sizes):
+        """Adds the uploads of a batch given their groups, stored flags and
+        sizes.
+        """
+        stored = np.asarray(stored, np.bool_)
+        sizes = np.asarray(sizes, np.int64)
+        counts = self.counts
+        counts[:, 0] += np.bincount(groups[stored], minlength=GROUPS)
+        counts[:, 1] += np.bincount(groups, minlength=GROUPS)
+        np.add.at(counts[:, 2], groups[stored], sizes[stored])
+        np.add.at(counts[:, 3], groups, sizes)
+
+
+def standard_errors(counts, rate):
+    """Estimates the standard errors of the DDPs of a sample.
+
+    Args:
+        counts - The counters of each group; see GroupCounters.
+        rate - The sampling rate.
+
+    Returns:
+        A (stderr_files, stderr_bytes) tuple; NaN with less than two groups.
+    """
+
+    counts = counts[counts[:, 1] > 0]
+    groups = len(counts)
+    if groups < 2:
+        return float("nan"), float("nan")
+
+    # The DDPs without each group
+    rest = counts.sum(axis=0) - counts
+    errors = []
+    for stored, uploaded in ((0, 1), (2, 3)):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ddps = 1 - rest[:, stored] / rest[:, uploaded]
+        # The finite population correction 1 - rate makes the error of a
+        # sample of every bucket zero.
+        variance = (1 - rate) * (groups - 1) / groups * \
+            np.sum((ddps - ddps.mean()) ** 2)
+        errors.append(float(np.sqrt(variance)))
+    return tuple(errors)
+
+
+def add_arguments(parser):
+    """Adds the bucket sampling options to an argparse parser."""
+    group = parser.add_argument_group("Bucket Sampling")
+    group.add_argument(
+        "--bucket-sample-rate", action="store", default=1.0, type=float,
+        metavar="P",
+        help="Only simulate the uploads of a pseudo-random fraction P of " +
+             "the short hashes, chosen by the seed, and scale the counters " +
+             "by 1 / P. The DDPs estimate those of the whole stream; see " +
+             "above for their standard errors (default: 1).")
+
+
+def check_arguments(parser, args):
+    """Validates the bucket sampling options parsed by parser."""
+    if not 0 < args.bucket_sample_rate <= 1:
+        parser.error("--bucket-sample-rate must be in (0, 1]")
@@ -0,0 +1,229 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A memory-budgeted store for the buckets of the reference engine.
+
+The buckets are kept in memory in least recently used order until their
+estimated size exceeds the budget. Then the least recently used buckets are
+encoded and appended to a spill file and read back when they are accessed
+again. The spill file is an append-only log of records indexed by an
+in-memory dict bucket_id -> (offset, length, files); the records of the
+buckets read back become garbage and the file is compacted once the garbage
+outweighs the live records. The number of files of the buckets on disk is
+kept in the index so that they can be counted without reading them.
+"""
+
+import collections
+import os
+import tempfile
+
+# Rough sizes in bytes of an empty bucket and of a file in a bucket (the File,
+# its hash and its checkers) on 64-bit CPython
+BUCKET_BYTES = 300
+FILE_BYTES = 300
+
+# The size of a pre-drawn random number of rng.BucketRandom (an int in a list)
+DRAW_BYTES = 40
+
+# The spill file is compacted once it has at least this many bytes of garbage
+MIN_COMPACT_BYTES = 64 << 20
+
+STATS = (
+    # The accesses to buckets in memory, on disk and to new buckets
+    "hits",
+    "misses",
+    "new",
+    # The buckets written to disk and the bytes written and read back
+    "evictions",
+    "bytes_spilled",
+    "bytes_loaded",
+    "compactions",
+)
+
+
+def estimate(bucket_id, files):
+    """Estimates the memory used by a bucket."""
+    return BUCKET_BYTES + FILE_BYTES * len(files)
+
+
+class SpillingBuckets:
+    """A dict-like store bucket_id -> list of files that keeps at most about
+    budget bytes of buckets in memory. Like a defaultdict(list), missing
+    buckets are created empty on access.
+
+    The bucket returned by the last access may change until the next access;
+    its size is estimated again then.
+    """
+
+    def __init__(self, budget, encode, decode, directory=None,
+                 weigh=estimate):
+        """Creates an empty store.
+
+        Args:
+            budget - The memory budget of the buckets in memory in bytes.
+            encode - A function (bucket_id, files) -> bytes that encodes a
+                bucket written to disk. It may also take other state kept
+                in memory for the bucket with it.
+            decode - A function (bucket_id, bytes) -> files; the inverse of
+                encode.
+            directory - The directory of the spill file; the default
+                temporary directory if None.
+            weigh - A function (bucket_id, files) -> the estimated bytes of
+                a bucket in memory.
+        """
+
+        self.budget = budget
+        self.encode = encode
+        self.decode = decode
+        self.directory = directory
+        self.weigh = weigh
+
+        # The buckets in memory in least recently used order and their
+        # estimated sizes
+        self.resident = collections.OrderedDict()
+        self.weights = {}
+        self.used = 0
+
+        # The bucket returned by the last access
+        self.last = None
+
+        # The records of the buckets on disk and the spill file
+        self.index = {}
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.end = 0
+        self.garbage = 0
+
+        self.stats = dict.fromkeys(STATS, 0)
+
+    def __getitem__(self, bucket_id):
+        self._settle()
+
+        files = self.resident.get(bucket_id)
+        if files is not None:
+            self.resident.move_to_end(bucket_id)
+            self.stats["hits"] += 1
+        else:
+            files = self.resident[bucket_id] = self._load(bucket_id)
+            weight = self.weights[bucket_id] = self.weigh(bucket_id, files)
+            self.used += weight
+
+        self.last = bucket_id
+        while self.used > self.budget and len(self.resident) > 1:
+            self._evict()
+        return files
+
+    def __len__(self):
+        return len(self.resident) + len(self.index)
+
+    def _settle(self):
+        """Updates the estimated size of the last accessed bucket."""
+        bucket_id = self.last
+        if bucket_id is None or bucket_id not in self.resident:
+            return
+
+        weight = self.weigh(bucket_id, self.resident[bucket_id])
+        self.used += weight - self.weights[bucket_id]
+        self.weights[bucket_id] = weight
+
+    def _evict(self):
+        """Writes the least recently used bucket to the spill file."""
+        bucket_id, files = self.resident.popitem(last=False)
+        self.used -= self.weights.pop(bucket_id)
+
+        data = self.encode(bucket_id, files)
+        os.pwrite(self.file.fileno(), data, self.end)
+        self.index[bucket_id] = (self.end, len(data), len(files))
+        self.end += len(data)
+
+        self.stats["evictions"] += 1
+        self.stats["bytes_spilled"] += len(data)
+
+    def _read(self, bucket_id):
+        offset, length, _ = self.index[bucket_id]
+        return os.pread(self.file.fileno(), length, offset)
+
+    def _load(self, bucket_id):
+        """Reads a bucket from the spill file or creates a new one."""
+        if bucket_id not in self.index:
+            self.stats["new"] += 1
+            return []
+
+        files = self.decode(bucket_id, self._read(bucket_id))
+        _, length, _ = self.index.pop(bucket_id)
+        self.garbage += length
+        self.stats["misses"] += 1
+        self.stats["bytes_loaded"] += length
+
+        if self.garbage >= MIN_COMPACT_BYTES and \
+                self.garbage > self.end - self.garbage:
+            self._compact()
+        return files
+
+    def _compact(self):
+        """Rewrites the spill file without the garbage."""
+        old = self.file.fileno()
+        new = tempfile.TemporaryFile(dir=self.directory)
+        end = 0
+        for bucket_id, (offset, length, count) in self.index.items():
+            os.pwrite(new.fileno(), os.pread(old, length, offset), end)
+            self.index[bucket_id] = (end, length, count)
+            end += length
+
+        self.file.close()
+        self.file = new
+        self.end = end
+        self.garbage = 0
+        self.stats["compactions"] += 1
+
+    def spilled(self):
+        """Yields the (bucket_id, data) pairs of the buckets on disk; data is
+        the record written by encode. The buckets are not brought back to
+        memory and decode is not called; see resident for the buckets in
+        memory.
+        """
+        for bucket_id in list(self.index):
+            yield bucket_id, self._read(bucket_id)
+
+    def lengths(self):
+        """Yields the number of files of each bucket without reading the
+        buckets on disk.
+        """
+        for files in self.resident.values():
+            yield len(files)
+        for _, _, count in self.index.values():
+            yield count
+
+    def clear(self):
+        """Removes all the buckets."""
+        self.resident.clear()
+        self.weights.clear()
+        self.used = 0
+        self.last = None
+        self.index.clear()
+        self.file.truncate(0)
+        self.end = 0
+        self.garbage = 0
+
+    def close(self):
+        """Removes the spill file."""
+        self.file.close()
+
+    @property
+    def hit_rate(self):
+        """The fraction of the accesses to existing buckets served from
+        memory.
+        """
+        stats = self.stats
+        accesses = stats["hits"] + stats["misses"]
+        return stats["hits"] / accesses if accesses else 1.0
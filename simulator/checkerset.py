@@ -0,0 +1,93 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+class CheckerSet:
+    """The checkers of a file as a multiset of the number of checks each
+    checker has left.
+
+    The simulation only needs the number of checkers and the checker with the
+    most checks left, so instead of a sorted list of checkers this keeps a
+    histogram of the check counts. The histogram is stored sparsely as a flat
+    list of (checks, count) runs in ascending order of checks; the counts are
+    bounded by RLc so a file has at most RLc runs but popular files with
+    thousands of checkers usually only have a couple.
+
+    All the operations touch the last runs of the list so they take constant
+    time in practice instead of the O(n log n) sort of a checker list.
+    """
+
+    __slots__ = ("runs", "total")
+
+    def __init__(self, checks):
+        """Creates the checkers of a new file with a single checker that has
+        the given number of checks.
+        """
+
+        # A flat list [checks_0, count_0, checks_1, count_1, ...]
+        self.runs = [checks, 1]
+
+        # The number of checkers
+        self.total = 1
+
+    @classmethod
+    def from_runs(cls, runs):
+        """Creates checkers from a flat list of runs; see the runs
+        attribute.
+        """
+
+        checkers = cls.__new__(cls)
+        checkers.runs = runs
+        checkers.total = sum(runs[1::2])
+        return checkers
+
+    def take(self):
+        """Removes the checker with the most checks left.
+
+        Returns:
+            The number of checks the removed checker had left.
+        """
+
+        runs = self.runs
+        checks = runs[-2]
+        if runs[-1] == 1:
+            del runs[-2:]
+        else:
+            runs[-1] -= 1
+
+        self.total -= 1
+        return checks
+
+    def add(self, checks):
+        """Adds a checker with the given number of checks left."""
+        runs = self.runs
+
+        # The checks are usually at least the checks of the next to last run
+        # (RLc or one less than the checks of the last run).
+        i = len(runs)
+        while i and runs[i - 2] > checks:
+            i -= 2
+
+        if i and runs[i - 2] == checks:
+            runs[i - 1] += 1
+        else:
+            runs[i:i] = (checks, 1)
+
+        self.total += 1
+
+    def to_list(self):
+        """Returns the checkers as a sorted list of check counts."""
+        runs = self.runs
+        return [checks for i in range(0, len(runs), 2)
+                for checks in [runs[i]] * runs[i + 1]]
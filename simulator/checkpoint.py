@@ -0,0 +1,148 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checkpoints of the simulator state.
+
+A checkpoint is an uncompressed .npz file with the state of the simulations
+after a number of uploads. The state of each simulation is a (meta, arrays)
+pair where meta is a JSON serializable dict and arrays a dict of NumPy arrays;
+see Simulation.get_state() in simulator.py. A run with --workers N has the
+state of N shards of simulations.
+
+The file contains the arrays of shard i and simulation j under the names
+"i/j/<name>" and a JSON document under the name "meta" with the metadata of
+the run and of the simulations.
+"""
+
+import glob
+import json
+import os
+
+import numpy as np
+
+VERSION = 2
+
+FILE_TEMPLATE = "checkpoint-%015i.npz"
+
+# The parameters a fork cannot change since the state depends on them
+FIXED_PARAMS = ("shlen", "hashlen", "with_sizes", "engine")
+
+# The parameters of a simulation restored from a checkpoint on --resume
+STATE_PARAMS = ("rlc", "rlu", "max_threshold", "offline_rate", "shlen",
+                "hashlen", "with_sizes", "one_successful_check",
+                "deduplicate_below_threshold", "seed", "engine")
+
+# The output options restored on --resume; the output of the interrupted run
+# is continued in the same format
+OUTPUT_PARAMS = ("output_format", "delta", "only_final")
+
+
+def split_ints(values):
+    """Packs a list of non-negative integers of up to 128 bits into an
+    array of (low, high) 64-bit words.
+    """
+
+    mask = (1 << 64) - 1
+    words = np.empty((len(values), 2), np.uint64)
+    words[:, 0] = [value & mask for value in values]
+    words[:, 1] = [value >> 64 for value in values]
+    return words
+
+
+def join_ints(words):
+    """The inverse of split_ints()."""
+    return [lo | hi << 64 for lo, hi in words.tolist()]
+
+
+def split_bytes(values, length):
+    """Packs a list of byte strings of the given length into an array."""
+    return np.frombuffer(b"".join(values), np.uint8).reshape(-1, length)
+
+
+def join_bytes(array):
+    """The inverse of split_bytes()."""
+    return [row.tobytes() for row in array]
+
+
+def due(start, end, every):
+    """Returns True if a checkpoint is due after the uploads start..end."""
+    return bool(every) and end // every > start // every
+
+
+def save(directory, offset, meta, shards):
+    """Writes a checkpoint.
+
+    Args:
+        directory - The checkpoint directory.
+        offset - The number of uploads simulated.
+        meta - A dict of the run metadata.
+        shards - A list of lists of the (meta, arrays) states of the
+            simulations of each shard.
+
+    Returns:
+        The path of the checkpoint.
+    """
+
+    meta = dict(meta, version=VERSION, offset=offset,
+                shards=[[state for state, _ in sims] for sims in shards])
+
+    arrays = {"meta": np.frombuffer(json.dumps(meta).encode(), np.uint8)}
+    for i, sims in enumerate(shards):
+        for j, (_, sim_arrays) in enumerate(sims):
+            for name, array in sim_arrays.items():
+                arrays["%i/%i/%s" % (i, j, name)] = array
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, FILE_TEMPLATE % offset)
+
+    # Write a temporary file first so that a crash does not leave a broken
+    # checkpoint behind.
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as out:
+        np.savez(out, **arrays)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp, path)
+
+    return path
+
+
+def latest(directory):
+    """Returns the path of the latest checkpoint in the directory or None."""
+    paths = sorted(glob.glob(os.path.join(directory, "checkpoint-*.npz")))
+    return paths[-1] if paths else None
+
+
+def load(path):
+    """Reads a checkpoint.
+
+    Returns:
+        A (meta, shards) tuple; see save().
+    """
+
+    with np.load(path) as data:
+        meta = json.loads(data["meta"].tobytes().decode())
+        if meta.get("version") != VERSION:
+            raise ValueError("Unsupported checkpoint version in %s" % path)
+
+        shards = []
+        for i, sims in enumerate(meta["shards"]):
+            shards.append([])
+            for j, state in enumerate(sims):
+                prefix = "%i/%i/" % (i, j)
+                arrays = {name[len(prefix):]: data[name]
+                          for name in data.files if name.startswith(prefix)}
+                shards[i].append((state, arrays))
+
+    return meta, shards
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+#
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the simulation engines and modes to an oracle.
+
+Simulates seeded synthetic streams with the Oracle, a straight-line copy of
+the original simulation, and with each of the MODES over the matrix of the
+protocol flags and the offline rates, and checks that every upload is stored
+or deduplicated the same way, i.e. that the counters after every upload are
+identical. Exits with status 1 if any mode differs from the oracle.
+
+The oracle keeps the sorted checker lists, the adjacent swaps of the
+popularity order and the files without checkers of the original simulation,
+so the optimizations of the engines are checked against it; it only shares
+the random numbers of the buckets (rng.BucketRandom) with them.
+"""
+
+import argparse
+import collections
+import itertools
+import math
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+import checkpoint
+import rng
+import simulator
+import stream
+import utils
+
+# The modes compared to the oracle
+MODES = {
+    # The reference engine
+    "reference": ("reference", "feed"),
+    # The array engine
+    "array": ("array", "feed"),
+    # The reference engine sharded over --workers processes
+    "workers": ("reference", "workers"),
+    "array-workers": ("array", "workers"),
+    # One upload at a time with Simulation.upload()
+    "upload": ("reference", "upload"),
+    "array-upload": ("array", "upload"),
+    # A new simulation restored from a checkpoint after every batch
+    "restore": ("reference", "restore"),
+    "array-restore": ("array", "restore"),
+    # Buckets spilled to disk under a tiny memory budget
+    "spill": ("reference", "spill"),
+}
+
+# The memory budget of the spill mode; a few buckets
+SPILL_BUDGET = 16 << 10
+
+# The protocol flags; every combination is compared.
+PROTOCOL_FLAGS = ("with_sizes", "deduplicate_below_threshold",
+                  "one_successful_check")
+
+STREAM_FORMATS = ("raw", "interned")
+
+
+def synthesize(path, fmt, args, seed):
+    """Writes a stream of args.uploads uploads of args.files files with Zipf
+    distributed popularity.
+    """
+
+    rnd = np.random.default_rng(seed)
+    hashes = [rnd.bytes(20) for _ in range(args.files)]
+    # A few distinct sizes so that the buckets are shared with --with-sizes
+    sizes = rnd.integers(1, 8, args.files).tolist()
+
+    ranks = rnd.zipf(args.zipf_exponent, args.uploads) % args.files
+    order = rnd.permutation(args.files)
+    uploads = order[ranks].tolist()
+
+    with open(path, "wb") as out:
+        if fmt == "raw":
+            out.write(b"".join(sizes[f].to_bytes(5, byteorder="big") +
+                               hashes[f] for f in uploads))
+            return
+
+        with open(path + ".ids", "wb") as table:
+            writer = stream.IdStreamWriter(out, table, args.shlen, 160)
+            writer.write([hashes[f] for f in uploads],
+                         [sizes[f] for f in uploads])
+
+
+class Oracle:
+    """The original simulation of the protocol, one upload at a time; see
+    Simulation.upload() in simulator.py.
+    """
+
+    def __init__(self, params):
+        self.params = params
+        self.rng = rng.BucketRandom(params.seed)
+        self.buckets = collections.defaultdict(list)
+
+    def feed(self, keys, bucket_ids, sizes):
+        return [self.upload(key, bucket_id)
+                for key, bucket_id in zip(keys, bucket_ids)]
+
+    def upload(self, upload, bucket_id):
+        args = self.params
+        files = self.buckets[bucket_id]
+
+        file_deduplicated = False
+        match_found = False
+        match_index = 0
+        files_considered = 0
+
+        for i, fl in enumerate(files):
+            checkers = fl.checkers
+            if not checkers:
+                # The file no longer has checkers.
+                continue
+
+            # All the checkers are offline with probability rate ** n.
+            num_checkers = len(checkers)
+            if args.offline_rate and self.rng.random(bucket_id) < \
+                    math.pow(args.offline_rate, num_checkers):
+                continue
+
+            files_considered += 1
+
+            # The last checker has the most checks left.
+            checker_index = num_checkers - 1
+            checkers[checker_index] -= 1
+
+            if fl.hash == upload and not match_found:
+                match_found = True
+                match_index = i
+
+                if args.deduplicate_below_threshold or \
+                        fl.copies >= fl.threshold:
+                    file_deduplicated = True
+                fl.copies += 1
+
+                if args.one_successful_check and file_deduplicated:
+                    checkers[checker_index] = args.rlc
+                else:
+                    checkers += [args.rlc]
+
+            if checkers[checker_index] == 0:
+                checkers.pop(checker_index)
+            elif num_checkers > 1 and checkers[checker_index] != args.rlc:
+                checkers.sort()
+
+            if files_considered == args.rlu:
+                break
+
+        if not match_found:
+            files.append(simulator.File(
+                hash=upload, checkers=[args.rlc], copies=1,
+                threshold=self.rng.randint(bucket_id, 2, args.max_threshold)))
+
+        # Swap the matched file ahead until the bucket is ordered again.
+        while match_found and match_index > 0 and \
+                files[match_index - 1].copies < files[match_index].copies:
+            files[match_index - 1], files[match_index] = \
+                files[match_index], files[match_index - 1]
+            match_index -= 1
+
+        return not file_deduplicated
+
+
+def simulate(mode, params, path, args, work_dir):
+    """Simulates the stream in a mode or with the oracle ("oracle").
+
+    Returns:
+        A NumPy array of the stored flags of the uploads.
+    """
+
+    engine, how = MODES.get(mode, ("reference", mode))
+    params = argparse.Namespace(**dict(vars(params), engine=engine))
+    if how == "spill":
+        params.max_memory = SPILL_BUDGET
+    upload_stream = stream.UploadStream(path, args.batch_size)
+    batches = simulator.read_batches(params, upload_stream)
+
+    stored = []
+    if how == "oracle":
+        oracle = Oracle(params)
+        for batch in batches:
+            stored.extend(oracle.feed(*batch))
+    elif how == "workers":
+        pool = simulator.ShardPool([params], args.workers)
+        for _, all_stored in pool.simulate(batches):
+            stored.extend(all_stored[0])
+        pool.close()
+    else:
+        sim = simulator.new_simulation(params)
+        for keys, bids, sizes in batches:
+            if how == "upload":
+                stored.extend(sim.upload(*upload)
+                              for upload in zip(keys, bids, sizes))
+                continue
+
+            stored.extend(sim.feed(keys, bids, sizes))
+            if how == "restore":
+                saved = checkpoint.save(work_dir, len(stored), {},
+                                        [[sim.get_state()]])
+                _, shards = checkpoint.load(saved)
+                os.remove(saved)
+                sim = simulator.new_simulation(params)
+                sim.set_state(*shards[0][0])
+
+    upload_stream.close()
+    return np.array(stored, np.bool_)
+
+
+def describe(params):
+    """Returns a short description of the parameters of a comparison."""
+    flags = [name for name in PROTOCOL_FLAGS if getattr(params, name)]
+    return "rlc=%i rlu=%i max_threshold=%i offline_rate=%s %s" % (
+        params.rlc, params.rlu, params.max_threshold, params.offline_rate,
+        ",".join(flags) or "default")
+
+
+def compare(args, work_dir):
+    """Runs the comparisons.
+
+    Returns:
+        The number of comparisons that differed.
+    """
+
+    failures = 0
+    for fmt, seed in itertools.product(args.formats, args.seeds):
+        path = os.path.join(work_dir, "stream-%s-%i.bin" % (fmt, seed))
+        synthesize(path, fmt, args, seed)
+
+        for values in itertools.product(*([[False, True]] *
+                                          len(PROTOCOL_FLAGS))):
+            for offline_rate in args.offline_rates:
+                params = simulator.simulation_params(
+                    rlc=args.rlc, rlu=args.rlu,
+                    max_threshold=args.max_threshold,
+                    offline_rate=offline_rate, shlen=args.shlen, hashlen=160,
+                    seed=seed, metrics=None, max_memory=None,
+                    spill_dir=None,
+                    **dict(zip(PROTOCOL_FLAGS, values)))
+                reference = simulate("oracle", params, path, args, work_dir)
+
+                for mode in args.modes:
+                    stored = simulate(mode, params, path, args, work_dir)
+                    name = "%s stream=%s seed=%i %s" % (
+                        mode, fmt, seed, describe(params))
+                    if np.array_equal(stored, reference):
+                        print("ok       %s" % name)
+                        continue
+
+                    failures += 1
+                    differ = np.flatnonzero(stored != reference)
+                    first = int(differ[0]) if len(differ) else \
+                        min(len(stored), len(reference))
+                    print("MISMATCH %s: %i uploads differ, the first at " %
+                          (name, len(differ)) +
+                          "upload %i; %i/%i files stored" % (
+                              first, stored.sum(), reference.sum()))
+                sys.stdout.flush()
+
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--modes", action="store", default=list(MODES),
+        type=lambda text: text.split(","),
+        help="A comma separated list of the modes to compare: %s (default: "
+             "all)." % ", ".join(MODES))
+    parser.add_argument(
+        "--uploads", action="store", default=20000, type=int,
+        help="The number of uploads per stream (default: 20000).")
+    parser.add_argument(
+        "--files", action="store", default=4000, type=int,
+        help="The number of distinct files per stream (default: 4000).")
+    parser.add_argument(
+        "--zipf-exponent", action="store", default=1.5, type=float,
+        help="The exponent of the Zipf popularity of the files.")
+    parser.add_argument(
+        "--seeds", action="store", default=[1],
+        type=utils.value_list(int),
+        help="The seeds of the streams and the simulations (default: 1).")
+    parser.add_argument(
+        "--formats", action="store", default=list(STREAM_FORMATS),
+        type=lambda text: text.split(","),
+        help="The stream formats to compare on: raw, interned (default: " +
+             "both).")
+    parser.add_argument(
+        "--offline-rates", action="store", default=[0, 0.3, 0.7],
+        type=utils.value_list(float),
+        help="The offline rates to compare with (default: 0,0.3,0.7).")
+    parser.add_argument(
+        "--short-hash-length", dest="shlen", action="store", default=4,
+        type=int,
+        help="The length of the short hashes; short hashes make long " +
+             "buckets (default: 4).")
+    parser.add_argument(
+        "--check-limit", dest="rlc", action="store", default=10, type=int,
+        help="RL_c; a low limit leaves files without checkers (default: 10).")
+    parser.add_argument(
+        "--pake-runs", dest="rlu", action="store", default=5, type=int,
+        help="RL_u (default: 5).")
+    parser.add_argument(
+        "--max-threshold", action="store", default=20, type=int,
+        help="The maximum threshold (default: 20).")
+    parser.add_argument(
+        "--workers", action="store", default=3, type=int,
+        help="The number of workers of the workers modes (default: 3).")
+    parser.add_argument(
+        "--batch-size", action="store", default=1000, type=int,
+        help="The number of uploads per batch, i.e. between the restores " +
+             "of the restore modes (default: 1000).")
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        if mode not in MODES:
+            parser.error("unknown mode %r" % mode)
+    for fmt in args.formats:
+        if fmt not in STREAM_FORMATS:
+            parser.error("unknown stream format %r" % fmt)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        failures = compare(args, work_dir)
+
+    if failures:
+        print("+++ %i comparisons differ from the oracle" % failures,
+              file=sys.stderr)
+        return 1
+    print("+++ All modes match the oracle", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,367 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""gzip and BGZF compressed upload streams.
+
+BGZF is the blocked gzip format of samtools: a series of independent gzip
+members of at most 64 KiB of data each, followed by an empty member that
+marks the end of the file. The header of every member records its compressed
+size in a "BC" extra field, so the members can be found without decompressing
+them and decompressed in parallel; zlib releases the GIL, so threads suffice.
+A BGZF file is also an ordinary multi-member gzip file that zcat and the gzip
+module read, and the files written by bgzip are read here.
+
+Other gzip files are decompressed sequentially in a background thread, which
+still overlaps the decompression with the simulation.
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import itertools
+import os
+import queue
+import struct
+import threading
+import zlib
+
+# The magic and the compression method (deflate) of a gzip member
+GZIP_PREFIX = b"\x1f\x8b\x08"
+
+# The reserved bits of the flags of a gzip member; always zero
+GZIP_RESERVED_FLAGS = 0xe0
+
+# The number of bytes is_compressed() looks at
+HEAD_SIZE = 4
+
+# The header of a BGZF member: magic, method and flags (FEXTRA), mtime,
+# extra flags, OS, the length of the extra field and the "BC" subfield with
+# the size of the member minus one
+BGZF_HEADER = struct.Struct("<4sIBBH2sHH")
+BGZF_PREFIX = b"\x1f\x8b\x08\x04"
+
+# The CRC-32 and the length of the data of a member
+GZIP_TRAILER = struct.Struct("<II")
+
+# The empty member at the end of a BGZF file
+BGZF_EOF = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# The data of a BGZF member; less than 64 KiB so that even incompressible data
+# fits in a member
+BLOCK_SIZE = 0xff00
+
+# The number of members compressed or decompressed in a single task
+BLOCKS_PER_TASK = 16
+
+# The size of the compressed pieces read at once
+PIECE_SIZE = 1 << 20
+
+# The number of threads by default
+DEFAULT_THREADS = min(4, os.cpu_count() or 1)
+
+COMPRESSIONS = ("none", "gzip", "bgzf")
+
+
+def is_compressed(head):
+    """Returns true if the first HEAD_SIZE bytes of a stream are those of a
+    gzip file: the magic, the deflate method and flags without the reserved
+    bits. A raw stream starts with the size of a file instead, which would
+    have to be about 135 GB with specific low bytes to match.
+    """
+    return len(head) >= HEAD_SIZE and \
+        bytes(head[:3]) == GZIP_PREFIX and \
+        not head[3] & GZIP_RESERVED_FLAGS
+
+
+def _is_bgzf(head):
+    """Returns true if the header of a gzip member is a BGZF header."""
+    return len(head) >= BGZF_HEADER.size and \
+        head[:4] == BGZF_PREFIX and head[10:14] == b"\x06\x00BC"
+
+
+def _pieces(fileobj, prefix):
+    """Yields the prefix and then the contents of fileobj in pieces."""
+    if prefix:
+        yield prefix
+    while True:
+        piece = fileobj.read(PIECE_SIZE)
+        if not piece:
+            return
+        yield piece
+
+
+def _members(pieces):
+    """Splits the compressed pieces of a BGZF file into members.
+
+    Yields:
+        The bytes of each member.
+    """
+
+    buf = bytearray()
+    start = 0
+    for piece in pieces:
+        buf += piece
+        while len(buf) - start >= BGZF_HEADER.size:
+            head = bytes(buf[start:start + BGZF_HEADER.size])
+            if not _is_bgzf(head):
+                raise ValueError("Corrupt BGZF stream: a member without a "
+                                 "BGZF header")
+            end = start + BGZF_HEADER.unpack(head)[-1] + 1
+            if end > len(buf):
+                break
+            yield bytes(buf[start:end])
+            start = end
+
+        # Drop the members already yielded.
+        del buf[:start]
+        start = 0
+
+    if buf:
+        raise ValueError("Truncated BGZF stream: %i trailing bytes" % len(buf))
+
+
+def _inflate(members):
+    """Decompresses and verifies a list of BGZF members."""
+    return b"".join(zlib.decompress(member, 31) for member in members)
+
+
+def _deflate(data, level):
+    """Compresses data into BGZF members of at most BLOCK_SIZE bytes."""
+    members = []
+    for start in range(0, len(data), BLOCK_SIZE):
+        block = data[start:start + BLOCK_SIZE]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        body = compressor.compress(block) + compressor.flush()
+        size = BGZF_HEADER.size + len(body) + GZIP_TRAILER.size
+        members.append(BGZF_HEADER.pack(BGZF_PREFIX, 0, 0, 0xff, 6, b"BC", 2,
+                                        size - 1))
+        members.append(body)
+        members.append(GZIP_TRAILER.pack(zlib.crc32(block),
+                                         len(block) & 0xffffffff))
+    return b"".join(members)
+
+
+class Reader:
+    """A read-only file object of the decompressed data of a gzip or BGZF
+    stream. Only read() and readinto() are supported.
+    """
+
+    def __init__(self, fileobj, threads=None, prefix=b""):
+        """Starts decompressing.
+
+        Args:
+            fileobj - The binary file object of the compressed stream.
+            threads - The number of decompression threads of BGZF streams;
+                DEFAULT_THREADS if None.
+            prefix - The compressed bytes already read from fileobj.
+        """
+
+        self.threads = threads or DEFAULT_THREADS
+        self.executor = None
+        self.thread = None
+        self.closed = False
+
+        # Peek at the header of the first member.
+        pieces = _pieces(fileobj, prefix)
+        head = b""
+        for piece in pieces:
+            head += piece
+            if len(head) >= BGZF_HEADER.size:
+                break
+        pieces = itertools.chain([head], pieces)
+
+        if _is_bgzf(head):
+            self.bgzf = True
+            self._data = self._inflate_members(pieces)
+        else:
+            self.bgzf = False
+            self._data = self._background(self._inflate_stream(pieces))
+
+        # The decompressed bytes not read yet
+        self._buf = b""
+        self._pos = 0
+
+    def _inflate_members(self, pieces):
+        """Yields the data of BGZF members decompressed by a pool of
+        threads in order.
+        """
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        pending = collections.deque()
+        members = []
+        for member in _members(pieces):
+            members.append(member)
+            if len(members) < BLOCKS_PER_TASK:
+                continue
+            pending.append(self.executor.submit(_inflate, members))
+            members = []
+            # Keep every thread busy, with the next tasks queued.
+            if len(pending) > 2 * self.threads:
+                yield pending.popleft().result()
+
+        pending.append(self.executor.submit(_inflate, members))
+        while pending:
+            yield pending.popleft().result()
+
+    @staticmethod
+    def _inflate_stream(pieces):
+        """Yields the data of a gzip stream of one or more members."""
+        decompressor = zlib.decompressobj(31)
+        started = False
+        for piece in pieces:
+            while piece:
+                started = True
+                yield decompressor.decompress(piece)
+                piece = b""
+                if decompressor.eof:
+                    # The next member starts after the end of this one.
+                    piece = decompressor.unused_data
+                    decompressor = zlib.decompressobj(31)
+                    started = False
+        if started:
+            raise ValueError("Truncated gzip stream")
+
+    def _background(self, generator):
+        """Runs a generator in a thread and yields its values."""
+        values = queue.Queue(2 * self.threads)
+
+        def run():
+            try:
+                for value in generator:
+                    if self.closed:
+                        return
+                    values.put(value)
+                values.put(None)
+            except Exception as error:
+                values.put(error)
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        while True:
+            value = values.get()
+            if value is None:
+                return
+            if isinstance(value, Exception):
+                raise value
+            yield value
+
+    def readinto(self, buf):
+        """Reads up to len(buf) bytes into buf; returns the number of bytes
+        read, 0 at the end of the stream.
+        """
+
+        view = memoryview(buf).cast("B")
+        filled = 0
+        while filled < len(view):
+            if self._pos == len(self._buf):
+                self._buf = next(self._data, None)
+                self._pos = 0
+                if self._buf is None:
+                    self._buf = b""
+                    break
+            count = min(len(view) - filled, len(self._buf) - self._pos)
+            view[filled:filled + count] = \
+                self._buf[self._pos:self._pos + count]
+            self._pos += count
+            filled += count
+        view.release()
+        return filled
+
+    def read(self, size):
+        """Reads up to size bytes."""
+        buf = bytearray(size)
+        return bytes(buf[:self.readinto(buf)])
+
+    def close(self):
+        """Stops the decompression."""
+        self.closed = True
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+
+class BgzfWriter:
+    """A write-only file object that compresses the data written into BGZF
+    members in a pool of threads and writes them to another file object in
+    order.
+    """
+
+    def __init__(self, out, threads=None, level=6):
+        """Creates a writer.
+
+        Args:
+            out - The binary file object to write the compressed data to. It
+                is not closed by close().
+            threads - The number of compression threads; DEFAULT_THREADS if
+                None.
+            level - The zlib compression level.
+        """
+
+        self.out = out
+        self.level = level
+        self.threads = threads or DEFAULT_THREADS
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        self.pending = collections.deque()
+        self.buf = bytearray()
+
+    def write(self, data):
+        """Buffers data and compresses the full tasks of members."""
+        self.buf += data
+        task = BLOCK_SIZE * BLOCKS_PER_TASK
+        if len(self.buf) >= task:
+            whole = len(self.buf) - len(self.buf) % task
+            self._submit(bytes(self.buf[:whole]))
+            del self.buf[:whole]
+        return len(data)
+
+    def _submit(self, data):
+        task = BLOCK_SIZE * BLOCKS_PER_TASK
+        for start in range(0, len(data), task):
+            self.pending.append(self.executor.submit(
+                _deflate, data[start:start + task], self.level))
+        while len(self.pending) > 2 * self.threads:
+            self.out.write(self.pending.popleft().result())
+
+    def flush(self):
+        """Flushes the file object underneath. The buffered data is only
+        compressed into whole members, so it stays buffered until close().
+        """
+        self.out.flush()
+
+    def close(self):
+        """Compresses and writes the rest of the data and the end of file
+        marker.
+        """
+
+        if self.buf:
+            self._submit(bytes(self.buf))
+            self.buf = bytearray()
+        while self.pending:
+            self.out.write(self.pending.popleft().result())
+        self.out.write(BGZF_EOF)
+        self.out.flush()
+        self.executor.shutdown()
+
+
+def new_writer(out, compression, threads=None):
+    """Returns a file object that compresses the data written to it into out
+    in the given format; see COMPRESSIONS. Closing it writes the end of the
+    compressed stream but does not close out.
+    """
+
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=out, mode="wb")
+    if compression == "bgzf":
+        return BgzfWriter(out, threads)
+    raise ValueError("Unknown compression %r" % compression)
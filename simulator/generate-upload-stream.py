@@ -16,13 +16,17 @@
 
 import argparse
 import collections
+import compressed
 import fileinput
 import functools
 import hashlib
+import indexed
 import itertools
 import math
 import operator
+import profiling
 import random
+import stream
 import sys
 import tqdm
 import timer
@@ -69,6 +73,7 @@ class UploadStreamGenerator:
         raise NotImplementedError("Implement get_generator()!")
 
     @utils.timeit
+    @profiling.phase("read_input")
     def read_input(self):
         """Reads the input data from source given in arguments.
 
@@ -110,6 +115,7 @@ class UploadStreamGenerator:
         return functools.reduce(lambda count, file: count + file[1], files, 0)
 
     @utils.timeit
+    @profiling.phase("compute_uploads")
     def compute_uploads(self, files):
         """Computes the time ticks each upload happens at.
 
@@ -135,32 +141,58 @@ class UploadStreamGenerator:
         return uploads
 
     @utils.timeit
+    @profiling.phase("output_uploads")
     def output_uploads(self, uploads, total_uploads=None):
         """Outputs the uploads generated by compute_uploads().
 
         Args:
             uploads - The uploads generated by compute_uploads().
             total_uploads - The total number of uploads in the stream. Used for
-                progress reporting (optional)
+                progress reporting (optional) and required by the indexed
+                format.
         """
 
         print("+++ Outputting uploads", file=sys.stderr)
 
         # Sort the uploads in the order sorted by their keys
-        stream = sorted(uploads.items(), key=operator.itemgetter(0))
+        ordered = sorted(uploads.items(), key=operator.itemgetter(0))
 
         # Only take the values which are lists of uploads
-        stream = map(operator.itemgetter(1), stream)
+        ordered = map(operator.itemgetter(1), ordered)
 
         # Shuffle the uploads for each time tick
-        stream = map(utils.shuffle, stream)
+        ordered = map(utils.shuffle, ordered)
 
         # Chain the lists together into a single iterator
-        stream = itertools.chain.from_iterable(stream)
+        ordered = itertools.chain.from_iterable(ordered)
 
         digest = hashlib.sha256()
 
-        for hash, size in tqdm.tqdm(stream, total=total_uploads):
+        out = sys.stdout.buffer
+        if self.args.compression != "none":
+            out = compressed.new_writer(out, self.args.compression)
+
+        # The raw records are written to out directly or in a container
+        records_out = out
+
+        writer = None
+        if self.args.format == "indexed":
+            params = {
+                "generator": "generate-upload-stream.py",
+                "input": self.args.input,
+                "distribution": self.args.distribution,
+                "seed": self.args.seed,
+            }
+            records_out = indexed.IndexedStreamWriter(out, total_uploads,
+                                                      160, params)
+        elif self.args.format == "interned":
+            table = open(self.args.id_table, "wb")
+            writer = stream.IdStreamWriter(out, table,
+                                           self.args.shlen, self.args.hashlen,
+                                           self.args.id_bytes)
+            hashes, sizes = [], []
+
+        for hash, size in tqdm.tqdm(ordered, total=total_uploads):
             # The uploads are packed into 25 bytes: 20 bytes for the hash
             # and 5 bytes for the file size
             upload = hash | size << 160
@@ -168,9 +200,26 @@ class UploadStreamGenerator:
                                       byteorder="big")
 
             digest.update(encoded)
-            sys.stdout.buffer.write(encoded)
-
-        print("+++ Upload stream outputted. SHA-256: %s" % (
+            if writer is None:
+                records_out.write(encoded)
+                continue
+
+            # Intern the uploads in batches.
+            hashes.append(encoded[5:])
+            sizes.append(size)
+            if len(hashes) == stream.DEFAULT_BATCH_SIZE:
+                writer.write(hashes, sizes)
+                hashes, sizes = [], []
+
+        if writer is not None:
+            writer.write(hashes, sizes)
+            table.close()
+        if records_out is not out:
+            records_out.close()
+        if out is not sys.stdout.buffer:
+            out.close()
+
+        print("+++ Upload stream outputted. SHA-256 (raw): %s" % (
             digest.hexdigest()
         ), file=sys.stderr)
 
@@ -222,8 +271,56 @@ def main():
                         default="uniform",
                         help="The type of distribution the popularities " +
                              "follow wrt. to time")
+    parser.add_argument("--seed",
+                        action="store", type=int,
+                        help="The seed of the random upload times and " +
+                             "shuffles. A random seed is used by default.")
+
+    parser.add_argument("--format",
+                        action="store",
+                        choices=["raw", "indexed", "interned"],
+                        default="raw",
+                        help="The format of the output stream. indexed " +
+                             "writes the raw stream in a container with " +
+                             "the number of uploads, the parameters and " +
+                             "block checksums; see indexed.py. interned " +
+                             "writes file IDs; see the interned output " +
+                             "arguments.")
+    parser.add_argument("--compression",
+                        action="store", choices=compressed.COMPRESSIONS,
+                        default="none",
+                        help="Compress the output stream. bgzf writes " +
+                             "gzip compatible blocks that the simulators " +
+                             "decompress in parallel; see compressed.py.")
+
+    interned = parser.add_argument_group(
+        "Interned Output",
+        "These arguments control the output of interned streams; see " +
+        "intern-upload-stream.py.")
+    interned.add_argument("--id-table",
+                          action="store", type=str,
+                          help="The file to write the ID -> hash table to. " +
+                               "Required with --format=interned.")
+    interned.add_argument("--id-bytes",
+                          action="store", default=4, type=int, choices=[4, 8],
+                          help="The width of the file IDs in bytes.")
+    interned.add_argument("--short-hash-length",
+                          dest="shlen", action="store", default=13, type=int,
+                          help="The length of short hash in bits.")
+    interned.add_argument("--hash-length",
+                          dest="hashlen", action="store", default=160,
+                          type=int,
+                          help="The length of the dataset hashes in bits.")
+    profiling.add_arguments(parser)
     args = parser.parse_args()
 
+    if args.format == "interned" and not args.id_table:
+        parser.error("--format=interned requires --id-table")
+    profiling.check_arguments(parser, args)
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
     if args.distribution == "uniform":
         g = UniformStreamGenerator(args)
     elif args.distribution == "normal":
@@ -231,7 +328,7 @@ def main():
     elif args.distribution == "lognormal":
         g = LogNormalStreamGenerator(args)
 
-    g.generate()
+    profiling.run(args, g.generate)
 
 
 if __name__ == "__main__":
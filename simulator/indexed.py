@@ -0,0 +1,293 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Indexed upload request streams.
+
+An indexed stream is a raw stream in a container that describes it:
+    * a HEADER: the magic, the format version, the hash length in bits, the
+      records per block, the number of records and the length of the
+      parameters,
+    * the parameters the stream was generated with as JSON,
+    * the 25 byte records of the raw stream, unchanged,
+    * the block index: an INDEX_DTYPE entry with the offset, the number of
+      records and the CRC-32 of each block of block_records records,
+    * a TRAILER: the offset of the index, the number of blocks, the SHA-256
+      of the records and the end magic.
+All the integers are little-endian. The number of records is known from the
+header, so the uploads can be counted and upload N found without reading the
+stream, and the blocks can be verified independently of each other.
+
+The records are not compressed so that the stream can be memory-mapped; an
+indexed stream can still be compressed as a whole (see compressed.py), but it
+is then read sequentially.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import struct
+import zlib
+
+import numpy as np
+
+import compressed
+
+MAGIC = b"DDPSTR01"
+END_MAGIC = b"DDPEND01"
+VERSION = 1
+
+# magic, version, hash length, records per block, records, parameter bytes
+HEADER = struct.Struct("<8sHHIQI")
+
+# The offset of the index, the number of blocks, the SHA-256 of the records
+# and the end magic
+TRAILER = struct.Struct("<QQ32s8s")
+
+INDEX_DTYPE = np.dtype([("offset", "<u8"), ("records", "<u4"),
+                        ("crc32", "<u4")])
+
+# The number of records per block by default
+BLOCK_RECORDS = 1 << 16
+
+# The size of a record; see stream.BYTES_PER_UPLOAD
+RECORD_SIZE = 25
+
+
+class Header:
+    """The header of an indexed stream.
+
+    Attributes:
+        hashlen - The length of the hashes in bits.
+        block_records - The number of records per block.
+        count - The number of records.
+        params - A dict of the parameters the stream was generated with.
+        data_offset - The offset of the first record.
+    """
+
+    def __init__(self, hashlen, block_records, count, params, data_offset):
+        self.hashlen = hashlen
+        self.block_records = block_records
+        self.count = count
+        self.params = params
+        self.data_offset = data_offset
+
+    @property
+    def data_end(self):
+        """The offset after the last record."""
+        return self.data_offset + self.count * RECORD_SIZE
+
+
+def read_header(read):
+    """Reads the header of an indexed stream.
+
+    Args:
+        read - A function n -> the next n bytes of the stream, starting from
+            the beginning.
+
+    Returns:
+        A Header.
+    """
+
+    head = read(HEADER.size)
+    if len(head) < HEADER.size:
+        raise ValueError("Truncated indexed stream header")
+    magic, version, hashlen, block_records, count, params_length = \
+        HEADER.unpack(head)
+    if magic != MAGIC:
+        raise ValueError("Not an indexed stream")
+    if version != VERSION:
+        raise ValueError("Unsupported indexed stream version %i" % version)
+
+    params = read(params_length)
+    if len(params) < params_length:
+        raise ValueError("Truncated indexed stream header")
+    return Header(hashlen, block_records, count, json.loads(params.decode()),
+                  HEADER.size + params_length)
+
+
+class IndexedStreamWriter:
+    """Writes indexed upload request streams. The number of records must be
+    known in advance; close() writes the index and fails if a different
+    number of records was written.
+    """
+
+    def __init__(self, out, count, hashlen=160, params=None,
+                 block_records=BLOCK_RECORDS):
+        """Writes the header.
+
+        Args:
+            out - A binary file object to write the stream to. It is not
+                closed by close().
+            count - The number of records in the stream.
+            hashlen - The length of the hashes in bits.
+            params - A JSON serializable dict of the parameters the stream
+                was generated with.
+            block_records - The number of records per block.
+        """
+
+        self.out = out
+        self.count = count
+        self.block_records = block_records
+
+        params = json.dumps(params or {}, sort_keys=True).encode()
+        out.write(HEADER.pack(MAGIC, VERSION, hashlen, block_records, count,
+                              len(params)))
+        out.write(params)
+
+        self.offset = HEADER.size + len(params)
+        self.written = 0
+        self.digest = hashlib.sha256()
+        self.index = []
+
+        # The records of the current block
+        self.block = bytearray()
+
+    def write(self, records):
+        """Writes encoded 25 byte records; any number at a time."""
+        self.block += records
+        size = self.block_records * RECORD_SIZE
+        while len(self.block) >= size:
+            self._write_block(bytes(self.block[:size]))
+            del self.block[:size]
+
+    def _write_block(self, data):
+        self.out.write(data)
+        self.digest.update(data)
+        records = len(data) // RECORD_SIZE
+        self.index.append((self.offset, records, zlib.crc32(data)))
+        self.offset += len(data)
+        self.written += records
+
+    def close(self):
+        """Writes the last block, the index and the trailer."""
+        if len(self.block) % RECORD_SIZE:
+            raise ValueError("Partial record at the end of the stream")
+        if self.block:
+            self._write_block(bytes(self.block))
+            self.block = bytearray()
+        if self.written != self.count:
+            raise ValueError("The header announces %i records, %i written" %
+                             (self.count, self.written))
+
+        index = np.array(self.index, INDEX_DTYPE)
+        self.out.write(index.tobytes())
+        self.out.write(TRAILER.pack(self.offset, len(index),
+                                    self.digest.digest(), END_MAGIC))
+        self.out.flush()
+
+
+class IndexedStream:
+    """An indexed stream file opened for inspection and verification; see
+    stream.UploadStream for reading the uploads.
+
+    Attributes:
+        header - The Header of the stream.
+        index - The block index; an array of INDEX_DTYPE.
+        sha256 - The SHA-256 of the records (bytes).
+    """
+
+    def __init__(self, path):
+        self._fp = None
+        self._mm = None
+        try:
+            self._open(path)
+        except Exception:
+            self.close()
+            raise
+
+    def _open(self, path):
+        self._fp = open(path, "rb")
+        if compressed.is_compressed(self._fp.peek(compressed.HEAD_SIZE)):
+            raise ValueError("Compressed indexed streams can only be read "
+                             "sequentially")
+        mm = self._mm = mmap.mmap(self._fp.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        position = 0
+
+        def read(count):
+            nonlocal position
+            position += count
+            return mm[position - count:position]
+
+        self.header = read_header(read)
+        if len(mm) < self.header.data_end + TRAILER.size:
+            raise ValueError("Truncated indexed stream")
+
+        index_offset, blocks, self.sha256, end_magic = \
+            TRAILER.unpack(mm[len(mm) - TRAILER.size:])
+        index_end = index_offset + blocks * INDEX_DTYPE.itemsize
+        if end_magic != END_MAGIC or index_offset != self.header.data_end \
+                or index_end != len(mm) - TRAILER.size:
+            raise ValueError("Corrupt indexed stream trailer")
+        self.index = np.frombuffer(mm[index_offset:index_end], INDEX_DTYPE)
+
+        if int(self.index["records"].sum()) != self.header.count:
+            raise ValueError("The index does not cover the %i records" %
+                             self.header.count)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Closes the stream file."""
+        if self._mm is not None:
+            self._mm.close()
+        if self._fp is not None:
+            self._fp.close()
+
+    def offset_of(self, upload):
+        """Returns the offset of the record of the upload with the given
+        index in the file.
+        """
+        if not 0 <= upload < self.header.count:
+            raise IndexError("Upload %i out of range" % upload)
+        return self.header.data_offset + upload * RECORD_SIZE
+
+    def _check_block(self, block):
+        entry = self.index[block]
+        start = int(entry["offset"])
+        end = start + int(entry["records"]) * RECORD_SIZE
+        view = memoryview(self._mm)[start:end]
+        try:
+            return zlib.crc32(view) == int(entry["crc32"])
+        finally:
+            view.release()
+
+    def verify(self, threads=None):
+        """Verifies the CRC-32 of every block in a pool of threads; zlib
+        releases the GIL while it computes them.
+
+        Returns:
+            A list of the numbers of the corrupt blocks.
+        """
+
+        with concurrent.futures.ThreadPoolExecutor(
+                threads or compressed.DEFAULT_THREADS) as executor:
+            valid = executor.map(self._check_block, range(len(self.index)))
+            return [block for block, ok in enumerate(valid) if not ok]
+
+    def verify_sha256(self):
+        """Returns true if the SHA-256 of the records matches the trailer.
+        This reads the whole stream in a single thread.
+        """
+        view = memoryview(self._mm)[self.header.data_offset:
+                                    self.header.data_end]
+        try:
+            return hashlib.sha256(view).digest() == self.sha256
+        finally:
+            view.release()
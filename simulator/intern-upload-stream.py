@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+#
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import stream
+import sys
+import tqdm
+import utils
+
+DESC = ("Converts a raw upload request stream into an interned stream where "
+        "each upload is a (file ID, short hash, size) record. The file IDs "
+        "are dense integers and the ID table maps them back to the original "
+        "hashes: the 20 byte hash of file ID i is at the offset 20 * i.")
+
+
+@utils.timeit
+def intern_stream(args):
+    with stream.UploadStream(args.input) as uploads, \
+            open(args.id_table, "wb") as table:
+        if uploads.interned:
+            raise ValueError("The input stream is already interned")
+
+        writer = stream.IdStreamWriter(sys.stdout.buffer, table, args.shlen,
+                                       args.hashlen, args.id_bytes)
+
+        # Indexed streams know their length.
+        total = None
+        if uploads.count is not None:
+            total = -(-uploads.count // uploads.batch_size)
+        for batch in tqdm.tqdm(uploads.batches(), desc="Batches",
+                               total=total):
+            writer.write_batch(batch)
+
+    print("+++ Stream interned: files=%i" % len(writer.ids), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=DESC)
+    parser.add_argument("input",
+                        action="store", default="-", type=str, nargs="?",
+                        help="The raw upload request stream to intern. " +
+                             "Defaults to stdin '-'")
+    parser.add_argument("--id-table",
+                        action="store", required=True, type=str,
+                        help="The file to write the ID -> hash table to.")
+    parser.add_argument("--id-bytes",
+                        action="store", default=4, type=int, choices=[4, 8],
+                        help="The width of the file IDs in bytes.")
+    parser.add_argument("--short-hash-length",
+                        dest="shlen", action="store", default=13, type=int,
+                        help="The length of short hash in bits (at most 32).")
+    parser.add_argument("--hash-length",
+                        dest="hashlen", action="store", default=160, type=int,
+                        help="The length of the dataset hashes in bits.")
+
+    intern_stream(parser.parse_args())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Instrumentation counters of the protocol simulation.
+
+The counters are only collected if the simulator is run with --metrics. A
+snapshot of the counters of a simulation is a dict with the COUNTERS and two
+histograms with log2 classes; class k counts the values v with
+v.bit_length() == k, i.e. 0, 1, 2-3, 4-7, ...:
+    * scanned_per_upload - the number of files scanned per upload,
+    * bucket_lengths - the number of files in each bucket.
+"""
+
+import json
+import os
+import time
+
+COUNTERS = (
+    # The number of uploads
+    "uploads",
+    # The files looked at when searching for candidates
+    "scanned",
+    # The files considered for deduplication (checked by a checker)
+    "considered",
+    # The files without checkers skipped
+    "dead_skipped",
+    # The files skipped since all their checkers were offline
+    "offline_skipped",
+    # The uploads that matched a file in the bucket
+    "matches",
+    # The matched files moved towards the front of the bucket and the sum
+    # of the positions they were moved by
+    "reorders",
+    "reorder_distance",
+    # The number of buckets and the files in them
+    "buckets",
+    "files",
+)
+
+HISTOGRAMS = ("scanned_per_upload", "bucket_lengths")
+
+# The number of log2 classes in the histograms
+HISTOGRAM_CLASSES = 65
+
+FORMATS = ("jsonl", "prometheus")
+
+
+class Metrics:
+    """The counters of a single simulation."""
+
+    def __init__(self):
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.scanned_per_upload = [0] * HISTOGRAM_CLASSES
+
+    def record_upload(self, scanned, considered, dead, matched, distance):
+        """Records the counters of a single upload.
+
+        Args:
+            scanned - The number of files scanned.
+            considered - The number of files considered.
+            dead - The number of files without checkers skipped.
+            matched - True if the upload matched a file.
+            distance - The number of positions the matched file was moved.
+        """
+
+        counts = self.counts
+        counts["uploads"] += 1
+        counts["scanned"] += scanned
+        counts["considered"] += considered
+        counts["dead_skipped"] += dead
+        counts["offline_skipped"] += scanned - considered - dead
+        if matched:
+            counts["matches"] += 1
+        if distance:
+            counts["reorders"] += 1
+            counts["reorder_distance"] += distance
+        self.scanned_per_upload[scanned.bit_length()] += 1
+
+    def get_state(self):
+        """Returns the counters as a JSON serializable dict."""
+        return {"counts": dict(self.counts),
+                "scanned_per_upload": list(self.scanned_per_upload)}
+
+    def set_state(self, state):
+        """Restores the counters returned by get_state()."""
+        self.counts.update(state["counts"])
+        self.scanned_per_upload = list(state["scanned_per_upload"])
+
+    def snapshot(self, bucket_lengths):
+        """Returns a snapshot of the counters.
+
+        Args:
+            bucket_lengths - An iterable of the number of files in each
+                bucket.
+        """
+
+        lengths = [0] * HISTOGRAM_CLASSES
+        buckets = files = 0
+        for length in bucket_lengths:
+            lengths[length.bit_length()] += 1
+            buckets += 1
+            files += length
+
+        return dict(self.counts, buckets=buckets, files=files,
+                    scanned_per_upload=list(self.scanned_per_upload),
+                    bucket_lengths=lengths)
+
+
+def merge(snapshots):
+    """Sums the snapshots of the shards of a simulation."""
+    merged = dict.fromkeys(COUNTERS, 0)
+    for name in HISTOGRAMS:
+        merged[name] = [0] * HISTOGRAM_CLASSES
+
+    for snapshot in snapshots:
+        for name in COUNTERS:
+            merged[name] += snapshot[name]
+        for name in HISTOGRAMS:
+            merged[name] = [a + b for a, b in zip(merged[name],
+                                                  snapshot[name])]
+    return merged
+
+
+def _trim(histogram):
+    """Drops the empty classes from the end of a histogram."""
+    end = len(histogram)
+    while end and not histogram[end - 1]:
+        end -= 1
+    return histogram[:end]
+
+
+def _labels(params):
+    labels = {
+        "rlc": params.rlc,
+        "rlu": params.rlu,
+        "max_threshold": params.max_threshold,
+        "offline_rate": params.offline_rate,
+    }
+    if params.replicates > 1:
+        labels["replicate"] = params.replicate
+    return labels
+
+
+class Exporter:
+    """Writes snapshots of the counters to a file. A JSON line is written
+    for each simulation on every export; a Prometheus text file is replaced
+    on every export.
+    """
+
+    def __init__(self, path, fmt="jsonl"):
+        self.path = path
+        self.fmt = fmt
+        if fmt == "jsonl":
+            self.out = open(path, "w")
+
+    def export(self, configs, snapshots, final=False):
+        """Exports the snapshots of the simulations.
+
+        Args:
+            configs - The parameters of the simulations.
+            snapshots - The snapshots of the simulations.
+            final - True if this is the last export of the run.
+        """
+
+        now = time.time()
+        if self.fmt == "jsonl":
+            for params, snapshot in zip(configs, snapshots):
+                line = dict(snapshot, time=now, final=final,
+                            params=_labels(params))
+                for name in HISTOGRAMS:
+                    line[name] = _trim(line[name])
+                self.out.write(json.dumps(line, sort_keys=True) + "\n")
+            self.out.flush()
+            return
+
+        lines = []
+        for name in COUNTERS:
+            if name in ("buckets", "files"):
+                metric, kind = "dedup_simulator_" + name, "gauge"
+            else:
+                metric, kind = "dedup_simulator_%s_total" % name, "counter"
+
+            lines.append("# TYPE %s %s" % (metric, kind))
+            for params, snapshot in zip(configs, snapshots):
+                lines.append("%s{%s} %i" % (
+                    metric, _format_labels(_labels(params)), snapshot[name]))
+
+        sums = {"scanned_per_upload": ("scanned", "uploads"),
+                "bucket_lengths": ("files", "buckets")}
+        for name in HISTOGRAMS:
+            lines.append("# TYPE dedup_simulator_%s histogram" % name)
+            for params, snapshot in zip(configs, snapshots):
+                labels = _labels(params)
+                total = 0
+                for k, count in enumerate(_trim(snapshot[name])):
+                    total += count
+                    # Class k has the values up to 2 ** k - 1.
+                    lines.append("dedup_simulator_%s_bucket{%s} %i" % (
+                        name, _format_labels(dict(labels, le=(1 << k) - 1)),
+                        total))
+                lines.append("dedup_simulator_%s_bucket{%s} %i" % (
+                    name, _format_labels(dict(labels, le="+Inf")), total))
+                total_sum, count = sums[name]
+                lines.append("dedup_simulator_%s_sum{%s} %i" % (
+                    name, _format_labels(labels), snapshot[total_sum]))
+                lines.append("dedup_simulator_%s_count{%s} %i" % (
+                    name, _format_labels(labels), snapshot[count]))
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as out:
+            out.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.path)
+
+    def close(self):
+        if self.fmt == "jsonl":
+            self.out.close()
+
+
+def _format_labels(labels):
+    return ",".join('%s="%s"' % item for item in sorted(labels.items()))
+
+
+def add_arguments(parser):
+    """Adds the metrics options to an argparse parser."""
+    group = parser.add_argument_group(
+        "Metrics",
+        "Counters of the internals of the simulation, e.g. the number of "
+        "files scanned per upload and the lengths of the buckets. They are "
+        "exported with the statistics on stderr.")
+    group.add_argument(
+        "--metrics", action="store", type=str, metavar="FILE",
+        help="Collect the counters and export them to FILE.")
+    group.add_argument(
+        "--metrics-format", action="store", default="jsonl", choices=FORMATS,
+        help="The format of the metrics: JSON lines written on every " +
+             "export or a Prometheus text file replaced on every export " +
+             "(default: jsonl).")
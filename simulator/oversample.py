@@ -3,6 +3,7 @@
 import argparse
 import fileinput
 import numpy as np
+import profiling
 import random
 import smote
 import sys
@@ -25,6 +26,7 @@ The hashes are SHA1 and they are drawn from an uniform distribution.
 
 
 @utils.timeit
+@profiling.phase("read_input")
 def read_input():
     """Read the input data from stdin.
 
@@ -56,6 +58,7 @@ def read_input():
 
 
 @utils.timeit
+@profiling.phase("output")
 def output_new_files(hashes, new_samples, args):
     """Prints new files from the SMOTEd samples.
 
@@ -91,7 +94,9 @@ def oversample(args):
     np_samples = np.array(samples, np.int32)
 
     print("+++ Performing SMOTE", file=sys.stderr)
-    new_samples = smote.SMOTE(np_samples, args.smote_amount, args.neighbors)
+    with profiling.phase("smote"):
+        new_samples = smote.SMOTE(np_samples, args.smote_amount,
+                                  args.neighbors)
 
     print("+++ Outputting new files", file=sys.stderr)
     output_new_files(hashes, new_samples, args)
@@ -117,7 +122,11 @@ def main():
               "E.g. 160 for SHA1 or 256 for SHA256")
     )
 
-    oversample(parser.parse_args())
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+    profiling.check_arguments(parser, args)
+    profiling.run(args, oversample, args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,140 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Perfect deduplication: every file is stored once, on its first upload.
+
+PerfectSimulator has the same interface as simulator.DedupSimulator, so the
+two can be fed the same batches. The batches are simulated with NumPy: the
+first occurrences of the files are found with the exact sets of seenset.py
+and the counters are updated with sums over the stored flags.
+"""
+
+import numpy as np
+
+import results
+import seenset
+import stream
+
+
+class PerfectSimulator:
+    """A simulation of perfect deduplication for use as a library.
+
+    Example:
+        sim = perfect.PerfectSimulator()
+        sim.feed(hashes, sizes)
+        print(sim.snapshot())
+    """
+
+    def __init__(self, observers=(), seen_set="runs"):
+        """Creates a simulation.
+
+        Args:
+            observers - Functions called after each batch; see
+                simulator.DedupSimulator.
+            seen_set - The set of the hashes seen; a key of
+                seenset.HASH_SETS.
+        """
+
+        self.observers = list(observers)
+        self.hash_set = seenset.HASH_SETS[seen_set]
+
+        # The files already in the storage; a seenset.IdSet for file IDs or
+        # a hash set for hashes, created on the first batch
+        self.seen = None
+
+        self.files_in_storage = 0
+        self.files_uploaded = 0
+        self.data_in_storage = 0
+        self.data_uploaded = 0
+
+    def feed(self, keys, sizes, short_hashes=None):
+        """Simulates a batch of uploads.
+
+        Args:
+            keys - The files of the uploads; 20 byte hashes (bytes) or the
+                file IDs (ints) of an interned stream. NumPy arrays of V20
+                hashes or integer IDs work too.
+            sizes - The sizes of the uploaded files.
+            short_hashes - Ignored; for compatibility with DedupSimulator.
+
+        Returns:
+            A NumPy array of flags; true for each upload that was stored.
+        """
+
+        if not isinstance(keys, np.ndarray):
+            keys = list(keys)
+            if keys and isinstance(keys[0], bytes):
+                keys = np.frombuffer(b"".join(keys), "V20")
+            else:
+                keys = np.array(keys, np.int64)
+
+        if not len(keys):
+            stored = np.zeros(0, np.bool_)
+        elif keys.dtype.kind == "V":
+            stored = self._seen(self.hash_set).insert(
+                *seenset.split_hashes(keys))
+        else:
+            stored = self._seen(seenset.IdSet).insert(keys)
+        return self._record(stored, sizes)
+
+    def feed_batch(self, batch):
+        """Simulates a batch of decoded uploads of an UploadStream."""
+        if "id" in batch.dtype.names:
+            return self.feed(batch["id"], batch["size"])
+
+        # The hashes of raw streams are already split into words.
+        stored = self._seen(self.hash_set).insert(
+            batch["hash_hi"], batch["hash_lo"], batch["hash_tail"])
+        return self._record(stored, batch["size"])
+
+    def _seen(self, kind):
+        """Returns the set of the files seen, creating it on first use."""
+        if self.seen is None:
+            self.seen = kind()
+        return self.seen
+
+    def _record(self, stored, sizes):
+        """Updates the counters and notifies the observers."""
+        sizes = np.asarray(sizes, np.int64)
+        start = self.snapshot()
+
+        self.files_in_storage += int(np.count_nonzero(stored))
+        self.data_in_storage += int(sizes[stored].sum())
+        self.files_uploaded += len(sizes)
+        self.data_uploaded += int(sizes.sum())
+
+        for observer in self.observers:
+            observer(start, stored, sizes)
+        return stored
+
+    def feed_stream(self, source, batch_size=stream.DEFAULT_BATCH_SIZE):
+        """Simulates the uploads of a stream file; see stream.UploadStream.
+
+        Returns:
+            The counters after the stream.
+        """
+
+        with stream.UploadStream(source, batch_size) as upload_stream:
+            for batch in upload_stream.batches():
+                self.feed_batch(batch)
+        return self.snapshot()
+
+    def seen_bytes(self):
+        """Returns the memory used by the set of the files seen in bytes."""
+        return self.seen.nbytes if self.seen is not None else 0
+
+    def snapshot(self):
+        """Returns the counters of the simulation as a results.Snapshot."""
+        return results.Snapshot(self.files_in_storage, self.files_uploaded,
+                                self.data_in_storage, self.data_uploaded)
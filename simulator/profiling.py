@@ -0,0 +1,218 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Profiling and per-phase timings of the pipeline tools.
+
+The tools mark their phases (e.g. decode, simulate and output) with phase().
+The time of a phase excludes the time of the phases nested in it, so the
+phases add up to at most the wall time of the run. With --timings FILE the
+phase times are written as a JSON document:
+    {"tool": ..., "argv": [...], "python": ..., "started": <unix time>,
+     "wall": <seconds>, "max_rss": <bytes>,
+     "phases": {"<name>": {"seconds": ..., "calls": ...}, ...}}
+
+--profile cprofile writes a pstats file of the run; --profile sampling
+samples the stack of the main thread every SAMPLE_INTERVAL seconds of CPU time
+and writes the samples in the collapsed stack format of flamegraph.pl
+("a;b;c count" lines). Only the main process is profiled; the --workers of the
+simulator are not.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import platform
+import signal
+import sys
+import time
+
+import timer
+import utils
+
+PROFILERS = ("cprofile", "sampling")
+
+# The file extensions of the profiles
+PROFILE_SUFFIXES = {"cprofile": ".pstats", "sampling": ".collapsed"}
+
+# The seconds between the samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+
+# A dict name -> [seconds, calls] of the phases in the order they started
+_phases = collections.OrderedDict()
+
+# The [start, nested seconds] of the phases being timed
+_stack = []
+
+
+class phase(contextlib.ContextDecorator):
+    """Times a phase of a tool; a context manager and a function decorator.
+
+    Args:
+        name - The name of the phase in the timings.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        _stack.append([timer.timestamp(), 0.0])
+        return self
+
+    def __exit__(self, *exc):
+        start, nested = _stack.pop()
+        elapsed = timer.timestamp() - start
+        if _stack:
+            _stack[-1][1] += elapsed
+
+        totals = _phases.setdefault(self.name, [0.0, 0])
+        totals[0] += elapsed - nested
+        totals[1] += 1
+        return False
+
+
+def timed(name, iterable):
+    """Yields the items of iterable, timing the production of each item as
+    the phase name.
+    """
+
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def timings():
+    """Returns a dict name -> {"seconds": ..., "calls": ...} of the phases
+    timed so far.
+    """
+    return collections.OrderedDict(
+        (name, {"seconds": seconds, "calls": calls})
+        for name, (seconds, calls) in _phases.items())
+
+
+class SamplingProfiler:
+    """Samples the stack of the main thread on a SIGPROF timer.
+
+    A thread sampling with sys._current_frames() would only run when the
+    main thread releases the GIL, which skews the samples towards the NumPy
+    calls that release it; the signal handler runs between the bytecodes of
+    the main thread instead.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = collections.Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%i)" % (
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno))
+            frame = frame.f_back
+        if stack:
+            self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def dump(self, path):
+        """Writes the samples in the collapsed stack format."""
+        with open(path, "w") as out:
+            for stack, count in sorted(self.samples.items()):
+                out.write("%s %i\n" % (stack, count))
+
+
+def run(args, func, *func_args):
+    """Runs func(*func_args) under the profiler selected by args and writes
+    the timings if asked to; see add_arguments().
+
+    Returns:
+        The return value of func.
+    """
+
+    tool = os.path.basename(sys.argv[0])
+    out = args.profile_out
+    if args.profile and out is None:
+        out = os.path.splitext(tool)[0] + PROFILE_SUFFIXES[args.profile]
+
+    started = time.time()
+    wall = timer.Timer()
+    try:
+        if args.profile == "cprofile":
+            return utils.profileit(func, out)(*func_args)
+
+        if args.profile == "sampling":
+            profiler = SamplingProfiler()
+            profiler.start()
+            try:
+                return func(*func_args)
+            finally:
+                profiler.stop()
+                profiler.dump(out)
+                print("+++ Profile written to %s" % out, file=sys.stderr)
+
+        return func(*func_args)
+    finally:
+        if args.timings:
+            write_timings(args.timings, tool, started, wall.elapsed)
+
+
+def write_timings(path, tool, started, wall):
+    """Writes the phase timings of the run as JSON; see the module doc."""
+    document = collections.OrderedDict([
+        ("tool", tool),
+        ("argv", sys.argv[1:]),
+        ("python", platform.python_version()),
+        ("started", started),
+        ("wall", wall),
+        ("max_rss", utils.get_memory_usage() * 1024),
+        ("phases", timings()),
+    ])
+    with open(path, "w") as out:
+        json.dump(document, out, indent=2)
+        out.write("\n")
+
+
+def add_arguments(parser):
+    """Adds the profiling options to an argparse parser."""
+    group = parser.add_argument_group("Profiling")
+    group.add_argument(
+        "--profile", action="store", choices=PROFILERS,
+        help="Profile the run with cProfile or a sampling profiler.")
+    group.add_argument(
+        "--profile-out", action="store", type=str, metavar="FILE",
+        help="The file to write the profile to; a pstats file for " +
+             "cprofile and collapsed stacks for sampling. Defaults to the " +
+             "name of the tool with a .pstats or .collapsed suffix.")
+    group.add_argument(
+        "--timings", action="store", type=str, metavar="FILE",
+        help="Write the time spent in each phase of the run to FILE as JSON.")
+
+
+def check_arguments(parser, args):
+    """Validates the profiling options parsed by parser."""
+    if args.profile_out and not args.profile:
+        parser.error("--profile-out requires --profile")
@@ -0,0 +1,135 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Replicates of the simulations with independent seeds.
+
+With --replicates N every parameter set is simulated N times side by side
+over the same decoded stream, replicate i with the seed
+rng.derive_seed(seed, i). The --only-final line of a parameter set then has
+the mean DDPs of the replicates followed by
+    <replicates>,<stddev_files>,<stddev_bytes>,
+    <ci_low_files>,<ci_high_files>,<ci_low_bytes>,<ci_high_bytes>
+where the confidence intervals of the means are Student's t intervals at the
+level given by --confidence.
+"""
+
+import math
+
+
+def t_quantile(p, df):
+    """Returns the p-quantile of Student's t distribution with df degrees of
+    freedom.
+    """
+
+    if p < 0.5:
+        return -t_quantile(1 - p, df)
+
+    # Bisect the distribution function; P(T > t) = I_x(df / 2, 1 / 2) / 2
+    # with x = df / (df + t^2).
+    low, high = 0.0, 1.0
+    while _beta_inc(df / (df + high * high), df / 2, 0.5) / 2 > 1 - p:
+        high *= 2
+    for _ in range(100):
+        mid = (low + high) / 2
+        if _beta_inc(df / (df + mid * mid), df / 2, 0.5) / 2 > 1 - p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def _beta_inc(x, a, b):
+    """The regularized incomplete beta function I_x(a, b)."""
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    if x > (a + 1) / (a + b + 2):
+        return 1 - _beta_inc(1 - x, b, a)
+
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) +
+                     a * math.log(x) + b * math.log1p(-x)) / a
+
+    # Lentz's algorithm for the continued fraction
+    tiny = 1e-300
+    c, d = 1.0, 1 - (a + b) * x / (a + 1)
+    d = 1 / (d if abs(d) > tiny else tiny)
+    result = d
+    for m in range(1, 300):
+        for numerator in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                          -(a + m) * (a + b + m) * x /
+                          ((a + 2 * m) * (a + 2 * m + 1))):
+            d = 1 + numerator * d
+            d = 1 / (d if abs(d) > tiny else tiny)
+            c = 1 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            result *= c * d
+        if abs(c * d - 1) < 1e-15:
+            break
+    return front * result
+
+
+def summarize(values, confidence):
+    """Returns the mean, the sample standard deviation and the confidence
+    interval of the mean of the values as a (mean, stddev, low, high) tuple.
+    """
+
+    count = len(values)
+    mean = sum(values) / count
+    if count < 2:
+        return mean, 0.0, mean, mean
+
+    stddev = math.sqrt(sum((v - mean) ** 2 for v in values) / (count - 1))
+    half = t_quantile((1 + confidence) / 2, count - 1) * stddev / \
+        math.sqrt(count)
+    return mean, stddev, mean - half, mean + half
+
+
+def final_result(simulations, confidence):
+    """Returns the --only-final line of the replicates of a parameter set;
+    see the module doc.
+    """
+
+    args = simulations[0].params
+    files = summarize([1 - sim.files_in_storage / sim.files_uploaded
+                       for sim in simulations], confidence)
+    data = summarize([1 - sim.data_in_storage / sim.data_uploaded
+                      for sim in simulations], confidence)
+    return ",".join(str(value) for value in (
+        args.rlc, args.rlu, args.max_threshold, args.offline_rate,
+        files[0], data[0], len(simulations), files[1], data[1],
+        files[2], files[3], data[2], data[3]))
+
+
+def add_arguments(parser):
+    """Adds the replicate options to an argparse parser."""
+    group = parser.add_argument_group("Replicates")
+    group.add_argument(
+        "--replicates", action="store", default=1, type=int, metavar="N",
+        help="Simulate every parameter set N times with independent seeds " +
+             "in the same pass and print the mean, the standard deviation " +
+             "and a confidence interval of the DDPs; requires --only-final.")
+    group.add_argument(
+        "--confidence", action="store", default=0.95, type=float,
+        help="The confidence level of the intervals (default: 0.95).")
+
+
+def check_arguments(parser, args):
+    """Validates the replicate options parsed by parser."""
+    if args.replicates < 1:
+        parser.error("--replicates must be positive")
+    if not 0 < args.confidence < 1:
+        parser.error("--confidence must be between 0 and 1")
+    if args.replicates > 1 and not args.only_final:
+        parser.error("--replicates requires --only-final")
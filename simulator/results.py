@@ -0,0 +1,384 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Writers and readers for the evolution output of the simulators.
+
+The rows of counters (see sampling.evolution()) can be written as
+    * csv - a "%i,%i,%i,%i" line per row (the default),
+    * npy - a NumPy .npy file of a structured array with a field per counter,
+    * binary - a columnar format with the run parameters in the header.
+
+The binary format starts with a header:
+    magic    8 bytes, b"DDPEVO01"
+    flags    <u4; bit 0 is set if the columns are delta encoded
+    length   <u4; the length of the parameters
+    params   the run parameters as UTF-8 JSON
+followed by blocks of rows:
+    count    <u8; the number of rows in the block
+    columns  a column of count <i8 values for each column in the order of the
+             "columns" of the parameters (COLUMNS if missing)
+
+If the columns are delta encoded, each value is the difference to the value of
+the previous row (the first row of the stream is relative to 0).
+
+With --with-perfect-baseline the rows have the BASELINE_COLUMNS of a perfect
+deduplication of the same uploads after the COLUMNS of the simulation.
+"""
+
+import collections
+import json
+import os
+import stat
+import struct
+import sys
+
+import numpy as np
+
+import profiling
+import sampling
+
+COLUMNS = ("files_in_storage", "files_uploaded", "data_in_storage",
+           "data_uploaded")
+
+# The columns of the perfect deduplication baseline
+BASELINE_COLUMNS = ("perfect_files_in_storage", "perfect_data_in_storage")
+
+
+def row_dtype(columns):
+    """Returns the dtype of the rows of the npy format."""
+    return np.dtype([(name, "<i8") for name in columns])
+
+
+ROW_DTYPE = row_dtype(COLUMNS)
+
+# The counters of a simulation at some point of the stream
+Snapshot = collections.namedtuple("Snapshot", COLUMNS)
+
+FORMATS = ("csv", "npy", "binary")
+
+BINARY_MAGIC = b"DDPEVO01"
+BINARY_HEADER = struct.Struct("<8sII")
+BLOCK_HEADER = struct.Struct("<Q")
+
+FLAG_DELTA = 1
+
+# The number of rows buffered before a block is written
+BLOCK_ROWS = 1 << 16
+
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+
+
+def _tell(out):
+    """Returns the position of a file object or None if it cannot seek."""
+    return out.tell() if out.seekable() else None
+
+
+class CsvWriter:
+    """Prints the rows as CSV lines to the standard output."""
+
+    def write(self, rows):
+        sampling.print_rows(rows)
+
+    def close(self):
+        sys.stdout.flush()
+
+    def get_state(self):
+        """Returns the state needed to continue the output; see
+        new_writer().
+        """
+        return {}
+
+    def tell(self):
+        """Flushes the output and returns its position or None."""
+        sys.stdout.flush()
+        return _tell(sys.stdout.buffer)
+
+
+class _BlockWriter:
+    """A base class for the writers that buffer rows into blocks."""
+
+    def __init__(self, out):
+        self.out = out
+        self.pending = []
+        self.pending_rows = 0
+
+    def write(self, rows):
+        if not len(rows):
+            return
+
+        self.pending.append(rows)
+        self.pending_rows += len(rows)
+        if self.pending_rows >= BLOCK_ROWS:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered rows as a block."""
+        if not self.pending_rows:
+            return
+
+        rows = np.concatenate(self.pending)
+        self.pending = []
+        self.pending_rows = 0
+        self.write_block(rows)
+
+    def close(self):
+        self.flush()
+        self.out.flush()
+
+    def tell(self):
+        self.flush()
+        self.out.flush()
+        return _tell(self.out)
+
+
+class BinaryWriter(_BlockWriter):
+    """Writes the rows in the columnar binary format."""
+
+    def __init__(self, out, params, delta=False, state=None,
+                 columns=COLUMNS):
+        super().__init__(out)
+        self.delta = delta
+
+        # The last row written; the base of the deltas of the next block
+        self.previous = np.zeros(len(columns), np.int64)
+
+        if state is not None:
+            # Continue an existing output; the header is already there.
+            self.previous[:] = state["previous"]
+            return
+
+        if tuple(columns) != COLUMNS:
+            params = dict(params, columns=list(columns))
+        header = json.dumps(params, sort_keys=True, default=str).encode()
+        flags = FLAG_DELTA if delta else 0
+        out.write(BINARY_HEADER.pack(BINARY_MAGIC, flags, len(header)))
+        out.write(header)
+
+    def get_state(self):
+        return {"previous": self.previous.tolist()}
+
+    def write_block(self, rows):
+        columns = rows.T.astype("<i8")
+        if self.delta:
+            last = columns[:, -1].copy()
+            columns = np.diff(columns, axis=1, prepend=self.previous[:, None])
+            self.previous = last
+
+        self.out.write(BLOCK_HEADER.pack(len(rows)))
+        self.out.write(np.ascontiguousarray(columns).tobytes())
+
+
+def _npy_header(count, dtype=ROW_DTYPE):
+    """Returns the header of a version 1.0 .npy file of count rows. The
+    length of the header does not depend on the count.
+    """
+
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%20i,), }" % (
+        np.lib.format.dtype_to_descr(dtype), count)
+    header += " " * (-(len(NPY_MAGIC) + 2 + len(header) + 1) % 64) + "\n"
+    return NPY_MAGIC + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+class NpyWriter(_BlockWriter):
+    """Writes the rows as a .npy file of row_dtype() records. The row count
+    is patched into the header at the end; if the output cannot seek, the
+    rows are kept in memory until then.
+    """
+
+    def __init__(self, out, columns=COLUMNS):
+        super().__init__(out)
+        self.dtype = row_dtype(columns)
+        self.seekable = out.seekable()
+        self.count = 0
+        if self.seekable:
+            self.start = out.tell()
+            out.write(_npy_header(0, self.dtype))
+
+    def write_block(self, rows):
+        self.count += len(rows)
+        self.out.write(rows.astype("<i8").tobytes())
+
+    def flush(self):
+        if self.seekable:
+            super().flush()
+
+    def close(self):
+        if self.seekable:
+            super().flush()
+            end = self.out.tell()
+            self.out.seek(self.start)
+            self.out.write(_npy_header(self.count, self.dtype))
+            self.out.seek(end)
+        else:
+            width = len(self.dtype.names)
+            rows = np.concatenate(self.pending +
+                                  [np.empty((0, width), np.int64)])
+            self.out.write(_npy_header(len(rows), self.dtype))
+            self.out.write(rows.astype("<i8").tobytes())
+        self.out.flush()
+
+
+class EvolutionOutput:
+    """An observer of a simulation that writes the evolution of its counters
+    through a sampler (optional) and a writer.
+
+    The simulators call it with the counters before each batch (a Snapshot),
+    the stored flags and the sizes of the uploads of the batch.
+    """
+
+    def __init__(self, writer, sampler=None, baseline=None, scale=1):
+        """Creates an output.
+
+        Args:
+            writer - The writer of the rows; see new_writer().
+            sampler - The sampler of the rows or None; see
+                sampling.new_sampler().
+            baseline - A LastRows observer of a perfect deduplication that
+                is fed each batch before the simulation; its
+                BASELINE_COLUMNS are appended to the rows.
+            scale - The factor the counters are multiplied by, e.g. to
+                estimate the whole stream from a sample of the buckets; the
+                values are rounded to integers.
+        """
+
+        self.writer = writer
+        self.sampler = sampler
+        self.baseline = baseline
+        self.scale = scale
+
+    @profiling.phase("output")
+    def __call__(self, start, stored, sizes):
+        rows = sampling.evolution(start, stored, sizes)
+        if self.baseline is not None:
+            # The files and data in storage of the baseline
+            rows = np.hstack([rows, self.baseline.rows[:, [0, 2]]])
+        if self.scale != 1:
+            rows = np.rint(rows * self.scale).astype(np.int64)
+        if self.sampler is not None:
+            rows = self.sampler.offer(rows)
+        self.writer.write(rows)
+
+    @profiling.phase("output")
+    def close(self):
+        """Writes the rows the sampler still holds and closes the writer."""
+        if self.sampler is not None:
+            self.writer.write(self.sampler.finish())
+        self.writer.close()
+
+
+class LastRows:
+    """An observer of a simulation that keeps the rows of counters (see
+    sampling.evolution()) of the last batch.
+    """
+
+    def __init__(self):
+        self.rows = None
+
+    def __call__(self, start, stored, sizes):
+        self.rows = sampling.evolution(start, stored, sizes)
+
+
+def new_writer(args, params, state=None, columns=COLUMNS):
+    """Creates the writer selected by args.output_format.
+
+    Args:
+        args - The parsed command line arguments; see add_arguments().
+        params - A dict of the run parameters for the binary header.
+        state - The state of a writer to continue from (see
+            get_state()) or None to start a new output.
+        columns - The names of the columns of the rows.
+    """
+
+    if args.output_format == "binary":
+        return BinaryWriter(sys.stdout.buffer, params, args.delta, state,
+                            columns)
+    if args.output_format == "npy":
+        return NpyWriter(sys.stdout.buffer, columns)
+    return CsvWriter()
+
+
+def truncate_output(position):
+    """Truncates the standard output to the given position if it is a
+    regular file that extends past it. Used to drop the output written after
+    the checkpoint a run is resumed from.
+    """
+
+    fd = sys.stdout.buffer.fileno()
+    info = os.fstat(fd)
+    if position is not None and stat.S_ISREG(info.st_mode) and \
+            info.st_size >= position:
+        os.ftruncate(fd, position)
+        os.lseek(fd, position, os.SEEK_SET)
+    else:
+        print("+++ The output does not continue the output of the " +
+              "checkpoint", file=sys.stderr)
+
+
+def add_arguments(parser):
+    """Adds the output format options to an argparse parser."""
+    parser.add_argument(
+        "--output-format", action="store", default="csv", choices=FORMATS,
+        help="The format of the evolution output; see results.py for the " +
+             "npy and binary formats.")
+    parser.add_argument(
+        "--delta", action="store_true",
+        help="Delta encode the columns of the binary output.")
+
+
+def check_arguments(parser, args):
+    """Validates the output format options parsed by parser."""
+    if args.delta and args.output_format != "binary":
+        parser.error("--delta requires --output-format binary")
+
+
+def load(path):
+    """Loads an evolution output file in the npy or binary format.
+
+    Returns:
+        A (params, rows) tuple where params is a dict of the run parameters
+        (None for npy files) and rows a NumPy array of row_dtype() records.
+    """
+
+    with open(path, "rb") as fileobj:
+        data = fileobj.read()
+
+    if data.startswith(NPY_MAGIC[:6]):
+        return None, np.load(path)
+
+    magic, flags, length = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC:
+        raise ValueError("%s is not an evolution output file" % path)
+
+    offset = BINARY_HEADER.size
+    params = json.loads(data[offset:offset + length].decode())
+    offset += length
+
+    names = params.get("columns", COLUMNS)
+    width = len(names)
+    blocks = []
+    while offset < len(data):
+        count, = BLOCK_HEADER.unpack_from(data, offset)
+        offset += BLOCK_HEADER.size
+        blocks.append(np.frombuffer(data, "<i8", width * count, offset)
+                      .reshape(width, count))
+        offset += 8 * width * count
+
+    columns = np.concatenate(blocks + [np.empty((width, 0), "<i8")], axis=1)
+    if flags & FLAG_DELTA:
+        columns = np.cumsum(columns, axis=1)
+
+    rows = np.empty(columns.shape[1], row_dtype(names))
+    for name, column in zip(names, columns):
+        rows[name] = column
+    return params, rows
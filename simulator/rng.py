@@ -0,0 +1,163 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deterministic random number streams for the simulator.
+
+Each bucket of the simulation draws its random numbers from its own SplitMix64
+stream that is derived from the seed and the bucket ID. The numbers a bucket
+gets therefore only depend on the seed and the uploads to that bucket, which
+makes the results reproducible even if the buckets are simulated in different
+processes.
+"""
+
+import random
+
+import numpy as np
+
+MASK64 = (1 << 64) - 1
+
+# The SplitMix64 increment (the golden ratio).
+GOLDEN = 0x9E3779B97F4A7C15
+
+# The limits of the number of numbers drawn at once for a bucket
+MIN_BLOCK = 8
+MAX_BLOCK = 1024
+
+
+def mix64(z):
+    """The SplitMix64 output function."""
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+
+def new_seed():
+    """Draws a random 64-bit seed from the OS."""
+    return random.SystemRandom().getrandbits(64)
+
+
+def derive_seed(seed, index):
+    """Derives the seed of the index-th replicate of a simulation from its
+    seed. Replicate 0 uses the seed itself.
+    """
+    if index == 0:
+        return seed
+    return mix64((seed + index * GOLDEN) & MASK64)
+
+
+def draw_block(state, count):
+    """Draws count numbers from a SplitMix64 stream at once.
+
+    Args:
+        state - The state of the stream.
+        count - The number of numbers to draw.
+
+    Returns:
+        A (values, state) tuple: a list of the top 53 bits of the next count
+        outputs of the stream and the state after them.
+    """
+
+    z = np.uint64(state) + np.arange(1, count + 1, dtype=np.uint64) * \
+        np.uint64(GOLDEN)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z ^= z >> np.uint64(31)
+    return (z >> np.uint64(11)).tolist(), (state + count * GOLDEN) & MASK64
+
+
+class BucketRandom:
+    """Independent random number streams for the buckets of a simulation.
+
+    The numbers are drawn with NumPy in blocks for each bucket. The blocks
+    start small and grow for the buckets that draw a lot of numbers.
+    """
+
+    def __init__(self, seed):
+        self.seed = seed
+        self._seed_key = mix64(seed & MASK64)
+
+        # A dict bucket_id -> [values, index, state] of the pre-drawn numbers
+        # of the bucket: the top 53 bits of the outputs, the index of the next
+        # one to use and the SplitMix64 state after the last one.
+        self.blocks = {}
+
+    def initial_state(self, bucket_id):
+        """Returns the SplitMix64 state of a bucket before the first draw."""
+        return mix64(self._seed_key ^ (bucket_id & MASK64) ^ (bucket_id >> 64))
+
+    def block(self, bucket_id):
+        """Returns the block of pre-drawn numbers of the bucket with at least
+        one unused number. The caller may use the numbers directly as long as
+        it updates the index.
+        """
+
+        block = self.blocks.get(bucket_id)
+        if block is None:
+            block = self.blocks[bucket_id] = \
+                [[], 0, self.initial_state(bucket_id)]
+
+        if block[1] == len(block[0]):
+            count = min(max(2 * len(block[0]), MIN_BLOCK), MAX_BLOCK)
+            block[0], block[2] = draw_block(block[2], count)
+            block[1] = 0
+
+        return block
+
+    def next53(self, bucket_id):
+        """Returns the top 53 bits of the next output of the bucket."""
+        block = self.block(bucket_id)
+        block[1] += 1
+        return block[0][block[1] - 1]
+
+    def random(self, bucket_id):
+        """Returns the next random float in the range [0, 1) of the
+        bucket.
+        """
+        return self.next53(bucket_id) * (1.0 / (1 << 53))
+
+    def randint(self, bucket_id, a, b):
+        """Returns the next random integer N of the bucket such that
+        a <= N <= b.
+        """
+        return a + self.next53(bucket_id) * (b - a + 1) // (1 << 53)
+
+    def pop_state(self, bucket_id):
+        """Drops the pre-drawn numbers of a bucket, e.g. when the bucket is
+        spilled to disk, and returns the SplitMix64 state of the bucket after
+        the numbers used so far; None if it has not drawn any. The stream
+        continues from the same position after set_state().
+        """
+
+        block = self.blocks.pop(bucket_id, None)
+        if block is None:
+            return None
+        values, index, state = block
+        return (state - (len(values) - index) * GOLDEN) & MASK64
+
+    def set_state(self, bucket_id, state):
+        """Restores the state of a bucket returned by pop_state()."""
+        self.blocks[bucket_id] = [[], 0, state]
+
+    def get_states(self):
+        """Returns a dict bucket_id -> the SplitMix64 state of the bucket
+        after the numbers used so far.
+        """
+
+        return {bucket_id: (state - (len(values) - index) * GOLDEN) & MASK64
+                for bucket_id, (values, index, state) in self.blocks.items()}
+
+    def set_states(self, states):
+        """Restores the states returned by get_states()."""
+        self.blocks = {bucket_id: [[], 0, state]
+                       for bucket_id, state in states.items()}
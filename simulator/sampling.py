@@ -0,0 +1,246 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Downsampling of the evolution output of the simulators.
+
+The evolution of a simulation is a row of counters
+(files_in_storage, files_uploaded, data_in_storage, data_uploaded) after each
+upload, possibly followed by further columns (see results.EvolutionOutput);
+the samplers only look at the second column. The samplers select the rows to
+output from batches of them so that only the selected rows are ever
+formatted:
+    * EverySampler - every Nth upload.
+    * ReservoirSampler - K uniformly random uploads; a replacement for
+      piping the output through `resamp -k K | sort -n`.
+    * LogSampler - about K uploads spaced logarithmically.
+"""
+
+import math
+import random
+
+import numpy as np
+
+
+def evolution(start, stored, sizes):
+    """Computes the counters after each upload of a batch.
+
+    Args:
+        start - The counters before the batch.
+        stored - The stored flags of the uploads.
+        sizes - The sizes of the uploads.
+
+    Returns:
+        A NumPy array with a row of counters for each upload.
+    """
+
+    stored = np.asarray(stored, np.bool_)
+    sizes = np.asarray(sizes, np.int64)
+
+    rows = np.empty((len(sizes), 4), np.int64)
+    np.cumsum(stored, out=rows[:, 0])
+    rows[:, 1] = np.arange(1, len(sizes) + 1)
+    np.cumsum(np.where(stored, sizes, 0), out=rows[:, 2])
+    np.cumsum(sizes, out=rows[:, 3])
+    rows += np.array(start, np.int64)
+    return rows
+
+
+def print_rows(rows):
+    """Prints the rows of counters as CSV lines."""
+    if len(rows):
+        tmpl = ",".join(["%i"] * rows.shape[1])
+        print("\n".join(tmpl % tuple(row) for row in rows.tolist()))
+
+
+class EverySampler:
+    """Selects the uploads whose number is a multiple of N and the last
+    upload.
+    """
+
+    def __init__(self, every, width=4):
+        self.every = every
+        self.width = width
+        self.last = None
+
+    def offer(self, rows):
+        """Offers the rows of a batch to the sampler.
+
+        Returns:
+            The rows that can be output right away.
+        """
+
+        if not len(rows):
+            return rows
+
+        self.last = rows[-1]
+        return rows[rows[:, 1] % self.every == 0]
+
+    def finish(self):
+        """Returns the rows to output after the last batch."""
+        if self.last is None or self.last[1] % self.every == 0:
+            return np.empty((0, self.width), np.int64)
+        return self.last[np.newaxis]
+
+
+class ReservoirSampler:
+    """Selects K uniformly random uploads with Li's Algorithm L; the number
+    of random draws only grows with the logarithm of the stream length.
+    """
+
+    def __init__(self, samples, seed, width=4):
+        self.samples = samples
+        self.rows = np.empty((samples, width), np.int64)
+        self.seen = 0
+        self.random = random.Random(seed)
+
+        self.weight = math.exp(math.log(self._uniform()) / samples)
+        self.next = samples + self._skip()
+
+    def _uniform(self):
+        """Returns a random float in the range (0, 1)."""
+        u = 0.0
+        while u == 0.0:
+            u = self.random.random()
+        return u
+
+    def _skip(self):
+        """Returns the number of uploads to skip before the next one goes to
+        the reservoir.
+        """
+        return int(math.log(self._uniform()) / math.log1p(-self.weight))
+
+    def offer(self, rows):
+        start = self.seen
+        end = start + len(rows)
+
+        if start < self.samples:
+            fill = min(self.samples, end) - start
+            self.rows[start:start + fill] = rows[:fill]
+
+        while self.next < end:
+            self.rows[self.random.randrange(self.samples)] = \
+                rows[self.next - start]
+            self.weight *= math.exp(math.log(self._uniform()) / self.samples)
+            self.next += self._skip() + 1
+
+        self.seen = end
+        return rows[:0]
+
+    def finish(self):
+        rows = self.rows[:min(self.samples, self.seen)]
+        return rows[np.argsort(rows[:, 1], kind="stable")]
+
+
+class LogSampler:
+    """Selects the first upload of each cell of a logarithmic grid and the
+    last upload.
+
+    The grid has `density` cells per doubling of the upload count. The
+    density starts at the next power of two from K and is halved whenever
+    more than 2K rows have been selected; the halved grid only has every
+    second boundary of the previous one, so between K and 2K rows are kept
+    without knowing the length of the stream.
+    """
+
+    def __init__(self, samples, width=4):
+        self.samples = samples
+        self.width = width
+        self.density = float(1 << max(samples - 1, 0).bit_length())
+        self.kept = []
+        self.count = 0
+        self.last = None
+
+    def _first_in_cell(self, rows):
+        """Returns a mask of the rows that are the first of their cell."""
+        n = rows[:, 1].astype(np.float64)
+        with np.errstate(divide="ignore"):
+            cell = np.floor(np.log2(n) * self.density)
+            prev = np.floor(np.log2(n - 1) * self.density)
+        return cell > prev
+
+    def offer(self, rows):
+        if not len(rows):
+            return rows
+
+        self.last = rows[-1]
+        rows = rows[self._first_in_cell(rows)]
+        self.kept.append(rows)
+        self.count += len(rows)
+
+        while self.count > 2 * self.samples:
+            self.density /= 2
+            kept = np.concatenate(self.kept)
+            kept = kept[self._first_in_cell(kept)]
+            self.kept = [kept]
+            self.count = len(kept)
+
+        return rows[:0]
+
+    def finish(self):
+        rows = np.concatenate(self.kept +
+                              [np.empty((0, self.width), np.int64)])
+        if self.last is not None and \
+                (not len(rows) or rows[-1][1] != self.last[1]):
+            rows = np.concatenate([rows, self.last[np.newaxis]])
+        return rows
+
+
+def add_arguments(parser):
+    """Adds the sampling options to an argparse parser."""
+    group = parser.add_argument_group(
+        "Output Sampling",
+        "By default the counters are printed after every upload. These "
+        "options only print the selected uploads; the output is in the "
+        "order of the uploads.")
+    exclusive = group.add_mutually_exclusive_group()
+    exclusive.add_argument(
+        "--samples", action="store", type=int, metavar="K",
+        help="Print K uniformly random uploads (like resamp -k K).")
+    exclusive.add_argument(
+        "--every", action="store", type=int, metavar="N",
+        help="Print every Nth upload and the last upload.")
+    group.add_argument(
+        "--log-spaced", action="store_true",
+        help="With --samples, print about K uploads spaced " +
+             "logarithmically (between K and 2K uploads and the last " +
+             "upload) instead of random ones.")
+
+
+def check_arguments(parser, args):
+    """Validates the sampling options parsed by parser."""
+    if args.samples is not None and args.samples < 1:
+        parser.error("--samples must be positive")
+    if args.every is not None and args.every < 1:
+        parser.error("--every must be positive")
+    if args.log_spaced and args.samples is None:
+        parser.error("--log-spaced requires --samples")
+
+
+def new_sampler(args, seed, width=4):
+    """Creates the sampler selected by the arguments.
+
+    Args:
+        width - The number of columns of the rows.
+
+    Returns:
+        A sampler, or None if every upload is printed.
+    """
+
+    if args.every is not None:
+        return EverySampler(args.every, width)
+    if args.samples is not None:
+        if args.log_spaced:
+            return LogSampler(args.samples, width)
+        return ReservoirSampler(args.samples, seed, width)
+    return None
@@ -0,0 +1,323 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Exact sets of the files already seen by the perfect simulator.
+
+The sets take the files of a batch of uploads at a time and return a flag for
+each upload that is the first occurrence of its file, both within the batch
+and over all the earlier batches:
+    * IdSet - a flag per file ID of an interned stream,
+    * SortedRuns - the 20 byte hashes of a raw stream in sorted runs that are
+      searched by their top 64 bits, the fingerprint,
+    * HashTable - the 20 byte hashes in an open addressing hash table indexed
+      by the fingerprint.
+The hash sets keep the remaining 96 bits of the hashes too and compare them
+whenever the fingerprints match, so they are exact even if two files share a
+fingerprint. SortedRuns takes 20 bytes per hash; HashTable takes 30-60 bytes
+per hash depending on its load.
+"""
+
+import numpy as np
+
+# The initial number of slots of a HashTable
+TABLE_SLOTS = 1 << 16
+
+# The largest fraction of the slots of a HashTable in use before it grows
+MAX_LOAD = 0.7
+
+
+def split_hashes(hashes):
+    """Splits an array of 20 byte hashes (V20) into the big-endian words of
+    the bits 96-159, 32-95 and 0-31 like stream.UPLOAD_DTYPE.
+
+    Returns:
+        A (hi, lo, tail) tuple of uint64, uint64 and uint32 arrays.
+    """
+
+    raw = np.ascontiguousarray(hashes).view(np.uint8).reshape(-1, 20)
+
+    def word(start, end, dtype):
+        return np.ascontiguousarray(raw[:, start:end]).view(
+            ">" + dtype)[:, 0].astype(dtype)
+
+    return word(0, 8, "u8"), word(8, 16, "u8"), word(16, 20, "u4")
+
+
+def _first_in_groups(order, same):
+    """Returns the index of the first occurrence of each group of equal keys.
+
+    Args:
+        order - The permutation that sorts the keys.
+        same - A flag for each sorted key after the first; true if it equals
+            the key before it.
+
+    Returns:
+        A (starts, first) tuple of the positions of the groups in the sorted
+        keys and the smallest index of each group.
+    """
+
+    starts = np.flatnonzero(np.concatenate(([True], ~same)))
+    return starts, np.minimum.reduceat(order, starts)
+
+
+class IdSet:
+    """A set of the dense file IDs of an interned stream; a byte per ID."""
+
+    def __init__(self):
+        self.flags = np.zeros(0, np.bool_)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.flags))
+
+    @property
+    def nbytes(self):
+        return self.flags.nbytes
+
+    def insert(self, ids):
+        """Adds the file IDs of a batch.
+
+        Returns:
+            A NumPy array of flags; true for the first occurrence of each ID
+            that was not in the set.
+        """
+
+        new = np.zeros(len(ids), np.bool_)
+        if not len(ids):
+            return new
+
+        ids = np.asarray(ids, np.int64)
+        order = np.argsort(ids)
+        ids = ids[order]
+        starts, first = _first_in_groups(order, ids[1:] == ids[:-1])
+        ids = ids[starts]
+
+        if ids[-1] >= len(self.flags):
+            flags = np.zeros(max(int(ids[-1]) + 1, 2 * len(self.flags)),
+                             np.bool_)
+            flags[:len(self.flags)] = self.flags
+            self.flags = flags
+
+        unseen = ~self.flags[ids]
+        self.flags[ids[unseen]] = True
+        new[first[unseen]] = True
+        return new
+
+
+class _HashSet:
+    """A base class for the sets of 20 byte hashes."""
+
+    def insert(self, hi, lo, tail):
+        """Adds the hashes of a batch as their big-endian words (see
+        split_hashes()).
+
+        Returns:
+            A NumPy array of flags; true for the first occurrence of each hash
+            that was not in the set.
+        """
+
+        new = np.zeros(len(hi), np.bool_)
+        if not len(hi):
+            return new
+
+        hi, lo, tail = (np.ascontiguousarray(words) for words in
+                        (hi, lo, tail))
+
+        def sort(order):
+            words = hi[order], lo[order], tail[order]
+            same_hi = words[0][1:] == words[0][:-1]
+            same = same_hi & (words[1][1:] == words[1][:-1]) & \
+                (words[2][1:] == words[2][:-1])
+            return same_hi, same
+
+        # Sort by the fingerprint. If different hashes of the batch share a
+        # fingerprint, sort by the whole hash so equal hashes are adjacent.
+        order = np.argsort(hi)
+        same_hi, same = sort(order)
+        if np.any(same_hi & ~same):
+            order = np.lexsort((tail, lo, hi))
+            _, same = sort(order)
+
+        _, first = _first_in_groups(order, same)
+        unseen = self._add_unique(hi[first], lo[first], tail[first])
+        new[first[unseen]] = True
+        return new
+
+    def _add_unique(self, hi, lo, tail):
+        """Adds distinct hashes sorted by the fingerprint.
+
+        Returns:
+            A flag for each hash; true if it was not in the set.
+        """
+        raise NotImplementedError
+
+
+class SortedRuns(_HashSet):
+    """A set of 20 byte hashes kept in runs sorted by the fingerprint.
+
+    A batch of new hashes becomes a run of its own and the runs are merged
+    while the newest run is at least half the size of the one before it, so
+    there are O(log n) runs of geometrically decreasing sizes. A hash takes
+    20 bytes.
+    """
+
+    def __init__(self):
+        # (fingerprints, lo, tail) arrays of each run, the oldest first
+        self.runs = []
+
+    def __len__(self):
+        return sum(len(run[0]) for run in self.runs)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for run in self.runs for array in run)
+
+    def _contains(self, hi, lo, tail):
+        """Returns a flag for each hash that is in the set."""
+        found = np.zeros(len(hi), np.bool_)
+        for run_hi, run_lo, run_tail in self.runs:
+            last = len(run_hi) - 1
+            left = np.searchsorted(run_hi, hi)
+            pos = np.minimum(left, last)
+            match = run_hi[pos] == hi
+            found |= match & (run_lo[pos] == lo) & (run_tail[pos] == tail)
+
+            # The fingerprint of a hash is almost always unique in a run;
+            # otherwise compare every hash with the same fingerprint.
+            more = match & (run_hi[np.minimum(left + 1, last)] == hi) & \
+                (left < last)
+            for i in np.flatnonzero(more & ~found).tolist():
+                span = slice(left[i], np.searchsorted(run_hi, hi[i], "right"))
+                found[i] = np.any((run_lo[span] == lo[i]) &
+                                  (run_tail[span] == tail[i]))
+        return found
+
+    def _add_unique(self, hi, lo, tail):
+        unseen = ~self._contains(hi, lo, tail)
+        if np.any(unseen):
+            self._add(hi[unseen], lo[unseen], tail[unseen])
+        return unseen
+
+    def _add(self, hi, lo, tail):
+        """Adds hashes that are not in the set, sorted by the fingerprint, as
+        a new run.
+        """
+
+        runs = self.runs
+        runs.append((hi, lo, tail))
+        while len(runs) > 1 and 2 * len(runs[-1][0]) >= len(runs[-2][0]):
+            newer = runs.pop()
+            runs[-1] = _merge(runs[-1], newer)
+
+
+class HashTable(_HashSet):
+    """A set of 20 byte hashes in an open addressing hash table with linear
+    probing. The slot of a hash is given by the top bits of its fingerprint;
+    the hashes are SHA-1 hashes so the bits are uniform, and the hashes of a
+    batch, sorted by the fingerprint, probe the table in order, which keeps
+    the memory accesses local. The table doubles whenever more than MAX_LOAD
+    of its slots would be in use.
+    """
+
+    def __init__(self, slots=TABLE_SLOTS):
+        self.count = 0
+        self._allocate(slots)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return self.used.nbytes + self.hi.nbytes + self.lo.nbytes + \
+            self.tail.nbytes
+
+    def _allocate(self, slots):
+        self.used = np.zeros(slots, np.bool_)
+        self.hi = np.zeros(slots, np.uint64)
+        self.lo = np.zeros(slots, np.uint64)
+        self.tail = np.zeros(slots, np.uint32)
+
+    def _add_unique(self, hi, lo, tail):
+        slots = len(self.used)
+        while self.count + len(hi) > MAX_LOAD * slots:
+            slots *= 2
+        if slots > len(self.used):
+            # Rehash the hashes into a larger table.
+            used = self.used
+            old = self.hi[used], self.lo[used], self.tail[used]
+            self._allocate(slots)
+            self._place(*old)
+
+        unseen = self._place(hi, lo, tail)
+        self.count += int(np.count_nonzero(unseen))
+        return unseen
+
+    def _place(self, hi, lo, tail):
+        """Inserts distinct hashes into the table.
+
+        Returns:
+            A flag for each hash; true if it was not in the table.
+        """
+
+        mask = len(self.used) - 1
+        shift = np.uint64(64 - mask.bit_length())
+        unseen = np.zeros(len(hi), np.bool_)
+
+        # The hashes still probing and their current slots
+        pending = np.arange(len(hi))
+        slots = (hi >> shift).astype(np.intp)
+        while len(pending):
+            used = self.used[slots]
+            found = used & (self.hi[slots] == hi[pending]) & \
+                (self.lo[slots] == lo[pending]) & \
+                (self.tail[slots] == tail[pending])
+
+            # Of the hashes probing the same free slot, the first takes it
+            # and the others probe it again.
+            free = np.flatnonzero(~used)
+            _, winners = np.unique(slots[free], return_index=True)
+            winners = free[winners]
+            taken, index = slots[winners], pending[winners]
+            self.used[taken] = True
+            self.hi[taken] = hi[index]
+            self.lo[taken] = lo[index]
+            self.tail[taken] = tail[index]
+            unseen[index] = True
+
+            probing = ~found
+            probing[winners] = False
+            slots = np.where(used, (slots + 1) & mask, slots)
+            pending, slots = pending[probing], slots[probing]
+        return unseen
+
+
+# The sets of hashes by the name of the --seen-set option
+HASH_SETS = {"runs": SortedRuns, "table": HashTable}
+
+
+def _merge(older, newer):
+    """Merges two runs in linear time."""
+    length = len(older[0]) + len(newer[0])
+    # The positions of the hashes of the newer run in the merged run
+    pos = np.searchsorted(older[0], newer[0], "right") + \
+        np.arange(len(newer[0]))
+    rest = np.ones(length, np.bool_)
+    rest[pos] = False
+
+    merged = []
+    for old, new in zip(older, newer):
+        array = np.empty(length, old.dtype)
+        array[pos] = new
+        array[rest] = old
+        merged.append(array)
+    return tuple(merged)
@@ -14,31 +14,45 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
+import numpy as np
+import perfect
+import profiling
+import results
+import rng
+import sampling
+import seenset
+import stream
 import timer
 import sys
 import utils
 
 
-def simulate():
-    # A set of files already in the storage
-    seen = set()
+def simulate(args):
+    upload_stream = stream.UploadStream(args.input)
 
-    files_uploaded = 0
-    data_uploaded = 0
-    files_in_storage = 0
-    data_in_storage = 0
+    # The sampler and the writer of the output
+    output = None
+    if not args.only_final:
+        sampler = sampling.new_sampler(args, args.seed)
+        writer = results.new_writer(args, vars(args))
+        output = results.EvolutionOutput(writer, sampler)
+
+    sim = perfect.PerfectSimulator([output] if output else [], args.seen_set)
 
     tmr = timer.Timer()
 
     def print_stats():
+        counters = sim.snapshot()
         data = (
-            utils.num_fmt(files_in_storage),
-            utils.num_fmt(files_uploaded),
-            1 - files_in_storage / files_uploaded,
-            utils.sizeof_fmt(data_in_storage),
-            utils.sizeof_fmt(data_uploaded),
-            1 - data_in_storage / data_uploaded,
+            utils.num_fmt(counters.files_in_storage),
+            utils.num_fmt(counters.files_uploaded),
+            1 - counters.files_in_storage / counters.files_uploaded,
+            utils.sizeof_fmt(counters.data_in_storage),
+            utils.sizeof_fmt(counters.data_uploaded),
+            1 - counters.data_in_storage / counters.data_uploaded,
             utils.get_mem_info(),
+            utils.sizeof_fmt(sim.seen_bytes()),
             tmr.elapsed_str
         )
 
@@ -46,33 +60,64 @@ def simulate():
             "Statistics: \n"
             "  Files: files_in_storage=%s, files_uploaded=%s, DDP=%s\n"
             "  Data: data_in_storage=%s, data_uploaded=%s, DDP=%s\n"
-            "  Execution: memory[%s], chunk_time=%s"
+            "  Execution: memory[%s, seen_set=%s], chunk_time=%s"
         )
 
         tmr.reset()
 
         print(tmpl % data, file=sys.stderr)
 
-    for (i, (hsh, size)) in enumerate(utils.read_upload_stream()):
-        files_uploaded += 1
-        data_uploaded += size
-        if hsh not in seen:
-            files_in_storage += 1
-            data_in_storage += size
-            seen.add(hsh)
+    for batch in profiling.timed("decode", upload_stream.batches()):
+        uploaded = sim.files_uploaded
+        with profiling.phase("simulate"):
+            sim.feed_batch(batch)
 
-        if (i + 1) % utils.REPORT_FREQUENCY == 0:
+        if sim.files_uploaded // utils.REPORT_FREQUENCY > \
+                uploaded // utils.REPORT_FREQUENCY:
             print_stats()
 
-        print("%i,%i,%i,%i" % (
-            files_in_storage,
-            files_uploaded,
-            data_in_storage,
-            data_uploaded,
-        ))
+    upload_stream.close()
+    if output is not None:
+        output.close()
+    else:
+        sampling.print_rows(np.array([sim.snapshot()], np.int64))
 
     print("+++ Done; ", end="", file=sys.stderr)
     print_stats()
 
 if __name__ == "__main__":
-    simulate()
+    parser = argparse.ArgumentParser(
+        description="A simulator for perfect deduplication.")
+    parser.add_argument("input",
+                        action="store", default="-", type=str, nargs="?",
+                        help="The upload request stream file to simulate; " +
+                             "either a raw or an interned stream. Defaults " +
+                             "to stdin '-'")
+    parser.add_argument("--seed", action="store", type=int,
+                        help="The seed for the random samples of --samples. " +
+                             "A random seed is used by default.")
+    parser.add_argument("--seen-set", action="store", default="runs",
+                        choices=sorted(seenset.HASH_SETS),
+                        help="The set of the hashes seen: sorted runs (20 " +
+                             "bytes per file) or a hash table (30-60 bytes " +
+                             "per file, faster). Interned streams always " +
+                             "use a flag per file ID.")
+    parser.add_argument("--only-final", action="store_true",
+                        help="Only print the counters after the last " +
+                             "upload, in the format of the other rows.")
+    sampling.add_arguments(parser)
+    results.add_arguments(parser)
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+    if args.only_final and (args.samples or args.every):
+        parser.error("--samples and --every cannot be used with --only-final")
+    if args.only_final and args.output_format != "csv":
+        parser.error("--output-format cannot be used with --only-final")
+    sampling.check_arguments(parser, args)
+    results.check_arguments(parser, args)
+    profiling.check_arguments(parser, args)
+    if args.seed is None:
+        args.seed = rng.new_seed()
+
+    profiling.run(args, simulate, args)
@@ -15,11 +15,28 @@
 # limitations under the License.
 
 import argparse
+import base64
+import bucketsample
+import bucketstore
+import checkerset
+import checkpoint
 import collections
+import itertools
 import math
+import metrics
+import multiprocessing
+import numpy as np
 import operator
-import random
+import perfect
+import pickle
+import profiling
 import recordclass
+import replicates
+import results
+import rng
+import sampling
+import seenset
+import stream
 import sys
 import timer
 import utils
@@ -29,7 +46,8 @@ statline is printed to the standard output after each upload:
     <files_in_storage>,<files_uploaded>,<data_in_storage>,<data_uploaded>
 
 Redirecting the stdout to a file will produce a valid CSV file with the raw
-simulation resuts.
+simulation resuts. The options --samples and --every print only a sample of
+the statlines instead.
 
 If the flag --only-final is used, no results are printed during simulations but
 the final deduplication percentage is outputted with the simulation parameters
@@ -38,6 +56,27 @@ in the actual output):
     <RLc>,<RLu>,<max_threshold>,<offline_rate>
     <dedup_percentage_based_on_file_counts>,<dedup_percentage_based_on_bytes>
 
+The protocol parameters --check-limit, --pake-runs, --max-threshold and
+--offline-rate also accept comma separated lists and start:stop[:step] ranges
+(inclusive like seq). The simulator then decodes the stream once and simulates
+every combination of the given values side by side, printing the --only-final
+line of each. The --sweep option reads explicit parameter sets from a file
+instead; each line contains <RLc>,<RLu>,<max_threshold>,<offline_rate>.
+
+With --with-perfect-baseline the uploads are also deduplicated perfectly in
+the same pass. The statlines then end with
+    <perfect_files_in_storage>,<perfect_data_in_storage>
+and the --only-final lines with the DDPs of perfect deduplication
+    <perfect_dedup_percentage_based_on_file_counts>,
+    <perfect_dedup_percentage_based_on_bytes>
+
+With --bucket-sample-rate P only the uploads of a pseudo-random fraction P of
+the short hashes are simulated and the counters of the statlines are scaled by
+1 / P. The DDPs of the sample estimate those of the whole stream; the
+--only-final lines then have the standard errors of the estimates before the
+perfect deduplication DDPs:
+    <stderr_files>,<stderr_bytes>
+See bucketsample.py.
 """
 
 # A single file in the simulation
@@ -45,39 +84,74 @@ File = recordclass.recordclass("File",
                                "hash checkers copies threshold")
 
 
-@utils.timeit
-#@profile
-def simulate(args):
-    # A dict of bucket_id -> [File, File, ..., File] for each bucket
-    buckets = collections.defaultdict(list)
+def pack_files(files, rng_state):
+    """Encodes the files of a bucket and the state of its random numbers
+    (see rng.BucketRandom.pop_state()) for the spill file of a
+    bucketstore.SpillingBuckets.
+    """
+    return pickle.dumps((rng_state, [
+        (fl.hash, fl.copies, fl.threshold, fl.checkers.runs) for fl in files
+    ]), pickle.HIGHEST_PROTOCOL)
 
-    # The number of bytes saved to the storage
-    data_in_storage = 0
-    files_in_storage = 0
 
-    # The number of bytes uploaded through the protocol before deduplication
-    data_uploaded = 0
-    files_uploaded = 0
+def unpack_files(data):
+    """The inverse of pack_files(); returns a (files, rng_state) tuple."""
+    rng_state, files = pickle.loads(data)
+    return [File(hash=key, checkers=checkerset.CheckerSet.from_runs(runs),
+                 copies=copies, threshold=threshold)
+            for key, copies, threshold, runs in files], rng_state
 
-    tmr = timer.Timer()
-    tmr_start = timer.Timer()
 
-    def print_stats():
+class BaseSimulation:
+    """The counters, the statistics and the checkpoint state shared by the
+    simulation engines. The engines implement feed(), upload(),
+    metrics_snapshot(), bucket_state() and restore_buckets().
+
+    The protocol parameters and options are read from params, an
+    argparse.Namespace with the attributes of the command line arguments.
+    """
+
+    def __init__(self, params):
+        self.params = params
+
+        # The number of bytes saved to the storage
+        self.data_in_storage = 0
+        self.files_in_storage = 0
+
+        # The number of bytes uploaded through the protocol before
+        # deduplication
+        self.data_uploaded = 0
+        self.files_uploaded = 0
+
+        # The number of files without checkers skipped when looking for
+        # candidates and the number of such files removed from the buckets
+        self.dead_skipped = 0
+        self.dead_compacted = 0
+
+    def print_stats(self, chunk_time, total_time):
         """A helper for printing statistics about the simulation"""
+        args = self.params
+        offline_rate = args.offline_rate
+        if args.replicates > 1:
+            offline_rate = "%s, replicate=%i" % (offline_rate, args.replicate)
+        # The counters of a sample of the buckets estimate the whole stream.
+        scale = 1 / args.bucket_sample_rate
         data = (
             args.rlc,
             args.rlu,
             args.max_threshold,
-            args.offline_rate,
-            utils.num_fmt(files_in_storage),
-            utils.num_fmt(files_uploaded),
-            1 - files_in_storage / files_uploaded,
-            utils.sizeof_fmt(data_in_storage),
-            utils.sizeof_fmt(data_uploaded),
-            1 - data_in_storage / data_uploaded,
+            offline_rate,
+            utils.num_fmt(self.files_in_storage * scale),
+            utils.num_fmt(self.files_uploaded * scale),
+            1 - self.files_in_storage / self.files_uploaded,
+            utils.sizeof_fmt(self.data_in_storage * scale),
+            utils.sizeof_fmt(self.data_uploaded * scale),
+            1 - self.data_in_storage / self.data_uploaded,
+            utils.num_fmt(self.dead_skipped),
+            utils.num_fmt(self.dead_compacted),
             utils.get_mem_info(),
-            tmr.elapsed_str,
-            tmr_start.elapsed_str,
+            chunk_time,
+            total_time,
         )
 
         tmpl = (
@@ -85,30 +159,293 @@ def simulate(args):
             "  Params: RLc=%s, RLu=%s, max_threshold=%s, offline_rate=%s\n"
             "  Files: files_in_storage=%s, files_uploaded=%s, DDP=%s\n"
             "  Data: data_in_storage=%s, data_uploaded=%s, DDP=%s\n"
+            "  Buckets: dead_skipped=%s, dead_compacted=%s\n"
             "  Execution: memory[%s], chunk_time=%s, total_time=%s"
         )
 
-        tmr.reset()
-
         print(tmpl % data, file=sys.stderr)
 
-    llen = len
-    for (i, (upload, size)) in enumerate(utils.read_upload_stream()):
-        data_uploaded += size
-        files_uploaded += 1
+    def final_result(self):
+        """Returns the --only-final line of the simulation."""
+        args = self.params
+        return "%s,%s,%s,%s,%s,%s" % (
+            args.rlc,
+            args.rlu,
+            args.max_threshold,
+            args.offline_rate,
+            1 - self.files_in_storage / self.files_uploaded,
+            1 - self.data_in_storage / self.data_uploaded,
+        )
 
-        if (i + 1) % utils.REPORT_FREQUENCY == 0:
-            print_stats()
+    def counters(self):
+        """Returns the (files_in_storage, files_uploaded, data_in_storage,
+        data_uploaded) counters of the simulation.
+        """
+        return (self.files_in_storage, self.files_uploaded,
+                self.data_in_storage, self.data_uploaded)
+
+    def set_counters(self, counters):
+        """Sets the counters; the inverse of counters()."""
+        (self.files_in_storage, self.files_uploaded,
+         self.data_in_storage, self.data_uploaded) = counters
+
+    def get_state(self):
+        """Returns the state of the simulation for a checkpoint.
+
+        Returns:
+            A (meta, arrays) tuple where meta is a JSON serializable dict and
+            arrays a dict of NumPy arrays; see checkpoint.py.
+        """
+
+        meta = {
+            "counters": list(self.counters()),
+            "dead_skipped": self.dead_skipped,
+            "dead_compacted": self.dead_compacted,
+        }
+        bucket_meta, arrays = self.bucket_state()
+        meta.update(bucket_meta)
+        return meta, arrays
+
+    def set_state(self, meta, arrays):
+        """Restores a state returned by get_state()."""
+        self.set_counters(meta["counters"])
+        self.dead_skipped = meta["dead_skipped"]
+        self.dead_compacted = meta["dead_compacted"]
+        self.restore_buckets(meta, arrays)
+
+    def record(self, stored, sizes):
+        """Updates the counters with the results of a batch of uploads.
+
+        Args:
+            stored - A sequence of flags, true for each upload that was
+                stored i.e. not deduplicated.
+            sizes - The sizes of the uploaded files.
+        """
+
+        self.files_uploaded += len(sizes)
+        self.data_uploaded += sum(sizes)
+        self.files_in_storage += sum(stored)
+        self.data_in_storage += sum(
+            size for flag, size in zip(stored, sizes) if flag)
+
+
+class Simulation(BaseSimulation):
+    """The state of a single protocol simulation on the reference engine:
+    the buckets are lists of File records.
+    """
+
+    def __init__(self, params):
+        super().__init__(params)
+
+        # The random number streams of the buckets
+        self.rng = rng.BucketRandom(params.seed)
+
+        # A dict of bucket_id -> [File, File, ..., File] for each bucket. With
+        # a memory budget, the cold buckets are spilled to disk with the
+        # states of their random numbers.
+        if params.max_memory:
+            self.buckets = bucketstore.SpillingBuckets(
+                params.max_memory, self.spill_bucket, self.load_bucket,
+                params.spill_dir, self.bucket_weight)
+        else:
+            self.buckets = collections.defaultdict(list)
+
+        # The probabilities offline_rate ** n of n checkers being offline,
+        # scaled by 2 ** 53 for comparing with the 53-bit random numbers
+        self.offline_limits = []
+
+        # The instrumentation counters if they are enabled or None
+        self.metrics = metrics.Metrics() if params.metrics else None
+
+    def print_stats(self, chunk_time, total_time):
+        super().print_stats(chunk_time, total_time)
+
+        buckets = self.buckets
+        if isinstance(buckets, bucketstore.SpillingBuckets):
+            stats = buckets.stats
+            print("  Spill: hit_rate=%.3f, resident=%s, evictions=%s, "
+                  "spilled=%s, loaded=%s, on_disk=%s" % (
+                      buckets.hit_rate, utils.sizeof_fmt(buckets.used),
+                      utils.num_fmt(stats["evictions"]),
+                      utils.sizeof_fmt(stats["bytes_spilled"]),
+                      utils.sizeof_fmt(stats["bytes_loaded"]),
+                      utils.sizeof_fmt(buckets.end)),
+                  file=sys.stderr)
+
+    def bucket_weight(self, bucket_id, files):
+        """Estimates the memory used by a bucket and its pre-drawn random
+        numbers; see bucketstore.SpillingBuckets.
+        """
+        block = self.rng.blocks.get(bucket_id)
+        draws = len(block[0]) if block is not None else 0
+        return bucketstore.estimate(bucket_id, files) + \
+            bucketstore.DRAW_BYTES * draws
+
+    def spill_bucket(self, bucket_id, files):
+        """Encodes a bucket written to disk; its random number stream is
+        dropped from memory and stored with it.
+        """
+        return pack_files(files, self.rng.pop_state(bucket_id))
+
+    def load_bucket(self, bucket_id, data):
+        """Decodes a bucket read back from disk and restores its random
+        number stream.
+        """
+        files, rng_state = unpack_files(data)
+        if rng_state is not None:
+            self.rng.set_state(bucket_id, rng_state)
+        return files
+
+    def metrics_snapshot(self):
+        """Returns a snapshot of the instrumentation counters; see
+        metrics.py.
+        """
+        buckets = self.buckets
+        if isinstance(buckets, bucketstore.SpillingBuckets):
+            # The buckets on disk are counted without reading them.
+            lengths = buckets.lengths()
+        else:
+            lengths = (len(files) for files in buckets.values())
+        return self.metrics.snapshot(lengths)
+
+    def offline_limit(self, num_checkers):
+        """Returns the probability of num_checkers checkers being offline
+        scaled by 2 ** 53. The values are cached in offline_limits.
+        """
+
+        limits = self.offline_limits
+        rate = self.params.offline_rate
+        while len(limits) <= num_checkers:
+            # Scaling by a power of two is exact so comparing a 53-bit number
+            # x with the limit is the same as comparing x / 2 ** 53 with the
+            # probability.
+            limits.append(math.pow(rate, len(limits)) * (1 << 53))
+        return limits[num_checkers]
+
+    def get_state(self):
+        meta, arrays = super().get_state()
+        if self.metrics is not None:
+            meta["metrics"] = self.metrics.get_state()
+        return meta, arrays
+
+    def set_state(self, meta, arrays):
+        super().set_state(meta, arrays)
+        if self.metrics is not None and "metrics" in meta:
+            self.metrics.set_state(meta["metrics"])
+
+    def bucket_state(self):
+        """Returns the (meta, arrays) state of the buckets and the random
+        number streams.
+        """
+
+        rng_states = self.rng.get_states()
+        if isinstance(self.buckets, bucketstore.SpillingBuckets):
+            # The buckets on disk carry their random number streams.
+            buckets = list(self.buckets.resident.items())
+            for bucket_id, data in self.buckets.spilled():
+                bucket, rng_state = unpack_files(data)
+                buckets.append((bucket_id, bucket))
+                if rng_state is not None:
+                    rng_states[bucket_id] = rng_state
+        else:
+            buckets = list(self.buckets.items())
+
+        files = [fl for _, bucket in buckets for fl in bucket]
+        keys = [fl.hash for fl in files]
+        bytes_keys = bool(keys) and isinstance(keys[0], bytes)
+
+        arrays = {
+            "bucket_ids": checkpoint.split_ints(
+                [bucket_id for bucket_id, _ in buckets]),
+            "bucket_sizes": np.array([len(bucket) for _, bucket in buckets],
+                                     np.int64),
+            "keys": (checkpoint.split_bytes(keys, 20) if bytes_keys
+                     else np.array(keys, np.uint64)),
+            "copies": np.array([fl.copies for fl in files], np.int64),
+            "thresholds": np.array([fl.threshold for fl in files], np.int64),
+            "run_lengths": np.array([len(fl.checkers.runs) for fl in files],
+                                    np.int64),
+            "runs": np.fromiter(itertools.chain.from_iterable(
+                fl.checkers.runs for fl in files), np.int64),
+            "rng_buckets": checkpoint.split_ints(list(rng_states)),
+            "rng_states": np.array(list(rng_states.values()), np.uint64),
+        }
+        return {"bytes_keys": bytes_keys}, arrays
+
+    def restore_buckets(self, meta, arrays):
+        """Restores a state returned by bucket_state()."""
+        if meta["bytes_keys"]:
+            keys = checkpoint.join_bytes(arrays["keys"])
+        else:
+            keys = arrays["keys"].tolist()
+        copies = arrays["copies"].tolist()
+        thresholds = arrays["thresholds"].tolist()
+        run_lengths = arrays["run_lengths"].tolist()
+        runs = arrays["runs"].tolist()
+
+        # The streams are restored first so that the buckets spilled while
+        # they are restored take their streams with them.
+        self.rng.set_states(dict(zip(
+            checkpoint.join_ints(arrays["rng_buckets"]),
+            arrays["rng_states"].tolist())))
+
+        files = zip(keys, copies, thresholds, run_lengths)
+        self.buckets.clear()
+        pos = 0
+        for bucket_id, size in zip(checkpoint.join_ints(arrays["bucket_ids"]),
+                                   arrays["bucket_sizes"].tolist()):
+            bucket = self.buckets[bucket_id]
+            for key, file_copies, threshold, length in \
+                    itertools.islice(files, size):
+                bucket.append(File(
+                    hash=key,
+                    checkers=checkerset.CheckerSet.from_runs(
+                        runs[pos:pos + length]),
+                    copies=file_copies,
+                    threshold=threshold))
+                pos += length
+
+    def feed(self, keys, bucket_ids, sizes):
+        """Simulates a batch of uploads and updates the counters.
+
+        Returns:
+            A list of flags; true for each upload that was stored.
+        """
 
-        # Get the short hash.
-        short_hash = upload >> (args.hashlen - args.shlen)
+        upload = self.upload
+        stored = [upload(*args) for args in zip(keys, bucket_ids, sizes)]
+        self.record(stored, sizes)
+        return stored
 
-        bucket_id = short_hash
-        if args.with_sizes:
-            bucket_id |= size << args.shlen
+    #@profile
+    def upload(self, upload, bucket_id, size):
+        """Simulates a single upload. Does not update the counters; see
+        feed().
+
+        Args:
+            upload - The key of the uploaded file (hash or file ID).
+            bucket_id - The bucket of the file; see bucket_ids().
+            size - The size of the file.
+
+        Returns:
+            True if the file was stored, False if it was deduplicated.
+        """
+
+        args = self.params
+        rnd = self.rng
 
         # The list of the files in the bucket in the order of their popularity
-        files = buckets[bucket_id]
+        files = self.buckets[bucket_id]
+
+        # The pre-drawn random numbers of the bucket for the offline checks;
+        # see rng.BucketRandom.block(). The index is kept in a local and
+        # written back after the loop.
+        offline = args.offline_rate
+        if offline:
+            draws = rnd.block(bucket_id)
+            draw_values = draws[0]
+            draw_index = draws[1]
+            limits = self.offline_limits
 
         # If the upload was deduplicated.
         file_deduplicated = False
@@ -118,18 +455,24 @@ def simulate(args):
         # The number of files considered for deduplication
         files_considered = 0
 
+        # The number of files without checkers skipped and the number of
+        # files scanned
+        dead = 0
+        scanned = 0
+
         for i, fl in enumerate(files):
-            if not fl.checkers:
-                # This file no longer has checkers. Skip it.
-                # TODO: Check if these could be removed from the array or is
-                # removal too expensive
+            scanned += 1
+            if not fl.checkers.total:
+                # This file no longer has checkers. Skip it; it is removed
+                # from the bucket after this upload.
+                dead += 1
                 continue
 
             # The checkers for this file
             checkers = fl.checkers
 
             # Calculate how many checkers there are available
-            num_checkers = llen(checkers)
+            num_checkers = checkers.total
 
             # Calculate the propability of all available checkers being online.
             # Since P(checker offline) = args.offline_rate / 100,
@@ -137,24 +480,33 @@ def simulate(args):
             #   = P(c1 offline) AND P(c2 offline) ... P(cn offline)
             #   = P(c1 offline) * P(c2 offline)* ... * P(cn offline)
             #   = P(checker offline) ^ n
-            if args.offline_rate and \
-                    random.random() < math.pow(args.offline_rate, num_checkers):
-                # All checkers were offline, try the next one
-                continue
+            if offline:
+                if draw_index == len(draw_values):
+                    draws[1] = draw_index
+                    draws = rnd.block(bucket_id)
+                    draw_values = draws[0]
+                    draw_index = draws[1]
 
-            files_considered += 1
+                value = draw_values[draw_index]
+                draw_index += 1
+                if value < (limits[num_checkers]
+                            if num_checkers < len(limits)
+                            else self.offline_limit(num_checkers)):
+                    # All checkers were offline, try the next one
+                    continue
 
-            # The last checker in the list has performed the least number of
-            # checks
-            checker_index = num_checkers - 1
+            files_considered += 1
 
-            # Decrease the check count for the checker.
-            checkers[checker_index] -= 1
+            # The checker with the most checks left has performed the least
+            # number of checks. Decrease the check count for the checker.
+            runs = checkers.runs
+            remaining = runs[-2] - 1
 
             # If this is the uploaded file but has already been
             # deduplicated as a different file, the second match is just
             # ignored
             if fl.hash == upload and not match_found:
+                checkers.take()
                 match_found = True
                 match_index = i
 
@@ -171,83 +523,803 @@ def simulate(args):
                 if args.one_successful_check and file_deduplicated:
                     # A successful check; this checker replaces the client who
                     # performed the check for this upload.
-                    checkers[checker_index] = args.rlc
+                    remaining = args.rlc
                 else:
                     # This "uploader" will perform RLc checks for this file.
                     # This also happens if the threshold has not yet been met.
                     # In that case the uploader just uses a different key when
                     # deduplicating this file
-                    checkers += [args.rlc]
-
-            if checkers[checker_index] == 0:
-                # The checker has hit the limit;
-                checkers.pop(checker_index)
+                    checkers.add(args.rlc)
 
-            elif num_checkers > 1 and checkers[checker_index] != args.rlc:
-                # The uploader did not replace the checker. Sort the list.
-                checkers.sort()
-
-            # assert all(checkers[i] <= checkers[i+1] for i in range(len(checkers)-1))
+                if remaining:
+                    # The checker has not hit the limit yet; put it back.
+                    checkers.add(remaining)
+            elif remaining and runs[-1] == 1 and \
+                    (len(runs) == 2 or runs[-4] < remaining):
+                # CheckerSet.take() and add() inlined. Usually the checker is
+                # alone in the last run and still has more checks left than
+                # the checkers of the run before it, so it is updated in
+                # place.
+                runs[-2] = remaining
+            else:
+                # CheckerSet.take() inlined; the checker is put back unless
+                # it has hit the limit.
+                if runs[-1] == 1:
+                    del runs[-2:]
+                else:
+                    runs[-1] -= 1
+                checkers.total -= 1
+                if remaining:
+                    checkers.add(remaining)
 
             if files_considered == args.rlu:
                 # The uploader rate limit has been reached.
                 break
 
-        if not file_deduplicated:
-            # The upload could not be deduplicated.
-            data_in_storage += size
-            files_in_storage += 1
+        if offline:
+            draws[1] = draw_index
 
         # There was no match for this file. Add a new file to the bucket.
         if not match_found:
             # Add the file to the list of files in this bucket.
             files.append(File(
                 hash=upload,
-                # The list of checkers for this file; each entry is the number
-                # of checks that checker has available
-                checkers=[args.rlc],
+                # The checkers for this file; the number of checks each
+                # checker has available
+                checkers=checkerset.CheckerSet(args.rlc),
                 copies=1,
-                threshold=random.randint(2, args.max_threshold)
+                threshold=rnd.randint(bucket_id, 2, args.max_threshold)
             ))
 
         # The matching file had its popularity increase. Make the list
-        # sorted again by shifting the item left until the list is ordered.
-        while match_found and match_index > 0 and \
+        # sorted again by moving the item in front of the files that have
+        # less copies; it stays behind the files that have as many.
+        distance = 0
+        if match_found and match_index > 0 and \
                 files[match_index - 1].copies < files[match_index].copies:
+            index = popularity_index(files, files[match_index].copies,
+                                     match_index)
+            files.insert(index, files.pop(match_index))
+            distance = match_index - index
 
-            files[match_index - 1], files[match_index] = \
-                files[match_index], files[match_index - 1]
+        # assert all(files[i].copies >= files[i+1].copies for i in range(len(files)-1))
 
-            match_index -= 1
+        if dead:
+            # Files without checkers can never be matched or considered
+            # again. Remove them from the scanned part of the bucket, so
+            # that every one of them is skipped only once; copying the
+            # scanned part costs about as much as the scan itself. The list
+            # stays ordered by the copies since we only remove files.
+            files[:scanned] = [fl for fl in files[:scanned]
+                               if fl.checkers.total]
+            self.dead_compacted += dead
 
-        # assert all(files[i].copies >= files[i+1].copies for i in range(len(files)-1))
+        self.dead_skipped += dead
 
-        if not args.only_final:
-            # Print the number to files to the output file
-            print("%i,%i,%i,%i" % (
-                files_in_storage,
-                files_uploaded,
-                data_in_storage,
-                data_uploaded,
-            ))
+        if self.metrics is not None:
+            self.metrics.record_upload(scanned, files_considered, dead,
+                                       match_found, distance)
+
+        # The upload is stored if it could not be deduplicated.
+        return not file_deduplicated
+
+
+class ArraySimulation(BaseSimulation):
+    """A simulation on the array engine; see array_engine.py. Produces the
+    same results as Simulation but does not count the skipped files without
+    checkers since they are removed from the buckets right away.
+    """
+
+    def __init__(self, params):
+        if params.max_memory:
+            raise ValueError("The array engine does not support a memory "
+                             "budget")
+        # Imported here so that the runs on the reference engine do not load
+        # the array engine and Numba.
+        import array_engine
+        super().__init__(params)
+        self.state = array_engine.ArrayState(params)
+
+    def feed(self, keys, bucket_ids, sizes):
+        stored = self.state.simulate(keys, bucket_ids).tolist()
+        self.record(stored, sizes)
+        self.dead_compacted = self.state.removed
+        return stored
+
+    def upload(self, upload, bucket_id, size):
+        stored = self.state.simulate([upload], [bucket_id])
+        self.dead_compacted = self.state.removed
+        return bool(stored[0])
+
+    def metrics_snapshot(self):
+        import array_engine
+        stats = self.state.stats.tolist()
+        counts = metrics.Metrics()
+        counts.counts.update(zip(
+            ("uploads", "scanned", "considered", "offline_skipped",
+             "matches", "reorders", "reorder_distance"),
+            stats[:array_engine.STAT_HISTOGRAM]))
+        counts.scanned_per_upload = stats[array_engine.STAT_HISTOGRAM:]
+        return counts.snapshot(self.state.bucket_lengths().tolist())
+
+    def bucket_state(self):
+        return self.state.get_state()
+
+    def restore_buckets(self, meta, arrays):
+        self.state.set_state(meta, arrays)
+
+
+# The simulation engines by their --engine name
+ENGINES = {
+    "reference": Simulation,
+    "array": ArraySimulation,
+}
+
+
+def new_simulation(params):
+    """Creates a simulation on the engine selected by params.engine."""
+    return ENGINES[params.engine](params)
+
+
+def popularity_index(files, copies, hi):
+    """Finds the position of a file in a bucket by its popularity.
+
+    Args:
+        files - The files of a bucket in descending order of copies.
+        copies - The number of copies the file has.
+        hi - The search is limited to files[:hi].
+
+    Returns:
+        The index of the first file in files[:hi] with less copies (hi if
+        there is no such file).
+    """
+
+    lo = 0
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if files[mid].copies < copies:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def bucket_ids(args, short_hashes, sizes):
+    """Computes the buckets of uploads; the short hash, combined with the
+    file size if the protocol uses sizes.
+    """
+
+    if args.with_sizes:
+        shlen = args.shlen
+        return [sh | size << shlen for sh, size in zip(short_hashes, sizes)]
+    return short_hashes
+
+
+def read_batches(args, upload_stream, sample=None):
+    """Reads the uploads from the stream in batches.
+
+    Args:
+        sample - A bucketsample.BucketSample of the buckets to read or None
+            to read every upload.
+
+    Yields:
+        A (keys, bucket_ids, sizes) tuple of lists for each batch.
+    """
+
+    select = sample.select if sample is not None else None
+    for batch in upload_stream.batches(select):
+        keys, short_hashes, sizes = upload_stream.decode_keys(
+            batch, args.shlen, args.hashlen)
+        yield keys, bucket_ids(args, short_hashes, sizes), sizes
+
+
+# The parameters of a single simulation that DedupSimulator() does not take,
+# with their values for a simulation of all the buckets without replicates.
+# configurations() sets them for the runs of the command line.
+RUN_DEFAULTS = {
+    "replicate": 0,
+    "replicates": 1,
+    "bucket_sample_rate": 1,
+}
+
+
+def simulation_params(**params):
+    """Returns the parameters of a single simulation as an
+    argparse.Namespace; those of RUN_DEFAULTS may be left out.
+    """
+    return argparse.Namespace(**dict(RUN_DEFAULTS, **params))
+
+
+class DedupSimulator:
+    """A simulation of the protocol for use as a library.
+
+    The uploads are fed in batches of (key, size) pairs and the counters can
+    be read at any point with snapshot(). Observers are called after each
+    batch with the counters before the batch (a results.Snapshot), the stored
+    flags and the sizes of the uploads; see results.EvolutionOutput.
+
+    Example:
+        sim = simulator.DedupSimulator(rlc=70, rlu=30, seed=1)
+        sim.feed(hashes, sizes)
+        print(sim.snapshot())
+    """
+
+    def __init__(self, rlc=70, rlu=30, max_threshold=20, offline_rate=0,
+                 shlen=13, hashlen=160, with_sizes=False,
+                 deduplicate_below_threshold=False,
+                 one_successful_check=False, seed=None, engine="reference",
+                 metrics=False, max_memory=None, spill_dir=None,
+                 observers=()):
+        """Creates a simulation; the parameters are those of the command
+        line. A random seed is used if seed is None. With max_memory (in
+        bytes) the buckets beyond the budget are spilled to disk; see
+        bucketstore.py.
+        """
+
+        if seed is None:
+            seed = rng.new_seed()
+        params = simulation_params(
+            rlc=rlc, rlu=rlu, max_threshold=max_threshold,
+            offline_rate=offline_rate, shlen=shlen, hashlen=hashlen,
+            with_sizes=with_sizes,
+            deduplicate_below_threshold=deduplicate_below_threshold,
+            one_successful_check=one_successful_check, seed=seed,
+            engine=engine, metrics=metrics, max_memory=max_memory,
+            spill_dir=spill_dir)
+        self._setup(params, observers)
+
+    @classmethod
+    def from_params(cls, params, observers=()):
+        """Creates a simulation from an argparse.Namespace with the
+        attributes of the command line arguments; see simulation_params().
+        """
+        sim = cls.__new__(cls)
+        sim._setup(simulation_params(**vars(params)), observers)
+        return sim
+
+    def _setup(self, params, observers):
+        self.params = params
+        self.simulation = new_simulation(params)
+        self.observers = list(observers)
+
+    def feed(self, keys, sizes, short_hashes=None):
+        """Simulates a batch of uploads.
+
+        Args:
+            keys - The files of the uploads; 20 byte hashes (bytes) or the
+                file IDs (ints) of an interned stream. NumPy arrays work too.
+            sizes - The sizes of the uploaded files.
+            short_hashes - The short hashes of the files. Computed from the
+                hashes if None; required with file IDs.
+
+        Returns:
+            A list of flags; true for each upload that was stored.
+        """
+
+        keys = keys.tolist() if isinstance(keys, np.ndarray) else list(keys)
+        sizes = sizes.tolist() if isinstance(sizes, np.ndarray) \
+            else list(sizes)
+
+        if short_hashes is None:
+            if keys and not isinstance(keys[0], bytes):
+                raise ValueError("Uploads of file IDs need the short hashes")
+            shift = self.params.hashlen - self.params.shlen
+            short_hashes = [int.from_bytes(key, byteorder="big") >> shift
+                            for key in keys]
+        elif isinstance(short_hashes, np.ndarray):
+            short_hashes = short_hashes.tolist()
+
+        return self.feed_buckets(
+            keys, bucket_ids(self.params, short_hashes, sizes), sizes)
+
+    def feed_buckets(self, keys, buckets, sizes, stored=None):
+        """Simulates a batch of uploads with precomputed bucket IDs (see
+        bucket_ids()) and notifies the observers.
+
+        Args:
+            stored - The stored flags of the uploads if they were simulated
+                elsewhere (e.g. by a ShardPool); only the counters are
+                updated then.
+
+        Returns:
+            The stored flags of the uploads.
+        """
+
+        start = self.snapshot()
+        if stored is None:
+            stored = self.simulation.feed(keys, buckets, sizes)
+        else:
+            self.simulation.record(stored, sizes)
+
+        for observer in self.observers:
+            observer(start, stored, sizes)
+        return stored
+
+    def feed_stream(self, source, batch_size=stream.DEFAULT_BATCH_SIZE):
+        """Simulates the uploads of a stream file; see stream.UploadStream.
+
+        Returns:
+            The counters after the stream.
+        """
+
+        with stream.UploadStream(source, batch_size) as upload_stream:
+            for batch in read_batches(self.params, upload_stream):
+                self.feed_buckets(*batch)
+        return self.snapshot()
+
+    def snapshot(self):
+        """Returns the counters of the simulation as a results.Snapshot."""
+        return results.Snapshot(*self.simulation.counters())
+
+    def metrics(self):
+        """Returns the instrumentation counters; see metrics.py. The
+        simulation must be created with metrics=True.
+        """
+        return self.simulation.metrics_snapshot()
+
+    def get_state(self):
+        """Returns the state of the simulation; see Simulation.get_state()."""
+        return self.simulation.get_state()
+
+    def set_state(self, meta, arrays):
+        """Restores a state returned by get_state()."""
+        self.simulation.set_state(meta, arrays)
+
+
+def configurations(args):
+    """Expands the parameter lists of the arguments into the parameter sets
+    to simulate.
+
+    Returns:
+        A list of argparse.Namespace objects, one for each parameter set,
+        or --replicates consecutive ones with different seeds for each
+        parameter set.
+    """
+
+    if args.grid is not None:
+        grid = args.grid
+    elif args.sweep:
+        grid = []
+        with open(args.sweep) as sweep:
+            for line in sweep:
+                line = line.split("#")[0].strip()
+                if not line:
+                    continue
+                rlc, rlu, max_threshold, offline_rate = line.split(",")
+                grid.append((int(rlc), int(rlu), int(max_threshold),
+                             float(offline_rate)))
+    else:
+        grid = itertools.product(args.rlc, args.rlu, args.max_threshold,
+                                 args.offline_rate)
+
+    return [
+        simulation_params(**dict(
+            vars(args), rlc=rlc, rlu=rlu, max_threshold=max_threshold,
+            offline_rate=offline_rate, replicate=replicate,
+            seed=rng.derive_seed(args.seed, replicate)))
+        for rlc, rlu, max_threshold, offline_rate in grid
+        for replicate in range(args.replicates)
+    ]
+
+
+def restore_arguments(parser, args, meta):
+    """Applies the parameters of a checkpoint to the arguments. --resume
+    continues with the parameters of the checkpoint; --fork uses the
+    parameters of the command line but they must be compatible with the
+    state.
+    """
+
+    saved = meta["configs"]
+    if len(meta["shards"]) != args.workers:
+        parser.error("the checkpoint was written with --workers %i" %
+                     len(meta["shards"]))
+
+    if args.resume:
+        for name in checkpoint.STATE_PARAMS:
+            setattr(args, name, saved[0][name])
+        # The output options of the command line may only repeat those of
+        # the checkpoint.
+        for name, value in meta.get("output", {}).items():
+            if getattr(args, name) not in (value, parser.get_default(name)):
+                parser.error("--resume cannot change --%s" %
+                             name.replace("_", "-"))
+            setattr(args, name, value)
+        args.replicates = meta.get("replicates", 1)
+        args.grid = [(params["rlc"], params["rlu"], params["max_threshold"],
+                      params["offline_rate"])
+                     for params in saved[::args.replicates]]
+        return
+
+    if args.seed is None:
+        args.seed = saved[0]["seed"]
+
+    configs = configurations(args)
+    if len(configs) != len(saved):
+        parser.error("the checkpoint has %i parameter sets, not %i" %
+                     (len(saved), len(configs)))
+
+    for params, old in zip(configs, saved):
+        for name in checkpoint.FIXED_PARAMS:
+            if getattr(params, name) != old[name]:
+                parser.error("--fork cannot change %s" % name)
+        if params.engine == "array" and params.rlc != old["rlc"]:
+            parser.error("--fork cannot change the check limit of the " +
+                         "array engine")
+
+
+def _shard_worker(conn, configs, states=None):
+    """Simulates the buckets of a single shard. Receives batches of
+    (keys, bucket_ids, sizes) from conn and sends back the stored flags of
+    each simulation until it receives None. The messages "state" and
+    "metrics" are answered with the states and the metrics snapshots of the
+    simulations.
+    """
+
+    simulations = [new_simulation(params) for params in configs]
+    if states is not None:
+        for sim, state in zip(simulations, states):
+            sim.set_state(*state)
+
+    while True:
+        batch = conn.recv()
+        if batch is None:
+            break
+
+        if batch == "state":
+            conn.send([sim.get_state() for sim in simulations])
+            continue
+
+        if batch == "metrics":
+            conn.send([sim.metrics_snapshot() for sim in simulations])
+            continue
+
+        conn.send([bytes(sim.feed(*batch)) for sim in simulations])
+
+
+class ShardPool:
+    """Worker processes that simulate the uploads. The buckets are sharded
+    among the workers by the bucket ID and the results are merged back into
+    the stream order.
+    """
+
+    def __init__(self, configs, workers, states=None):
+        """Starts the workers.
+
+        Args:
+            configs - The parameter sets to simulate.
+            workers - The number of workers.
+            states - The states of the simulations of each shard to start
+                from or None; see checkpoint.py.
+        """
+
+        self.configs = configs
+        self.pipes = []
+        self.procs = []
+        for shard in range(workers):
+            conn, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(
+                target=_shard_worker, daemon=True,
+                args=(child, configs, states and states[shard]))
+            proc.start()
+            self.pipes.append(conn)
+            self.procs.append(proc)
+
+    def _submit(self, keys, bids, sizes):
+        pipes = self.pipes
+        owners = np.fromiter((bid % len(pipes) for bid in bids), np.intp,
+                             len(bids))
+        for shard, conn in enumerate(pipes):
+            index = np.flatnonzero(owners == shard).tolist()
+            conn.send(([keys[i] for i in index],
+                       [bids[i] for i in index],
+                       [sizes[i] for i in index]))
+        return owners
+
+    def _collect(self, owners):
+        stored = np.zeros((len(self.configs), len(owners)), np.bool_)
+        for shard, conn in enumerate(self.pipes):
+            mask = owners == shard
+            for sim, flags in enumerate(conn.recv()):
+                stored[sim, mask] = np.frombuffer(flags, np.bool_)
+        return stored.tolist()
+
+    def simulate(self, batches, offset=0, barrier=None):
+        """Simulates the batches.
+
+        Args:
+            batches - The (keys, bucket_ids, sizes) batches to simulate.
+            offset - The number of uploads before the first batch.
+            barrier - A function (start, end) -> bool. If it returns true
+                for the uploads of a batch, no more batches are submitted
+                before the results of that batch have been consumed, so
+                get_states() returns the states after that batch.
+
+        Yields:
+            A (batch, stored) tuple for each batch where stored has a list of
+            stored flags for each simulation.
+        """
+
+        # Keep the workers busy by submitting the next batch before
+        # collecting the results of the previous one.
+        pending = None
+        for batch in batches:
+            if pending is not None and barrier is not None and \
+                    barrier(offset - len(pending[0][2]), offset):
+                yield pending[0], self._collect(pending[1])
+                pending = None
+
+            owners = self._submit(*batch)
+            offset += len(batch[2])
+            if pending is not None:
+                yield pending[0], self._collect(pending[1])
+            pending = (batch, owners)
+
+        if pending is not None:
+            yield pending[0], self._collect(pending[1])
+
+    def get_states(self):
+        """Returns the states of the simulations of each shard."""
+        for conn in self.pipes:
+            conn.send("state")
+        return [conn.recv() for conn in self.pipes]
+
+    def get_metrics(self):
+        """Returns the metrics snapshots of the simulations merged over the
+        shards.
+        """
+        for conn in self.pipes:
+            conn.send("metrics")
+        shards = [conn.recv() for conn in self.pipes]
+        return [metrics.merge(snapshots) for snapshots in zip(*shards)]
+
+    def close(self):
+        """Stops the workers."""
+        for conn, proc in zip(self.pipes, self.procs):
+            conn.send(None)
+            proc.join()
+
+
+def save_checkpoint(args, configs, simulations, pool, sampler, writer):
+    """Writes a checkpoint of the run to args.checkpoint_dir."""
+    if pool is None:
+        shards = [[sim.get_state() for sim in simulations]]
+    else:
+        shards = pool.get_states()
+
+    meta = {
+        "configs": [{name: getattr(params, name)
+                     for name in checkpoint.STATE_PARAMS}
+                    for params in configs],
+        "counters": [list(sim.counters()) for sim in simulations],
+        "replicates": args.replicates,
+        "output": {name: getattr(args, name)
+                   for name in checkpoint.OUTPUT_PARAMS},
+        "sampler": None,
+        "writer": None,
+        "output_offset": None,
+    }
+    if writer is not None:
+        # tell() flushes the buffered rows, which updates the state.
+        meta["output_offset"] = writer.tell()
+        meta["writer"] = writer.get_state()
+    if sampler is not None:
+        meta["sampler"] = base64.b64encode(pickle.dumps(sampler)).decode()
+
+    path = checkpoint.save(args.checkpoint_dir,
+                           simulations[0].files_uploaded, meta, shards)
+    print("+++ Checkpoint: %s" % path, file=sys.stderr)
+
+
+@utils.timeit
+def simulate(args, restore=None):
+    """Runs the simulations.
+
+    Args:
+        args - The parsed command line arguments.
+        restore - A (meta, shards) checkpoint to continue from or None; see
+            checkpoint.load().
+    """
+
+    configs = configurations(args)
+    if args.max_memory:
+        # The budget is shared by the simulations of every worker.
+        share = max(args.max_memory // (len(configs) * args.workers), 1)
+        for params in configs:
+            params.max_memory = share
+    simulators = [DedupSimulator.from_params(params) for params in configs]
+    simulations = [sim.simulation for sim in simulators]
+
+    tmr = timer.Timer()
+    tmr_start = timer.Timer()
+
+    # The sample of the buckets and the counters of its jackknife groups
+    # for each simulation
+    sample = None
+    group_counters = None
+    scale = 1 / args.bucket_sample_rate
+    if args.bucket_sample_rate < 1:
+        group_counters = [bucketsample.GroupCounters() for _ in configs]
+
+    def print_stats():
+        """A helper for printing statistics about the simulations"""
+        for i, sim in enumerate(simulations):
+            sim.print_stats(tmr.elapsed_str, tmr_start.elapsed_str)
+            if group_counters is not None:
+                errors = bucketsample.standard_errors(
+                    group_counters[i].counts, args.bucket_sample_rate)
+                print("  Sample: rate=%s, uploads=%s, stderr_files=%s, "
+                      "stderr_bytes=%s" % ((
+                          args.bucket_sample_rate,
+                          utils.num_fmt(sim.files_uploaded)) + errors),
+                      file=sys.stderr)
+        tmr.reset()
+
+    exporter = None
+    if args.metrics:
+        exporter = metrics.Exporter(args.metrics, args.metrics_format)
+
+    def export_metrics(final=False):
+        """Exports the instrumentation counters if asked to."""
+        if exporter is None:
+            return
+        if pool is None:
+            snapshots = [sim.metrics_snapshot() for sim in simulations]
+        else:
+            snapshots = pool.get_metrics()
+        exporter.export(configs, snapshots, final)
+
+    # The perfect deduplication of the same uploads and its rows of the
+    # last batch
+    baseline = None
+    baseline_rows = None
+    columns = results.COLUMNS
+    if args.with_perfect_baseline:
+        baseline_rows = results.LastRows()
+        baseline = perfect.PerfectSimulator([baseline_rows], args.seen_set)
+        columns += results.BASELINE_COLUMNS
+
+    def print_baseline_stats():
+        counters = baseline.snapshot()
+        print("  Perfect: files_in_storage=%s, DDP=%s, data_in_storage=%s, "
+              "DDP=%s, seen_set=%s" % (
+                  utils.num_fmt(counters.files_in_storage * scale),
+                  1 - counters.files_in_storage / counters.files_uploaded,
+                  utils.sizeof_fmt(counters.data_in_storage * scale),
+                  1 - counters.data_in_storage / counters.data_uploaded,
+                  utils.sizeof_fmt(baseline.seen_bytes())),
+              file=sys.stderr)
+
+    # The sampler and the writer of the evolution output
+    sampler = sampling.new_sampler(args, args.seed, len(columns))
+    writer = None
+
+    # The number of uploads simulated before this run and the states of the
+    # simulations of each shard
+    offset = 0
+    shards = None
+    if restore is not None:
+        meta, shards = restore
+        offset = meta["offset"]
+        for sim, counters in zip(simulations, meta["counters"]):
+            sim.set_counters(counters)
+        if meta["sampler"] is not None:
+            sampler = pickle.loads(base64.b64decode(meta["sampler"]))
+        if args.resume and not args.only_final:
+            # Continue the output of the interrupted run.
+            results.truncate_output(meta["output_offset"])
+            writer = results.new_writer(args, vars(configs[0]),
+                                        meta["writer"])
+
+    output = None
+    if not args.only_final:
+        if writer is None:
+            writer = results.new_writer(args, vars(configs[0]),
+                                        columns=columns)
+        # Only one simulation can print the intermediate results.
+        output = results.EvolutionOutput(writer, sampler, baseline_rows,
+                                         scale)
+        simulators[0].observers.append(output)
+
+    upload_stream = stream.UploadStream(args.input)
+    upload_stream.skip(offset)
+    if group_counters is not None:
+        sample = bucketsample.BucketSample(
+            args.bucket_sample_rate, args.seed, args.shlen, args.hashlen,
+            upload_stream.interned)
+    batches = profiling.timed("decode",
+                              read_batches(args, upload_stream, sample))
+
+    def checkpoint_due(start, end):
+        return checkpoint.due(start, end, args.checkpoint_every)
+
+    def workers_queried(start, end):
+        # The workers are asked for their states or metrics after the batch.
+        return checkpoint_due(start, end) or exporter is not None and \
+            checkpoint.due(start, end, utils.REPORT_FREQUENCY)
+
+    pool = None
+    if args.workers > 1:
+        # The workers simulate the buckets; here we only merge the results.
+        pool = ShardPool(configs, args.workers, shards)
+        outcomes = profiling.timed(
+            "simulate", pool.simulate(batches, offset, workers_queried))
+    else:
+        if shards is not None:
+            for sim, state in zip(simulations, shards[0]):
+                sim.set_state(*state)
+        outcomes = ((batch, [None] * len(simulations)) for batch in batches)
+
+    for (keys, bids, sizes), all_stored in outcomes:
+        start = simulations[0].counters()
+
+        with profiling.phase("simulate"):
+            if baseline is not None:
+                baseline.feed(keys, sizes)
+            all_stored = [sim.feed_buckets(keys, bids, sizes, stored)
+                          for sim, stored in zip(simulators, all_stored)]
+
+        if group_counters is not None:
+            groups = sample.groups(bids)
+            for counters, stored in zip(group_counters, all_stored):
+                counters.add(groups, stored, sizes)
+
+        uploaded = simulations[0].files_uploaded
+        if uploaded // utils.REPORT_FREQUENCY > \
+                start[1] // utils.REPORT_FREQUENCY:
+            print_stats()
+            if baseline is not None:
+                print_baseline_stats()
+            export_metrics()
+
+        if checkpoint_due(start[1], uploaded):
+            with profiling.phase("checkpoint"):
+                save_checkpoint(args, configs, simulations, pool, sampler,
+                                writer)
+
+    upload_stream.close()
+    export_metrics(final=True)
+    if pool is not None:
+        pool.close()
+    if exporter is not None:
+        exporter.close()
+
+    if output is not None:
+        output.close()
 
     # Print the results if asked to. If this was false, the progress has been
     # printed as files were being uploaded.
     if args.only_final:
-        print("%s,%s,%s,%s,%s,%s" % (
-            args.rlc,
-            args.rlu,
-            args.max_threshold,
-            args.offline_rate,
-            1 - files_in_storage / files_uploaded,
-            1 - data_in_storage / data_uploaded,
-        ))
+        for i in range(0, len(simulations), args.replicates):
+            if args.replicates > 1:
+                line = replicates.final_result(
+                    simulations[i:i + args.replicates], args.confidence)
+            else:
+                line = simulations[i].final_result()
+            if group_counters is not None:
+                # The replicates share the sample; pool their groups.
+                counts = sum(counters.counts for counters in
+                             group_counters[i:i + args.replicates])
+                line += ",%s,%s" % bucketsample.standard_errors(
+                    counts, args.bucket_sample_rate)
+            if baseline is not None:
+                counters = baseline.snapshot()
+                line += ",%s,%s" % (
+                    1 - counters.files_in_storage / counters.files_uploaded,
+                    1 - counters.data_in_storage / counters.data_uploaded)
+            print(line)
 
     print("+++ Done - ", file=sys.stderr, end="")
     print_stats()
+    if baseline is not None:
+        print_baseline_stats()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("input",
+                        action="store", default="-", type=str, nargs="?",
+                        help="The upload request stream file to simulate; " +
+                             "either a raw or an interned stream. Defaults " +
+                             "to stdin '-'")
     params = parser.add_argument_group("Protocol Parameters")
     params.add_argument("--short-hash-length",
                         dest="shlen", action="store", default=13, type=int,
@@ -257,19 +1329,28 @@ if __name__ == "__main__":
                         help="The length of the dataset hashes in bits.")
 
     params.add_argument("--check-limit",
-                        dest="rlc", action="store", default=70, type=int,
+                        dest="rlc", action="store", default=[70],
+                        type=utils.value_list(int),
                         help="The number of times an uploader can perform a " +
                              "check for a file (RL_c).")
     params.add_argument("--pake-runs",
-                        dest="rlu", action="store", default=30, type=int,
+                        dest="rlu", action="store", default=[30],
+                        type=utils.value_list(int),
                         help="The number of files that are considered when " +
                              "uploading a new file (RL_u).")
     params.add_argument("--max-threshold",
-                        action="store", default=20, type=int,
+                        action="store", default=[20],
+                        type=utils.value_list(int),
                         help="The maximum value for the random threshold")
-    params.add_argument("--offline-rate", action="store", default=0, type=float,
+    params.add_argument("--offline-rate", action="store", default=[0],
+                        type=utils.value_list(float),
                         help="The probability that a client is offline " +
                         "during an upload.")
+    params.add_argument("--sweep", action="store", type=str,
+                        help="A file of parameter sets to simulate in a " +
+                             "single pass; each line has the format " +
+                             "<RLc>,<RLu>,<max_threshold>,<offline_rate>. " +
+                             "Overrides the parameters above.")
 
     protof = parser.add_argument_group(
         "Protocol Version",
@@ -284,6 +1365,45 @@ if __name__ == "__main__":
                         help="If specified, deduplication occurs even if the " +
                         "number of copies is below the threshold")
 
+    parser.add_argument(
+        "--seed", action="store", type=int,
+        help="The seed for the random numbers. Simulations with the same " +
+             "seed and parameters produce the same results. A random seed " +
+             "is used by default.")
+    parser.add_argument(
+        "--workers", action="store", default=1, type=int,
+        help="The number of worker processes. The buckets are sharded " +
+             "among the workers; the results are the same as with a " +
+             "single process.")
+
+    parser.add_argument(
+        "--engine", action="store", default="reference",
+        choices=sorted(ENGINES),
+        help="The simulation engine. The array engine keeps the buckets in " +
+             "flat arrays and runs the protocol in a compiled kernel if " +
+             "Numba is installed; the results are the same.")
+
+    parser.add_argument(
+        "--max-memory", action="store", type=utils.byte_size, metavar="SIZE",
+        help="The approximate memory budget of the buckets, e.g. 2G. The " +
+             "least recently used buckets beyond the budget are spilled to " +
+             "a file and read back when needed; the results are the same. " +
+             "Only with the reference engine.")
+    parser.add_argument(
+        "--spill-dir", action="store", type=str,
+        help="The directory of the spill files of --max-memory (default: " +
+             "the temporary directory).")
+
+    parser.add_argument(
+        "--with-perfect-baseline", action="store_true",
+        help="Also simulate perfect deduplication of the uploads in the " +
+             "same pass; see above for the output.")
+    parser.add_argument(
+        "--seen-set", action="store", default="runs",
+        choices=sorted(seenset.HASH_SETS),
+        help="The set of the hashes seen by the perfect baseline; see " +
+             "simulator-perfect.py.")
+
     parser.add_argument(
         "--only-final", action="store_true",
         help=("Only print final results from the simulation. The format of "
@@ -293,4 +1413,78 @@ if __name__ == "__main__":
               "<dedup_percentage_based_on_bytes>")
     )
 
-    simulate(parser.parse_args())
+    checkp = parser.add_argument_group(
+        "Checkpoints",
+        "The state of the simulations can be saved periodically to continue "
+        "an interrupted run or to start variants of a run from a shared "
+        "prefix of the stream.")
+    checkp.add_argument(
+        "--checkpoint-every", action="store", type=int, metavar="N",
+        help="Write a checkpoint after every N uploads.")
+    checkp.add_argument(
+        "--checkpoint-dir", action="store", default="checkpoints", type=str,
+        help="The directory of the checkpoints (default: checkpoints).")
+    checkp.add_argument(
+        "--resume", action="store_true",
+        help="Continue from the latest checkpoint in --checkpoint-dir with " +
+             "the parameters and output options of the checkpoint. If the " +
+             "output is appended to the output file of the interrupted " +
+             "run, the lines after the checkpoint are removed first.")
+    checkp.add_argument(
+        "--fork", action="store", type=str, metavar="CHECKPOINT",
+        help="Start from the given checkpoint with the parameters of the " +
+             "command line. The output starts from the checkpoint.")
+
+    replicates.add_arguments(parser)
+    bucketsample.add_arguments(parser)
+    sampling.add_arguments(parser)
+    results.add_arguments(parser)
+    metrics.add_arguments(parser)
+    profiling.add_arguments(parser)
+    parser.set_defaults(grid=None)
+
+    args = parser.parse_args()
+
+    restore = None
+    if args.resume and args.fork:
+        parser.error("--resume and --fork cannot be used together")
+    if args.resume or args.fork:
+        path = args.fork or checkpoint.latest(args.checkpoint_dir)
+        if path is None:
+            parser.error("no checkpoints in %s" % args.checkpoint_dir)
+        restore = checkpoint.load(path)
+        restore_arguments(parser, args, restore[0])
+        print("+++ Restoring: %s" % path, file=sys.stderr)
+
+    replicates.check_arguments(parser, args)
+    bucketsample.check_arguments(parser, args)
+    if not args.only_final and (args.sweep or len(configurations(args)) > 1):
+        parser.error("simulating multiple parameter sets requires " +
+                     "--only-final")
+    if args.only_final and (args.samples or args.every):
+        parser.error("--samples and --every cannot be used with --only-final")
+    if args.only_final and args.output_format != "csv":
+        parser.error("--output-format cannot be used with --only-final")
+    sampling.check_arguments(parser, args)
+    results.check_arguments(parser, args)
+    profiling.check_arguments(parser, args)
+    if args.max_memory and args.engine == "array":
+        parser.error("--max-memory requires --engine reference")
+    if args.spill_dir and not args.max_memory:
+        parser.error("--spill-dir requires --max-memory")
+    if args.with_perfect_baseline and (args.checkpoint_every or restore):
+        parser.error("--with-perfect-baseline does not support checkpoints")
+    if args.bucket_sample_rate < 1 and (args.checkpoint_every or restore):
+        parser.error("--bucket-sample-rate does not support checkpoints")
+    if args.output_format == "npy" and (args.checkpoint_every or restore):
+        parser.error("checkpoints do not support --output-format npy")
+
+    if args.seed is None:
+        args.seed = rng.new_seed()
+    print("+++ Seed: %i" % args.seed, file=sys.stderr)
+
+    if args.engine == "array":
+        import array_engine
+        array_engine.warn_if_interpreted()
+
+    profiling.run(args, simulate, args, restore)
@@ -0,0 +1,511 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batched readers and writers for the upload request streams generated with
+the generate-upload-stream.py script.
+
+Two stream formats are supported:
+* Raw streams are a headerless concatenation of 25 byte records; each record
+  has the file size (5 bytes) followed by the SHA1 hash of the file (20
+  bytes), both big-endian.
+* Interned streams (written by intern-upload-stream.py) start with a 16 byte
+  header and contain (file ID, short hash, size) records, little-endian. The
+  file IDs are dense integers assigned in the order of first appearance and a
+  side table maps them back to the original hashes.
+Raw streams may also be in an indexed container that records the number of
+uploads, the generation parameters and block checksums; see indexed.py.
+
+The readers here read the stream in large chunks and decode each chunk into a
+NumPy structured array at once instead of decoding the uploads one by one.
+Streams of either format may be gzip or BGZF compressed; see compressed.py.
+"""
+
+import compressed
+import indexed
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+# 5 bytes for the file size, 20 bytes for the SHA1 hash.
+BYTES_PER_UPLOAD = 25
+
+# The number of uploads decoded at once by default.
+DEFAULT_BATCH_SIZE = 1 << 16
+
+# The decoded uploads. The hash is available both as the raw 20 bytes and as
+# big-endian words: hash_hi has the bits 96-159, hash_lo the bits 32-95 and
+# hash_tail the bits 0-31 of the hash.
+UPLOAD_DTYPE = np.dtype([
+    ("hash", "V20"),
+    ("hash_hi", "u8"),
+    ("hash_lo", "u8"),
+    ("hash_tail", "u4"),
+    ("size", "u8"),
+])
+
+# The header of interned streams: magic, bytes per file ID, short hash length
+# and hash length the short hashes were computed with.
+ID_STREAM_MAGIC = b"DDPIDS01"
+ID_STREAM_HEADER = struct.Struct("<8sBBH4x")
+
+# The records of interned streams by the width of the file IDs.
+ID_RECORD_DTYPES = {
+    4: np.dtype([("id", "<u4"), ("short_hash", "<u4"), ("size", "<u8")]),
+    8: np.dtype([("id", "<u8"), ("short_hash", "<u4"), ("size", "<u8")]),
+}
+
+
+def decode(buf, count):
+    """Decodes uploads from raw stream bytes.
+
+    Args:
+        buf - A bytes-like object that contains at least count records.
+        count - The number of records to decode.
+
+    Returns:
+        A NumPy array of UPLOAD_DTYPE with count uploads.
+    """
+
+    raw = np.frombuffer(buf, np.uint8, count * BYTES_PER_UPLOAD)
+    raw = raw.reshape(count, BYTES_PER_UPLOAD)
+
+    uploads = np.empty(count, UPLOAD_DTYPE)
+    uploads["hash"] = np.ascontiguousarray(raw[:, 5:]).view("V20")[:, 0]
+    uploads["hash_hi"] = np.ascontiguousarray(raw[:, 5:13]).view(">u8")[:, 0]
+    uploads["hash_lo"] = np.ascontiguousarray(raw[:, 13:21]).view(">u8")[:, 0]
+    uploads["hash_tail"] = np.ascontiguousarray(raw[:, 21:]).view(">u4")[:, 0]
+
+    # Pad the 5 byte size to a 64-bit word.
+    size = np.zeros((count, 8), np.uint8)
+    size[:, 3:] = raw[:, :5]
+    uploads["size"] = size.view(">u8")[:, 0]
+
+    return uploads
+
+
+def short_hashes(uploads, shlen, hashlen):
+    """Computes the short hashes for a batch of decoded raw uploads.
+
+    Args:
+        uploads - A NumPy array of UPLOAD_DTYPE.
+        shlen - The length of the short hash in bits.
+        hashlen - The length of the dataset hashes in bits.
+
+    Returns:
+        A list of ints; the hash of each upload shifted right by
+        hashlen - shlen bits.
+    """
+
+    shift = hashlen - shlen
+    if 96 <= shift < 160:
+        # The short hash comes from the top 64 bits of the hash.
+        return (uploads["hash_hi"] >> np.uint64(shift - 96)).tolist()
+
+    return [int.from_bytes(hsh, byteorder="big") >> shift
+            for hsh in uploads["hash"].tolist()]
+
+
+def _read_exact(fileobj, buf, filled=0):
+    """Reads from fileobj until buf is full or the stream ends. Returns the
+    number of bytes in buf.
+    """
+
+    view = memoryview(buf)
+    # Pipes may return less than asked for; keep reading until the buffer
+    # is full or the stream ends.
+    while filled < len(buf):
+        n = fileobj.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+
+    view.release()
+    return filled
+
+
+def _read_chunks(fileobj, chunk_size, prefix=b"", length=None):
+    """A generator that reads fileobj in chunks of chunk_size bytes. Only the
+    last chunk may be shorter than chunk_size. The bytes in prefix are
+    returned before the bytes read from fileobj. If length is given, at most
+    length bytes are returned.
+    """
+
+    while length is None or length > 0:
+        size = chunk_size if length is None else min(chunk_size, length)
+        buf = bytearray(size)
+        buf[:len(prefix)] = prefix
+        filled = _read_exact(fileobj, buf, len(prefix))
+        prefix = b""
+        if length is not None:
+            length -= filled
+
+        if filled:
+            yield buf if filled == size else buf[:filled]
+
+        if filled < size:
+            return
+
+
+def _map_chunks(mm, offset, chunk_size, end):
+    """A generator that yields the memory-mapped file mm in chunks of
+    chunk_size bytes from offset to end.
+    """
+
+    for start in range(offset, end, chunk_size):
+        yield memoryview(mm)[start:min(start + chunk_size, end)]
+
+
+class UploadStream:
+    """An upload request stream opened for reading. Stream files are
+    memory-mapped; '-' reads the stream from stdin. gzip and BGZF compressed
+    streams are decompressed on the fly, BGZF streams by a pool of threads
+    (see compressed.Reader).
+
+    Attributes:
+        interned - True if this is an interned file-ID stream.
+        indexed - True if this is an indexed raw stream.
+        shlen - The short hash length of an interned stream (None if raw).
+        hashlen - The hash length of an interned or indexed stream (None if
+            raw).
+        record_size - The number of bytes per upload in the stream.
+        count - The number of uploads of an indexed stream (None if
+            unknown).
+        params - The generation parameters of an indexed stream (None if
+            unknown).
+    """
+
+    def __init__(self, source="-", batch_size=DEFAULT_BATCH_SIZE,
+                 threads=None):
+        self.source = source
+        self.batch_size = batch_size
+
+        self._fp = None
+        self._mm = None
+
+        # The file object the stream is read from unless it is mapped
+        self._input = None
+
+        if source in (None, "-"):
+            self._input = sys.stdin.buffer
+        else:
+            self._fp = open(source, "rb")
+            if compressed.is_compressed(
+                    self._fp.peek(compressed.HEAD_SIZE)):
+                self._input = self._fp
+            elif os.fstat(self._fp.fileno()).st_size:
+                self._mm = mmap.mmap(self._fp.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+
+        if self._input is not None:
+            header = bytearray(ID_STREAM_HEADER.size)
+            header = header[:_read_exact(self._input, header)]
+            if compressed.is_compressed(header):
+                self._input = compressed.Reader(self._input, threads,
+                                                bytes(header))
+                header = bytearray(ID_STREAM_HEADER.size)
+                header = header[:_read_exact(self._input, header)]
+        else:
+            header = self._mm[:ID_STREAM_HEADER.size] if self._mm else b""
+
+        self.interned = header.startswith(ID_STREAM_MAGIC)
+        self.indexed = header.startswith(indexed.MAGIC)
+        self.count = None
+        self.params = None
+
+        # The offset of the end of the records; None if the stream ends with
+        # them
+        self._end = None
+
+        if self.interned:
+            (_, id_bytes, self.shlen, self.hashlen) = \
+                ID_STREAM_HEADER.unpack(header)
+            self._dtype = ID_RECORD_DTYPES[id_bytes]
+            self.record_size = self._dtype.itemsize
+            self._offset = ID_STREAM_HEADER.size
+            self._prefix = b""
+        elif self.indexed:
+            info = indexed.read_header(self._header_reader(bytes(header)))
+            self.shlen = None
+            self.hashlen = info.hashlen
+            self._dtype = None
+            self.record_size = BYTES_PER_UPLOAD
+            self.count = info.count
+            self.params = info.params
+            self._offset = info.data_offset
+            self._end = info.data_end
+            self._prefix = b""
+            if self._mm is not None and len(self._mm) < self._end:
+                raise ValueError("Truncated indexed stream: %i of %i "
+                                 "uploads" % ((len(self._mm) - self._offset) //
+                                              self.record_size, self.count))
+        else:
+            self.shlen = self.hashlen = None
+            self._dtype = None
+            self.record_size = BYTES_PER_UPLOAD
+            self._offset = 0
+            # The bytes we peeked from the input are the first uploads.
+            self._prefix = bytes(header)
+
+    def _header_reader(self, peeked):
+        """Returns a function n -> the next n bytes of the stream from its
+        beginning given the bytes of the stream already read.
+        """
+
+        position = 0
+
+        def read(count):
+            nonlocal position
+            start, position = position, position + count
+            if self._input is None:
+                return self._mm[start:position]
+            data = peeked[start:position]
+            rest = bytearray(count - len(data))
+            return data + bytes(rest[:_read_exact(self._input, rest)])
+
+        return read
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Closes the stream file."""
+        if isinstance(self._input, compressed.Reader):
+            self._input.close()
+        if self._mm is not None:
+            self._mm.close()
+        if self._fp is not None:
+            self._fp.close()
+
+    def skip(self, count):
+        """Skips the next count uploads of the stream. Mapped stream files
+        are seeked; stdin and compressed streams are read and discarded.
+        """
+
+        length = count * self.record_size
+        if self._end is not None and self._offset + length > self._end:
+            raise ValueError("Cannot skip %i uploads; the stream is shorter" %
+                             count)
+        if self._input is None:
+            end = len(self._mm) if self._mm is not None else 0
+            if self._offset + length > end:
+                raise ValueError("Cannot skip %i uploads; the stream is "
+                                 "shorter" % count)
+            self._offset += length
+            return
+        self._offset += length
+
+        prefix = self._prefix[:length]
+        self._prefix = self._prefix[length:]
+        length -= len(prefix)
+
+        buf = bytearray(min(length, 1 << 20))
+        while length:
+            filled = _read_exact(self._input,
+                                 memoryview(buf)[:min(length, len(buf))])
+            if not filled:
+                raise ValueError("Cannot skip %i uploads; the stream is "
+                                 "shorter" % count)
+            length -= filled
+
+    def _chunks(self):
+        chunk_size = self.batch_size * self.record_size
+        if self._input is not None:
+            length = None
+            if self._end is not None:
+                length = self._end - self._offset
+            return _read_chunks(self._input, chunk_size, self._prefix, length)
+        if self._mm is None:
+            return iter(())
+        return _map_chunks(self._mm, self._offset, chunk_size,
+                           self._end or len(self._mm))
+
+    def batches(self, select=None):
+        """Reads the stream in batches.
+
+        Args:
+            select - None or a function that is given the top 64 bits of
+                the hashes (raw streams) or the short hashes (interned
+                streams) of a batch as a uint64 array and returns a mask of
+                the uploads to keep. The other uploads are dropped before
+                they are decoded.
+
+        Yields:
+            NumPy arrays with at most batch_size uploads in the stream order.
+            The arrays are of UPLOAD_DTYPE for raw streams and of
+            ID_RECORD_DTYPES for interned streams.
+        """
+
+        for chunk in self._chunks():
+            count, extra = divmod(len(chunk), self.record_size)
+            if extra:
+                raise ValueError("Truncated upload stream: %i trailing bytes"
+                                 % extra)
+
+            if self.interned:
+                records = np.frombuffer(chunk, self._dtype, count)
+                if select is None:
+                    yield records.copy()
+                else:
+                    yield records[select(
+                        records["short_hash"].astype(np.uint64))]
+            elif select is not None:
+                raw = np.frombuffer(chunk, np.uint8, count * BYTES_PER_UPLOAD)
+                raw = raw.reshape(count, BYTES_PER_UPLOAD)
+                hash_hi = np.ascontiguousarray(raw[:, 5:13]).view(">u8")[:, 0]
+                raw = raw[select(hash_hi.astype(np.uint64))]
+                yield decode(raw, len(raw))
+            else:
+                yield decode(chunk, count)
+
+            if isinstance(chunk, memoryview):
+                # Release the view so that the mapping can be closed.
+                chunk.release()
+
+    def decode_keys(self, batch, shlen, hashlen):
+        """Decodes a batch into the values the simulators need.
+
+        Args:
+            batch - A batch returned by batches().
+            shlen - The length of the short hash in bits.
+            hashlen - The length of the dataset hashes in bits.
+
+        Returns:
+            A (keys, short_hashes, sizes) tuple of lists. The keys identify
+            the files; they are the 20 byte hashes (bytes) of raw streams and
+            the file IDs (int) of interned streams.
+        """
+
+        if not self.interned:
+            return (batch["hash"].tolist(),
+                    short_hashes(batch, shlen, hashlen),
+                    batch["size"].tolist())
+
+        if (shlen, hashlen) != (self.shlen, self.hashlen):
+            raise ValueError(
+                "The stream was interned with short hash length %i and hash "
+                "length %i, not %i and %i" % (self.shlen, self.hashlen,
+                                              shlen, hashlen))
+
+        return (batch["id"].tolist(),
+                batch["short_hash"].tolist(),
+                batch["size"].tolist())
+
+    def uploads(self, shlen, hashlen):
+        """Reads the stream one upload at a time.
+
+        Yields:
+            A (key, short_hash, size) tuple for each upload. See decode_keys().
+        """
+
+        for batch in self.batches():
+            yield from zip(*self.decode_keys(batch, shlen, hashlen))
+
+
+def read_upload_batches(source="-", batch_size=DEFAULT_BATCH_SIZE):
+    """Reads a raw upload request stream in batches.
+
+    Args:
+        source - The path of the stream file. The file is memory-mapped. If
+            the source is '-' or None, the stream is read from stdin.
+        batch_size - The maximum number of uploads in a single batch.
+
+    Yields:
+        NumPy arrays of UPLOAD_DTYPE in the stream order.
+    """
+
+    with UploadStream(source, batch_size) as stream:
+        if stream.interned:
+            raise ValueError("Interned streams do not contain the hashes; " +
+                             "use the ID table to map the IDs to hashes.")
+
+        yield from stream.batches()
+
+
+class IdStreamWriter:
+    """Writes interned upload request streams. The file IDs are assigned in
+    the order the files first appear in the stream and the 20 byte hash of
+    each new file is appended to the ID table, i.e. the hash of file ID i is
+    at the offset 20 * i of the table.
+    """
+
+    def __init__(self, out, table, shlen, hashlen, id_bytes=4):
+        """Initializes the writer and writes the stream header.
+
+        Args:
+            out - A binary file object to write the stream to.
+            table - A binary file object to write the ID table to.
+            shlen - The length of the short hashes in bits (at most 32).
+            hashlen - The length of the dataset hashes in bits.
+            id_bytes - The width of the file IDs; 4 or 8 bytes.
+        """
+
+        if not 0 <= shlen <= 32:
+            raise ValueError("Interned streams support short hashes of at " +
+                             "most 32 bits")
+
+        self.out = out
+        self.table = table
+        self.shlen = shlen
+        self.hashlen = hashlen
+        self.dtype = ID_RECORD_DTYPES[id_bytes]
+        self.max_id = (1 << (8 * id_bytes)) - 1
+
+        # A dict hash -> file ID.
+        self.ids = {}
+
+        out.write(ID_STREAM_HEADER.pack(ID_STREAM_MAGIC, id_bytes, shlen,
+                                        hashlen))
+
+    def write(self, hashes, sizes):
+        """Writes a batch of uploads to the stream.
+
+        Args:
+            hashes - A list of 20 byte hashes (bytes).
+            sizes - A list of file sizes.
+        """
+
+        ids = self.ids
+        records = np.empty(len(hashes), self.dtype)
+
+        new_files = []
+        file_ids = []
+        for hsh in hashes:
+            file_id = ids.get(hsh)
+            if file_id is None:
+                file_id = ids[hsh] = len(ids)
+                new_files.append(hsh)
+            file_ids.append(file_id)
+
+        if len(ids) - 1 > self.max_id:
+            raise OverflowError("Too many files for %i byte file IDs" %
+                                self.dtype["id"].itemsize)
+
+        shift = self.hashlen - self.shlen
+        records["id"] = file_ids
+        records["short_hash"] = [int.from_bytes(hsh, byteorder="big") >> shift
+                                 for hsh in hashes]
+        records["size"] = sizes
+
+        self.table.write(b"".join(new_files))
+        self.out.write(records.tobytes())
+
+    def write_batch(self, uploads):
+        """Writes a batch decoded from a raw stream."""
+        self.write(uploads["hash"].tolist(), uploads["size"].tolist())
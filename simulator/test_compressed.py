@@ -0,0 +1,58 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the detection of compressed upload request streams.
+
+Run with python3 -m unittest from the simulator directory.
+"""
+
+import gzip
+import os
+import tempfile
+import unittest
+
+import compressed
+import stream
+
+
+class IsCompressedTest(unittest.TestCase):
+
+    def test_gzip_and_bgzf(self):
+        self.assertTrue(compressed.is_compressed(gzip.compress(b"uploads")))
+        self.assertTrue(compressed.is_compressed(compressed.BGZF_EOF))
+
+    def test_raw_stream_with_gzip_magic(self):
+        # A file of 0x1f8b000000 bytes (about 135 GB) starts with the magic
+        # of gzip but not with its method.
+        record = b"\x1f\x8b\x00\x00\x00" + b"\x42" * 20
+        self.assertFalse(compressed.is_compressed(record))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "uploads")
+            with open(path, "wb") as out:
+                out.write(record * 3)
+            with stream.UploadStream(path) as uploads:
+                self.assertFalse(uploads.indexed or uploads.interned)
+                batches = list(uploads.batches())
+            self.assertEqual(sum(len(batch) for batch in batches), 3)
+
+    def test_reserved_flags(self):
+        head = bytearray(gzip.compress(b"uploads"))
+        head[3] |= 0x80
+        self.assertFalse(compressed.is_compressed(head))
+        self.assertFalse(compressed.is_compressed(b"\x1f\x8b"))
+
+
+if __name__ == "__main__":
+    unittest.main()
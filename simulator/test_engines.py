@@ -0,0 +1,45 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs compare-engines.py on small streams; every engine and mode must
+match the oracle.
+
+Run with python3 -m unittest from the simulator directory.
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+HARNESS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       "compare-engines.py")
+
+
+class CompareEnginesTest(unittest.TestCase):
+
+    def test_all_modes_match_the_oracle(self):
+        result = subprocess.run(
+            [sys.executable, HARNESS, "--uploads", "2000", "--files", "400",
+             "--offline-rates", "0,0.5", "--batch-size", "500"],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        mismatches = [line for line in result.stdout.splitlines()
+                      if line.startswith("MISMATCH")]
+        self.assertEqual(mismatches, [])
+        self.assertEqual(result.returncode, 0, result.stdout[-2000:])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of indexed upload request streams.
+
+Run with python3 -m unittest from the simulator directory.
+"""
+
+import gzip
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+import compressed
+import indexed
+import stream
+
+
+def _records(count, seed=1):
+    """Returns count encoded uploads with random hashes and sizes."""
+    rand = random.Random(seed)
+    return b"".join((rand.getrandbits(160) | rand.getrandbits(40) << 160)
+                    .to_bytes(stream.BYTES_PER_UPLOAD, byteorder="big")
+                    for _ in range(count))
+
+
+class IndexedStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "uploads")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _write(self, records, compression):
+        count = len(records) // indexed.RECORD_SIZE
+        with open(self.path, "wb") as out:
+            if compression != "none":
+                out = compressed.new_writer(out, compression)
+            writer = indexed.IndexedStreamWriter(out, count, 160,
+                                                 {"seed": 1},
+                                                 block_records=1000)
+            # Write in pieces that do not line up with the blocks.
+            for start in range(0, len(records), 777 * indexed.RECORD_SIZE):
+                writer.write(records[start:start + 777 *
+                                     indexed.RECORD_SIZE])
+            writer.close()
+            if compression != "none":
+                out.close()
+
+    def _read(self, skip=0):
+        with stream.UploadStream(self.path, batch_size=333) as uploads:
+            self.assertTrue(uploads.indexed)
+            self.assertEqual(uploads.params, {"seed": 1})
+            uploads.skip(skip)
+            return np.concatenate(list(uploads.batches()))
+
+    def _assert_uploads(self, uploads, records):
+        count = len(records) // indexed.RECORD_SIZE
+        self.assertTrue(np.array_equal(uploads,
+                                       stream.decode(records, count)))
+
+    def test_round_trip(self):
+        records = _records(5000)
+        for compression in compressed.COMPRESSIONS:
+            with self.subTest(compression=compression):
+                self._write(records, compression)
+                self._assert_uploads(self._read(), records)
+                self._assert_uploads(self._read(1234),
+                                     records[1234 * indexed.RECORD_SIZE:])
+
+    def test_bgzf_is_gzip(self):
+        records = _records(3000)
+        self._write(records, "none")
+        with open(self.path, "rb") as f:
+            raw = f.read()
+        self._write(records, "bgzf")
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.assertTrue(data.endswith(compressed.BGZF_EOF))
+        self.assertEqual(gzip.decompress(data), raw)
+
+    def test_verify(self):
+        records = _records(2500)
+        self._write(records, "none")
+        with indexed.IndexedStream(self.path) as uploads:
+            self.assertEqual(len(uploads.index), 3)
+            self.assertEqual(uploads.verify(), [])
+            self.assertTrue(uploads.verify_sha256())
+            offset = uploads.offset_of(1500)
+
+        with open(self.path, "r+b") as f:
+            f.seek(offset)
+            f.write(b"\xff" * indexed.RECORD_SIZE)
+        with indexed.IndexedStream(self.path) as uploads:
+            self.assertEqual(uploads.verify(), [1])
+            self.assertFalse(uploads.verify_sha256())
+
+
+if __name__ == "__main__":
+    unittest.main()
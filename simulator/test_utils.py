@@ -0,0 +1,60 @@
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of utils.py.
+
+Run with python3 -m unittest from the simulator directory.
+"""
+
+import argparse
+import unittest
+
+import utils
+
+
+class ValueListTest(unittest.TestCase):
+
+    def test_lists_and_ranges(self):
+        ints = utils.value_list(int)
+        self.assertEqual(ints("70"), [70])
+        self.assertEqual(ints("10,20"), [10, 20])
+        self.assertEqual(ints("10:50:10"), [10, 20, 30, 40, 50])
+        self.assertEqual(ints("10:55:10"), [10, 20, 30, 40, 50])
+        self.assertEqual(ints("1:3,7"), [1, 2, 3, 7])
+        self.assertEqual(ints("5:5"), [5])
+
+    def test_float_ranges(self):
+        floats = utils.value_list(float)
+        self.assertEqual(floats("0:1:0.1"),
+                         [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1])
+        # The values do not go past the stop.
+        self.assertEqual(floats("1:2.9:0.4"), [1, 1.4, 1.8, 2.2, 2.6])
+
+    def test_invalid_ranges(self):
+        ints = utils.value_list(int)
+        for text in ("90:10:10", "90:10", "10:90:0", "10:90:-10",
+                     "1:2:3:4"):
+            with self.subTest(text=text):
+                with self.assertRaises(argparse.ArgumentTypeError):
+                    ints(text)
+
+    def test_parser_error(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--check-limit", type=utils.value_list(int))
+        with self.assertRaises(SystemExit):
+            parser.parse_args(["--check-limit", "90:10:10"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -12,10 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
 import cProfile
 import functools
+import pstats
 import random
 import resource
+import stream
 import timer
 import tqdm
 import sys
@@ -25,7 +28,7 @@ import sys
 REPORT_FREQUENCY = 100000
 
 # 20 bytes for the SHA1 hash, 5 bytes for the file size.
-BYTES_PER_UPLOAD = 25
+BYTES_PER_UPLOAD = stream.BYTES_PER_UPLOAD
 
 
 def timeit(fn):
@@ -44,22 +47,25 @@ def timeit(fn):
     return wrapper
 
 
-def profileit(func):
-    """A decorator that will record and print a cProfile profile for the
-       decorated function.
+def profileit(func, out=None):
+    """A decorator that will record a cProfile profile for the decorated
+       function. The profile is written to the file out in the pstats format
+       if given; otherwise it is printed to stderr.
     """
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         profiler = cProfile.Profile()
         profiler.enable()
-        rval = func(*args, **kwargs)
-        profiler.disable()
         try:
-            # Only in 3.3
-            profiler.print_stats(sort="cumtime")
-        except KeyError:
-            profiler.print_stats()
-        return rval
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            if out is not None:
+                profiler.dump_stats(out)
+                print("+++ Profile written to %s" % out, file=sys.stderr)
+            else:
+                stats = pstats.Stats(profiler, stream=sys.stderr)
+                stats.sort_stats("cumulative").print_stats()
 
     return wrapper
 
@@ -102,6 +108,64 @@ def get_mem_info(obj=None):
     return "obj=%s, total=%s" % (datamem, totalmem)
 
 
+def byte_size(text):
+    """An argparse type for sizes in bytes with an optional K, M or G
+    suffix (powers of 1024), e.g. "512M".
+    """
+
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper().rstrip("B")
+    scale = units.get(text[-1:], 1)
+    if scale != 1:
+        text = text[:-1]
+    try:
+        size = int(float(text) * scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size %r" % text)
+    if size <= 0:
+        raise argparse.ArgumentTypeError("the size must be positive")
+    return size
+
+
+def value_list(convert):
+    """Creates an argparse type for parameters that accept multiple values.
+
+    The created type parses a comma separated list of values and inclusive
+    start:stop[:step] ranges like seq, e.g. "10,20" or "10:90:10".
+
+    Arguments:
+    convert -- The type of the values (int or float).
+    """
+
+    def parse(text):
+        values = []
+        for part in text.split(","):
+            bounds = [convert(v) for v in part.split(":")]
+            if len(bounds) == 1:
+                values.extend(bounds)
+                continue
+
+            if len(bounds) not in (2, 3) or \
+                    len(bounds) == 3 and bounds[2] <= 0:
+                raise argparse.ArgumentTypeError("invalid range %r" % part)
+
+            start, stop, step = (bounds + [1])[:3]
+            if stop < start:
+                raise argparse.ArgumentTypeError(
+                    "invalid range %r: the stop is below the start" % part)
+
+            # The values up to the stop; the tolerance keeps a stop that
+            # is reached with float steps.
+            count = int((stop - start) / step + 1e-9) + 1
+            # Round the floats to avoid accumulating representation errors.
+            values.extend(convert(round(start + i * step, 10))
+                          for i in range(count))
+
+        return values
+
+    return parse
+
+
 def shuffle(in_list):
     """A generator that iterates the list in random order.
 
@@ -122,24 +186,25 @@ def shuffle(in_list):
     yield in_list[0]
 
 
-def read_upload_stream():
-    """Reads the precomputed upload request stream from stdin. The stream MUST
-       be generated with generate_upload_stream.py script.
+def read_upload_stream(source="-"):
+    """Reads the precomputed upload request stream from stdin or a file. The
+       stream MUST be generated with generate_upload_stream.py script.
+
+       This is a compatibility wrapper for stream.read_upload_batches(); prefer
+       the batched reader in new code.
+
+       Arguments:
+          source -- The stream file to read. Defaults to stdin '-'.
 
        Yields:
           A (hash, size) tuple of each upload (int, int).
     """
-    upload = sys.stdin.buffer.read(BYTES_PER_UPLOAD)
-    while upload:
-        data = int.from_bytes(upload, byteorder='big')
-        hsh = data & 0xffffffffffffffffffffffffffffffffffffffff
-        size = data >> 160
-
-        # Yield the hash, size pair
-        yield (hsh, size)
-
-        # Read the next upload
-        upload = sys.stdin.buffer.read(BYTES_PER_UPLOAD)
+    for batch in stream.read_upload_batches(source):
+        sizes = batch["size"].tolist()
+        hashes = batch["hash"].tolist()
+        for hsh, size in zip(hashes, sizes):
+            # Yield the hash, size pair
+            yield (int.from_bytes(hsh, byteorder="big"), size)
 
 
 def collect(iterable):
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+#
+# Copyright 2015 Secure Systems Group, Aalto University https://se-sy.org/.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import indexed
+import json
+import sys
+import utils
+
+DESC = ("Prints the header of an indexed upload request stream (see "
+        "indexed.py) and verifies the checksums of its blocks in parallel. "
+        "Exits with status 1 if the stream is corrupt.")
+
+
+@utils.timeit
+def verify_stream(args):
+    try:
+        uploads = indexed.IndexedStream(args.input)
+    except ValueError as error:
+        # Raw and compressed streams have no index to verify.
+        print("+++ Cannot verify %s: %s" % (args.input, error),
+              file=sys.stderr)
+        return 1
+
+    with uploads:
+        header = uploads.header
+        print("+++ Uploads: %i, hash length: %i, blocks: %i" % (
+            header.count, header.hashlen, len(uploads.index)),
+            file=sys.stderr)
+        print("+++ Parameters: %s" % json.dumps(header.params,
+                                                sort_keys=True),
+              file=sys.stderr)
+        print("+++ SHA-256 (raw): %s" % uploads.sha256.hex(), file=sys.stderr)
+
+        corrupt = uploads.verify(args.threads)
+        for block in corrupt:
+            entry = uploads.index[block]
+            first = block * header.block_records
+            print("+++ Corrupt block %i: uploads %i-%i" % (
+                block, first, first + int(entry["records"]) - 1),
+                file=sys.stderr)
+
+        if args.sha256 and not uploads.verify_sha256():
+            print("+++ The SHA-256 of the uploads does not match",
+                  file=sys.stderr)
+            return 1
+
+    if corrupt:
+        return 1
+    print("+++ Stream OK", file=sys.stderr)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=DESC)
+    parser.add_argument("input",
+                        action="store", type=str,
+                        help="The indexed upload request stream file.")
+    parser.add_argument("--threads",
+                        action="store", type=int,
+                        help="The number of threads verifying the blocks " +
+                             "(default: the number of CPUs, at most 4).")
+    parser.add_argument("--sha256",
+                        action="store_true",
+                        help="Also compare the SHA-256 of all the uploads " +
+                             "to the one recorded by the generator; this " +
+                             "reads the stream in a single thread.")
+
+    return verify_stream(parser.parse_args())
+
+
+if __name__ == "__main__":
+    sys.exit(main())